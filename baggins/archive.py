@@ -0,0 +1,237 @@
+'''
+Writers for serialized bags, i.e. bags packaged as a single tar or zip
+archive file.  Payload files are streamed from their source location
+directly into the archive, and checksums are calculated from the same
+reads, so payload content is never staged in an intermediate directory
+and is read only once.  Content is copied in blocks, so memory use does
+not depend on the size of the files being archived.
+
+'''
+
+import os
+import stat
+import tarfile
+import time
+import zipfile
+import zlib
+
+from baggins import fixity
+
+
+#: uncompressed tar archive
+TAR = 'tar'
+#: gzip-compressed tar archive
+TAR_GZ = 'tar.gz'
+#: zip archive
+ZIP = 'zip'
+
+#: available serialization formats
+FORMATS = [TAR, TAR_GZ, ZIP]
+
+#: file extension for each serialization format
+EXTENSIONS = {
+    TAR: '.tar',
+    TAR_GZ: '.tar.gz',
+    ZIP: '.zip',
+}
+
+#: permissions for payload files in the archive (matches the permissions
+#: set on payload files copied into a bag directory)
+PAYLOAD_MODE = 0664
+
+
+class HashingReader(object):
+    '''Read-only file wrapper that calculates checksums and counts the
+    bytes as content is read.  Content is passed to the hasher in blocks
+    of at least :data:`baggins.fixity.BLOCK_SIZE`, regardless of the
+    size of the reads requested, so that threaded digests are not
+    swamped by small blocks.
+
+    :param fileobj: file object to read from
+    :param hasher: :class:`baggins.fixity.MultiHasher`
+    '''
+
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+        #: number of bytes read so far
+        self.size = 0
+        self._pending = []
+        self._pending_size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data:
+            self.size += len(data)
+            self._pending.append(data)
+            self._pending_size += len(data)
+            if self._pending_size >= fixity.BLOCK_SIZE:
+                self.flush()
+        return data
+
+    def flush(self):
+        '''Pass any content read but not yet checksummed to the hasher.'''
+        if self._pending:
+            self.hasher.update(''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+
+class ArchiveWriter(object):
+    '''Base class for serialized bag writers.  Extending classes must
+    implement :meth:`_add_stream`, :meth:`add_tag_file`, and
+    :meth:`close`.'''
+
+    def add_file(self, path, arcname, algorithms, threaded=False):
+        '''Add a payload file to the archive, calculating checksums as
+        the content is written.
+
+        :param path: path to the source file
+        :param arcname: path for the file in the archive
+        :param algorithms: list of :mod:`hashlib` algorithm names
+        :param threaded: calculate each algorithm in a separate thread;
+            see :class:`baggins.fixity.MultiHasher`
+        :returns: tuple of size in bytes and a dictionary of hex digests
+            keyed on algorithm name
+        '''
+        hasher = fixity.MultiHasher(algorithms, threaded)
+        try:
+            with open(path, 'rb') as infile:
+                reader = HashingReader(infile, hasher)
+                self._add_stream(reader, os.fstat(infile.fileno()), arcname)
+                reader.flush()
+        finally:
+            hasher.close()
+        return reader.size, hasher.hexdigests()
+
+    def add_tree(self, path, arcname):
+        '''Add all files under a directory (e.g., bag tag files and
+        metadata) to the archive, under the directory `arcname`.'''
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            relroot = os.path.relpath(root, path)
+            for filename in sorted(files):
+                if relroot != os.curdir:
+                    filename = os.path.join(relroot, filename)
+                self.add_tag_file(os.path.join(path, filename),
+                                  '%s/%s' % (arcname, filename))
+
+    def _add_stream(self, fileobj, filestat, arcname):
+        raise NotImplementedError
+
+    def add_tag_file(self, path, arcname):
+        '''Add a (small) file to the archive as is.'''
+        raise NotImplementedError
+
+    def close(self):
+        '''Finish writing the archive.'''
+        raise NotImplementedError
+
+
+class TarWriter(ArchiveWriter):
+    '''Write a serialized bag as a tar archive, optionally gzip
+    compressed.  Archives are written in POSIX pax format, which has
+    no limits on file size or path length.'''
+
+    def __init__(self, path, compress=False):
+        self.tar = tarfile.open(path, 'w:gz' if compress else 'w',
+                                format=tarfile.PAX_FORMAT)
+
+    def _add_stream(self, fileobj, filestat, arcname):
+        tarinfo = self.tar.gettarinfo(arcname=arcname, fileobj=fileobj.fileobj)
+        tarinfo.mode = PAYLOAD_MODE
+        self.tar.addfile(tarinfo, fileobj)
+
+    def add_tag_file(self, path, arcname):
+        self.tar.add(path, arcname, recursive=False)
+
+    def close(self):
+        self.tar.close()
+
+
+class ZipWriter(ArchiveWriter):
+    '''Write a serialized bag as a zip archive.  Zip64 extensions are
+    used as needed for large files and archives.'''
+
+    #: compression method for zip entries; payload content for
+    #: digitized volumes (i.e., images) does not compress well,
+    #: so files are stored uncompressed by default
+    compression = zipfile.ZIP_STORED
+
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path, 'w', self.compression,
+                                   allowZip64=True)
+
+    def _add_stream(self, fileobj, filestat, arcname):
+        # zipfile can only add content from a named file or a string,
+        # so this follows the logic of :meth:`zipfile.ZipFile.write`
+        # but reads from a file object
+        zfile = self.zip
+        zinfo = zipfile.ZipInfo(arcname,
+                                time.localtime(filestat.st_mtime)[0:6])
+        zinfo.external_attr = (stat.S_IFREG | PAYLOAD_MODE) << 16L
+        zinfo.compress_type = self.compression
+        zinfo.file_size = filestat.st_size
+        zinfo.flag_bits = 0x00
+        zinfo.header_offset = zfile.fp.tell()
+        zfile._writecheck(zinfo)
+        zfile._didModify = True
+
+        # CRC and sizes in the header are updated once content is written
+        zinfo.CRC = crc = 0
+        zinfo.compress_size = compress_size = 0
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        zfile.fp.write(zinfo.FileHeader(zip64))
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                          zlib.DEFLATED, -15)
+        else:
+            compressor = None
+        file_size = 0
+        while True:
+            block = fileobj.read(fixity.BLOCK_SIZE)
+            if not block:
+                break
+            file_size += len(block)
+            crc = zlib.crc32(block, crc) & 0xffffffff
+            if compressor:
+                block = compressor.compress(block)
+                compress_size += len(block)
+            zfile.fp.write(block)
+        if compressor:
+            block = compressor.flush()
+            compress_size += len(block)
+            zfile.fp.write(block)
+            zinfo.compress_size = compress_size
+        else:
+            zinfo.compress_size = file_size
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        if not zip64 and max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+            raise RuntimeError('File size of %s changed while being archived'
+                               % arcname)
+
+        position = zfile.fp.tell()
+        zfile.fp.seek(zinfo.header_offset, 0)
+        zfile.fp.write(zinfo.FileHeader(zip64))
+        zfile.fp.seek(position, 0)
+        zfile.filelist.append(zinfo)
+        zfile.NameToInfo[zinfo.filename] = zinfo
+
+    def add_tag_file(self, path, arcname):
+        self.zip.write(path, arcname)
+
+    def close(self):
+        self.zip.close()
+
+
+def open_archive(path, serialization):
+    '''Open an archive writer for the requested serialization format,
+    one of :data:`FORMATS`.'''
+    if serialization == TAR:
+        return TarWriter(path)
+    if serialization == TAR_GZ:
+        return TarWriter(path, compress=True)
+    if serialization == ZIP:
+        return ZipWriter(path)
+    raise ValueError('Unknown serialization format %s' % serialization)
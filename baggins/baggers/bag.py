@@ -1,7 +1,122 @@
 import bagit
+from datetime import date
+import errno
+from multiprocessing.pool import ThreadPool
 import os
+import re
 import shutil
 from slugify import slugify
+import threading
+import uuid
+
+from baggins import __version__, archive, fixity, journal, metrics, staging
+
+
+#: bagit version and tag file encoding declared in bagit.txt
+BAGIT_VERSION = '0.97'
+BAGIT_ENCODING = 'UTF-8'
+
+#: bag software agent recorded in bag-info.txt
+BAG_SOFTWARE_AGENT = 'baggins v%s <https://github.com/emory-libraries/emory-baggins>' \
+    % __version__
+
+# bagit changes the working directory while saving a bag, so bags
+# being created in different threads must not be saved concurrently
+_save_lock = threading.Lock()
+
+
+def make_temp_bag_dir(bagdir):
+    '''Create a temporary directory where a bag is built before being
+    moved to `bagdir`.  The directory is a hidden sibling of the final
+    bag directory, so it is on the same filesystem and can be renamed
+    into place.  The name is unique to each attempt, since several bags
+    may be in progress in the same process (e.g., when bagging in a
+    pipeline).
+
+    :returns: path to the new directory
+    '''
+    basedir, name = os.path.split(bagdir)
+    # not created with tempfile.mkdtemp, since a bag directory is moved
+    # into place as is and should get the usual permissions, not 0700
+    tmp_bagdir = os.path.join(basedir,
+                              '.%s.%s.tmp' % (name, uuid.uuid4().hex))
+    os.mkdir(tmp_bagdir)
+    return tmp_bagdir
+
+
+def temp_bag_dirs(bagdir):
+    '''List any temporary directories (e.g., from an interrupted run) for
+    a bag that would be created at `bagdir`.'''
+    basedir, name = os.path.split(bagdir)
+    prefix = '.%s.' % name
+    try:
+        filenames = os.listdir(basedir or '.')
+    except OSError:
+        return []
+    # the unique part of the name is alphanumeric (a process id, for
+    # directories left by older versions)
+    return [os.path.join(basedir, filename) for filename in filenames
+            if filename.startswith(prefix) and filename.endswith('.tmp')
+            and filename[len(prefix):-len('.tmp')].isalnum()]
+
+
+def is_complete_bag(path):
+    '''Check whether a bag at its final location is complete.  Bags are
+    built in a temporary directory (see :func:`make_temp_bag_dir`) and only
+    moved into place once they are finished, so anything at the final
+    location is treated as complete, except for a bag directory with no
+    tag manifest (the last file written when a bag is saved), e.g. one
+    left by a version that built bags in place.'''
+    if not os.path.isdir(path):
+        return os.path.exists(path)
+    return any(filename.startswith('tagmanifest-')
+               for filename in os.listdir(path))
+
+
+def tag_file_totals(bagdir):
+    '''Number of files and total size of the tag files in a bag
+    directory, i.e. everything outside the payload directory.'''
+    files = size = 0
+    for root, dirs, filenames in os.walk(bagdir):
+        if root == bagdir and 'data' in dirs:
+            dirs.remove('data')
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+    return files, size
+
+
+def _utf8(value):
+    # tag files are written as utf-8 encoded bytes
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def write_tag_file(path, tags):
+    '''Write a bagit tag file (e.g. bagit.txt or bag-info.txt) from a
+    dictionary of tags and values; values can be single values or
+    lists for repeated tags.'''
+    with open(path, 'wb') as tagfile:
+        for tag in sorted(tags.keys()):
+            values = tags[tag]
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                # strip CR and LF so they don't break the tag file
+                value = re.sub(r'\r|\n', '', _utf8(value))
+                tagfile.write('%s: %s\n' % (_utf8(tag), value))
+
+
+def write_manifest(path, checksums):
+    '''Write a bagit manifest file from a dictionary of checksums
+    keyed on bag-relative file path.'''
+    with open(path, 'wb') as manifest:
+        for filename in sorted(checksums.keys()):
+            # encode line breaks in filenames as required by bagit
+            filename_enc = _utf8(filename).replace('\r', '%0D') \
+                                          .replace('\n', '%0A')
+            manifest.write('%s  %s\n' % (checksums[filename], filename_enc))
 
 
 class Baggee(object):
@@ -19,6 +134,50 @@ class Baggee(object):
     checksum_algorithms = ['md5', 'sha256']
     # NOTE: may eventually want to make these configurable
 
+    #: strategy for staging payload files in the bag, one of
+    #: :data:`baggins.staging.STRATEGIES`; falls back to the next
+    #: strategy when the requested one is not possible for a file
+    staging_strategy = staging.COPY
+
+    #: number of threads used to stage and checksum payload files
+    checksum_workers = 1
+
+    #: calculate each checksum algorithm in its own thread, so that
+    #: digests of the same content are calculated concurrently
+    parallel_digests = False
+
+    #: optional serialization format, one of :data:`baggins.archive.FORMATS`;
+    #: if set, the bag is created as a single archive file, and payload
+    #: files are streamed directly into the archive instead of being
+    #: staged in a bag directory
+    serialization = None
+
+    #: size and checksums for payload files added to the bag, keyed on
+    #: path relative to the bag directory; populated by
+    #: :meth:`add_data_files`
+    payload = None
+
+    #: optional function to be called with the status of bag creation
+    #: as it progresses (one of the states in :mod:`baggins.journal`)
+    status_callback = None
+
+    #: :class:`baggins.metrics.BagMetrics` with timing and throughput for
+    #: each stage of the most recent call to :meth:`create_bag`
+    metrics = None
+
+    def stage(self, name):
+        '''Context manager to record metrics for a stage of bag creation
+        in :attr:`metrics`; see :meth:`baggins.metrics.BagMetrics.stage`.'''
+        if self.metrics is None:
+            self.metrics = metrics.BagMetrics(self.bag_name())
+        return self.metrics.stage(name)
+
+    def set_status(self, status):
+        '''Report bag creation status via :attr:`status_callback`,
+        if one is set.'''
+        if self.status_callback is not None:
+            self.status_callback(status)
+
     def object_id(self):
         '''Object ID for this item. Use PID, ARK, or OCLC Number
         in that order of preference.
@@ -39,7 +198,7 @@ class Baggee(object):
 
     def bag_info(self):
         '''Optional metadata to be included in Bag info.  Should return
-        a dictionary to be passed to the bagit make_bag method.
+        a dictionary of tags to be included in bag-info.txt.
         '''
         return {}
 
@@ -123,18 +282,155 @@ class Baggee(object):
         objectid-objectname.'''
         return '%s-%s' % (self.object_id(), self.file_title())
 
+    def bag_path(self, basedir):
+        '''Full path to the bag that will be created in `basedir`; either
+        a bag directory or, if :attr:`serialization` is set, an
+        archive file.'''
+        path = os.path.join(basedir, self.bag_name())
+        if self.serialization:
+            path += archive.EXTENSIONS[self.serialization]
+        return path
+
+    def _map(self, func, items):
+        # apply a function to a list of items, using a pool of
+        # threads if more than one checksum worker is configured
+        if self.checksum_workers > 1 and len(items) > 1:
+            pool = ThreadPool(min(self.checksum_workers, len(items)))
+            try:
+                return pool.map(func, items)
+            finally:
+                pool.close()
+                pool.join()
+        return map(func, items)
+
     def add_data_files(self, bagdir):
-        '''Copy data files into the bag staging directory.'''
-        for datafile in self.data_files():
-            # use copy2 to preserve original file statistics
-            shutil.copy2(datafile, bagdir)
-            datafile_base = os.path.basename(datafile)
-            # make sure file is writable so bagit can move it,
-            # otherwise bagit will error
-            # NOTE: for now, assuming user creating the bag has at least
-            # group permissions on the content being bagged; might
-            # need revision at a later point.
-            os.chmod(os.path.join(bagdir, datafile_base), 0664)
+        '''Stage data files in the bag payload directory using
+        :attr:`staging_strategy`, and calculate checksums for all
+        :attr:`checksum_algorithms`.  Files are staged and checksummed
+        using :attr:`checksum_workers` threads.  Sizes and checksums are
+        stored in :attr:`payload`.'''
+        data_dir = self.stage_payload(bagdir)
+        self.checksum_payload(bagdir)
+        return data_dir
+
+    def stage_payload(self, bagdir):
+        '''Stage data files in the bag payload directory, without
+        checksumming files that are linked or copied by the kernel;
+        use :meth:`checksum_payload` to complete the checksums.'''
+        self.set_status(journal.STAGING)
+        data_dir = os.path.join(bagdir, 'data')
+        if not os.path.isdir(data_dir):
+            os.mkdir(data_dir)
+
+        with self.stage('stage_payload') as stage:
+            self.payload = dict(self._map(
+                lambda datafile: self.stage_data_file(datafile, data_dir),
+                self.data_files()))
+            # linked files are not read or written
+            copied = sum(info['size'] for info in self.payload.values()
+                         if info['strategy'] in (staging.KERNEL, staging.COPY))
+            stage.files = len(self.payload)
+            stage.bytes_read = stage.bytes_written = copied
+        return data_dir
+
+    def stage_data_file(self, datafile, data_dir):
+        '''Stage a single data file in the payload directory.  When the
+        file is copied, checksums are calculated as it is copied.
+
+        :returns: tuple of bag-relative path and a dictionary with size,
+            checksums (None if not yet calculated), and the staging
+            strategy used
+        '''
+        datafile_base = os.path.basename(datafile)
+        payload_file = os.path.join(data_dir, datafile_base)
+        # stage the file (preserving original file statistics); if
+        # copied, it is checksummed in the same pass
+        strategy, size, checksums = staging.stage_file(
+            datafile, payload_file, self.staging_strategy,
+            self.checksum_algorithms, self.parallel_digests)
+        # make sure file is writable by the group, so the bag
+        # can be updated later if necessary; hard links share
+        # permissions with the source, so leave those alone
+        # NOTE: for now, assuming user creating the bag has at least
+        # group permissions on the content being bagged; might
+        # need revision at a later point.
+        if strategy != staging.HARDLINK:
+            os.chmod(payload_file, 0664)
+        return 'data/%s' % datafile_base, \
+            {'size': size, 'checksums': checksums, 'strategy': strategy}
+
+    def add_serialized_data_files(self, writer, name):
+        '''Stream data files into a serialized bag, calculating checksums
+        for all :attr:`checksum_algorithms` as the content is written.
+        Sizes and checksums are stored in :attr:`payload`.
+
+        :param writer: :class:`baggins.archive.ArchiveWriter`
+        :param name: bag name, used as the top-level directory in
+            the archive
+        '''
+        self.set_status(journal.STAGING)
+        self.payload = {}
+        with self.stage('stream_payload') as stage:
+            for datafile in self.data_files():
+                path = 'data/%s' % os.path.basename(datafile)
+                size, checksums = writer.add_file(
+                    datafile, '%s/%s' % (name, path), self.checksum_algorithms,
+                    self.parallel_digests)
+                self.payload[path] = {'size': size, 'checksums': checksums}
+                stage.files += 1
+                stage.bytes_read += size
+                stage.bytes_written += size
+
+    def checksum_payload(self, bagdir):
+        '''Calculate checksums for any staged payload files that were
+        not checksummed while they were staged (i.e., linked or copied
+        by the kernel), using :attr:`checksum_workers` threads.'''
+        self.set_status(journal.HASHING)
+        unchecked = [path for path, info in self.payload.items()
+                     if info['checksums'] is None]
+
+        def checksum(path):
+            return fixity.hash_file(os.path.join(bagdir, path),
+                                    self.checksum_algorithms,
+                                    self.parallel_digests)
+
+        with self.stage('checksum_payload') as stage:
+            for path, (size, checksums) in zip(unchecked,
+                                               self._map(checksum, unchecked)):
+                self.payload[path].update({'size': size,
+                                           'checksums': checksums})
+                stage.files += 1
+                stage.bytes_read += size
+
+    def make_bag(self, bagdir):
+        '''Turn the bag directory into a bagit bag, writing bagit.txt,
+        bag-info.txt, and payload manifests.  Manifests are generated
+        from the checksums calculated by :meth:`add_data_files`, so
+        payload content is not read again.
+
+        :returns: :class:`bagit.Bag`
+        '''
+        write_tag_file(os.path.join(bagdir, 'bagit.txt'), {
+            'BagIt-Version': BAGIT_VERSION,
+            'Tag-File-Character-Encoding': BAGIT_ENCODING
+        })
+
+        payload = self.payload or {}
+        bag_info = dict(self.bag_info())
+        # allow bagging date and software agent to be overridden
+        bag_info.setdefault('Bagging-Date', date.strftime(date.today(), '%Y-%m-%d'))
+        bag_info.setdefault('Bag-Software-Agent', BAG_SOFTWARE_AGENT)
+        bag_info['Payload-Oxum'] = '%d.%d' % \
+            (sum(info['size'] for info in payload.values()), len(payload))
+        write_tag_file(os.path.join(bagdir, 'bag-info.txt'), bag_info)
+
+        for alg in self.checksum_algorithms:
+            write_manifest(
+                os.path.join(bagdir, 'manifest-%s.txt' % alg),
+                dict((path, info['checksums'][alg])
+                     for path, info in payload.items()))
+
+        return bagit.Bag(bagdir)
 
     def add_descriptive_metadata(self, bagdir):
         metadata_dir = os.path.join(bagdir, 'metadata', 'descriptive')
@@ -220,13 +516,139 @@ class Baggee(object):
         # return dir in case extending class wants to use it
         return rel_dir
 
+    def add_metadata(self, method, bagdir):
+        '''Add metadata to the bag with one of the `add_*_metadata`
+        methods, specified by name, recording the time taken and the
+        metadata files written in :attr:`metrics`.'''
+        metadata_dir = os.path.join(bagdir, 'metadata')
+        files, size = metrics.directory_totals(metadata_dir)
+        with self.stage(method) as stage:
+            getattr(self, method)(bagdir)
+            new_files, new_size = metrics.directory_totals(metadata_dir)
+            stage.files = new_files - files
+            stage.bytes_written = new_size - size
+
     def create_bag(self, basedir):
-        '''Create a bagit bag for this item.'''
-        bagdir = os.path.join(basedir, self.bag_name())
-        os.mkdir(bagdir)
+        '''Create a bagit bag for this item.  The bag is built in a
+        temporary directory alongside the final bag directory and moved
+        into place once it is complete, so a partially created bag is
+        never visible at the final location.
+
+        :returns: :class:`bagit.Bag`, or the path to the archive file
+            if :attr:`serialization` is set
+        '''
+        if self.serialization:
+            self.metrics = metrics.BagMetrics(self.bag_name())
+            return self.create_serialized_bag(basedir)
+
+        bagdir, tmp_bagdir = self.start_bag(basedir)
+        try:
+            self.add_data_files(tmp_bagdir)
+        except BaseException:
+            self.abort_bag(tmp_bagdir)
+            raise
+        return self.finish_bag(tmp_bagdir, bagdir)
+
+    def start_bag(self, basedir):
+        '''Start creating a bag directory in `basedir`, by creating the
+        temporary directory where the bag will be built.  Used by
+        :meth:`create_bag`; the steps of creating a bag can also be run
+        separately (e.g., in different stages of a pipeline): stage the
+        payload with :meth:`stage_payload` and :meth:`checksum_payload`,
+        then call :meth:`finish_bag`, or :meth:`abort_bag` on error.
+
+        :returns: tuple of final bag directory and temporary directory
+        '''
+        self.metrics = metrics.BagMetrics(self.bag_name())
+        bagdir = self.bag_path(basedir)
+        if os.path.exists(bagdir):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), bagdir)
+
+        tmp_bagdir = make_temp_bag_dir(bagdir)
+        return bagdir, tmp_bagdir
 
-        # add payload  data to the bag
-        self.add_data_files(bagdir)
+    def finish_bag(self, tmp_bagdir, bagdir):
+        '''Add metadata and tag files to a bag whose payload has been
+        staged and checksummed in a temporary directory, and move it
+        into place at `bagdir`.  The temporary directory is removed
+        on error.
+
+        :returns: :class:`bagit.Bag`
+        '''
+        try:
+            bag = self.add_tag_files(tmp_bagdir)
+            # make sure nothing has been created at the final location
+            # since we started, since rename will replace an empty directory
+            if os.path.exists(bagdir):
+                raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), bagdir)
+            os.rename(tmp_bagdir, bagdir)
+        except BaseException:
+            shutil.rmtree(tmp_bagdir, ignore_errors=True)
+            raise
+        finally:
+            self.metrics.finish()
+
+        # bagit keeps bag paths absolute; the bag was saved in the
+        # temporary directory, so update the path to the final location
+        bag.path = os.path.abspath(bagdir)
+        return bag
+
+    def abort_bag(self, tmp_bagdir):
+        '''Remove the temporary directory for a bag that could not
+        be created.'''
+        shutil.rmtree(tmp_bagdir, ignore_errors=True)
+        if self.metrics is not None:
+            self.metrics.finish()
+
+    def create_serialized_bag(self, basedir):
+        '''Create a serialized bag for this item, as an archive file in
+        the format specified by :attr:`serialization`.  Payload files
+        are streamed into the archive and checksummed in the same pass;
+        only tag files and metadata are written to a temporary directory
+        before being added to the archive.  The archive is written in
+        a temporary directory alongside the final location and moved
+        into place once it is complete.
+
+        :returns: path to the archive file
+        '''
+        name = self.bag_name()
+        bagfile = self.bag_path(basedir)
+        if os.path.exists(bagfile):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), bagfile)
+
+        tmpdir = make_temp_bag_dir(bagfile)
+        try:
+            tmp_bagfile = os.path.join(tmpdir, os.path.basename(bagfile))
+            tag_dir = os.path.join(tmpdir, name)
+            os.mkdir(tag_dir)
+            writer = archive.open_archive(tmp_bagfile, self.serialization)
+            try:
+                self.add_serialized_data_files(writer, name)
+                self.add_tag_files(tag_dir)
+                with self.stage('archive_tag_files') as stage:
+                    writer.add_tree(tag_dir, name)
+                    stage.files, stage.bytes_read = \
+                        metrics.directory_totals(tag_dir)
+            finally:
+                writer.close()
+            with self.stage('finalize') as stage:
+                stage.files = 1
+                stage.bytes_written = os.path.getsize(tmp_bagfile)
+                if os.path.exists(bagfile):
+                    raise OSError(errno.EEXIST, os.strerror(errno.EEXIST),
+                                  bagfile)
+                os.rename(tmp_bagfile, bagfile)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            self.metrics.finish()
+
+        return bagfile
+
+    def add_tag_files(self, bagdir):
+        '''Add metadata to a bag directory and generate bag manifests and
+        tag files, based on the payload information in :attr:`payload`.
+        Payload content is not read, so this can also be used to generate
+        tag files for a serialized bag.'''
 
         # ** add metadata **
 
@@ -243,33 +665,44 @@ class Baggee(object):
 
         
 
-        # create the bag, passing in any bag metadata and configured
-        # checksum algorithms
-        bag = bagit.make_bag(bagdir, self.bag_info(),
-                             checksum=self.checksum_algorithms)
+        # create the bag, including any bag metadata and manifests for
+        # the configured checksum algorithms
+        with self.stage('make_bag') as stage:
+            bag = self.make_bag(bagdir)
+            stage.files, stage.bytes_written = tag_file_totals(bagdir)
 
         # descriptive metadata
-        self.add_descriptive_metadata(bagdir)
+        self.add_metadata('add_descriptive_metadata', bagdir)
 
         # content metadata
-        self.add_content_metadata(bagdir)
+        self.add_metadata('add_content_metadata', bagdir)
 
         # relationship metadata
-        self.add_relationship_metadata(bagdir)
+        self.add_metadata('add_relationship_metadata', bagdir)
 
         # technical metadata
-        self.add_technical_metadata(bagdir)
+        self.add_metadata('add_technical_metadata', bagdir)
 
          # rights metadata
-        self.add_rights_metadata(bagdir)
+        self.add_metadata('add_rights_metadata', bagdir)
 
         # identifiers metadata
-        self.add_identity_metadata(bagdir)
+        self.add_metadata('add_identity_metadata', bagdir)
 
         # audit metadata
-        self.add_audit_metadata(bagdir)
-
-        bag.save()
+        self.add_metadata('add_audit_metadata', bagdir)
+
+        # save updates bag-info and generates tag manifests, which
+        # reads all of the tag files
+        with self.stage('save') as stage:
+            stage.files, stage.bytes_read = tag_file_totals(bagdir)
+            with _save_lock:
+                bag.save()
+            tagmanifests = [os.path.join(bagdir, 'tagmanifest-%s.txt' % alg)
+                            for alg in bag.algorithms]
+            stage.bytes_written = sum(os.path.getsize(path)
+                                      for path in tagmanifests
+                                      if os.path.exists(path))
 
         # NOTE: to add metadata as tag files (once there is a version of
         # python-bagit that supports it), add the tagfile content to the
@@ -6,32 +6,84 @@ Bagging logic for LSDI digitized book content.
 import argparse
 from optparse import OptionParser
 from ConfigParser import ConfigParser, NoOptionError, NoSectionError
-import glob
+from collections import OrderedDict
+from functools import partial
+from io import BytesIO
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import requests
+import shutil
 import yaml
 import sys
-import re
+from StringIO import StringIO
+import traceback
 
-from lxml import etree
+from eulxml.xmlmap import load_xmlobject_from_string
 from eulfedora.server import Repository
 from baggins.lsdi.collections import CollectionSources
-from baggins.lsdi.digwf import Client
-from baggins.lsdi.fedora import Volume
+from baggins.lsdi.digwf import Client, Item
+from baggins.lsdi import fedora
+from baggins.lsdi.fedora import Volume, Collection, FedoraMonitor
 from baggins.baggers import bag
-from baggins.lsdi.mets import Mets, METSFile, METSMap
+from baggins import archive, cache, characterize, journal, metrics, \
+    pipeline, staging
+from baggins.lsdi import mets
 
 sys.tracebacklimit = 0
 
 
+def fedora_object_info(obj):
+    '''Pid, label, and ARK (if available) for a Fedora object, as a
+    dictionary for inclusion in relationship metadata.  Returns None
+    if the object does not exist (or could not be retrieved, since
+    eulfedora reports any failed request as a nonexistent object).'''
+    if not obj.exists:
+        return None
+    # NOTE: using str to avoid unicode weirdness in yaml output
+    info = {'pid': str(obj.pid), 'name': str(obj.label)}
+    # include ark if available
+    if obj.ark_uri:
+        info.update({'ark_uri': obj.ark_uri, 'ark': obj.ark})
+    return info
+
+
 class LsdiBaggee(bag.Baggee):
     '''Bag object extending base baggee class, for creating lsdi
     bags according to emory bagit specification.
     '''
 
+    #: page image file extensions, in order of preference
+    image_extensions = ['.tif', '.TIF', '.jp2', '.jpg']
+
+    #: process-wide cache of Fedora book and collection information,
+    #: shared by all volumes bagged in the same process; see
+    #: :meth:`LsdiBagger.init_caches`
+    fedora_cache = cache.Cache(ttl=24 * 60 * 60)
+
+    #: relationship metadata retrieved in advance by
+    #: :meth:`prefetch_metadata`, if any
+    relationship_info = None
+
+    #: number of threads used to characterize page images for
+    #: technical metadata
+    characterization_workers = 4
+
     def __init__(self, item, repo=None):
         self.item = item
         self.repo = repo
+        self._directory_files = {}
+
+    def prefetch_metadata(self):
+        '''Retrieve everything needed to bag this item that requires
+        network access (MARC record, directory listings, and Fedora
+        relationship information), so that it can be done separately
+        from staging and checksumming the payload.'''
+        self.item.marc
+        self.data_files()
+        if self.relationship_info is None:
+            self.relationship_info = self.relationship_metadata_info()
 
     def object_id(self):
         '''Object id for bag name; use pid/ark if available; otherwise, use
@@ -92,6 +144,37 @@ class LsdiBaggee(bag.Baggee):
         return [self.item.pdf, self.item.ocr_file] + self.image_files() \
             + self.page_text_files()
 
+    def directory_files(self, path):
+        '''Files in a directory, grouped by file extension.  Each
+        directory is only listed once for an item and the result is
+        reused, since listing directories with thousands of files on
+        network storage is slow; use :meth:`clear_file_cache` if
+        directory contents change.
+
+        :returns: dictionary of lists of full file paths, keyed on
+            file extension
+        '''
+        if path not in self._directory_files:
+            files = {}
+            try:
+                filenames = os.listdir(path)
+            except OSError:
+                # treat a missing or unreadable directory as empty
+                filenames = []
+            for filename in filenames:
+                # skip hidden files, as glob does
+                if filename.startswith('.'):
+                    continue
+                extension = os.path.splitext(filename)[1]
+                files.setdefault(extension, []).append(
+                    os.path.join(path, filename))
+            self._directory_files[path] = files
+        return self._directory_files[path]
+
+    def clear_file_cache(self):
+        '''Clear cached directory listings used to find data files.'''
+        self._directory_files = {}
+
     def image_files(self):
         '''Find image files based on display image path returned from the
         DigWF API.  Looks for TIFFs, then JP2s, thn JPG files.  Raises an error
@@ -99,17 +182,14 @@ class LsdiBaggee(bag.Baggee):
         item information returned by the DigWF APi.
         '''
         image_path = self.item.display_image_path
-        # first, look for TIFFs
-        images = glob.glob('%s/*.tif' % image_path)
-        # tif variant - in some cases, extension is upper case
-        if not len(images):
-            images = glob.glob('%s/*.TIF' % image_path)
-        # if no TIFFs were found, look for JP2s
-        if not len(images):
-            images = glob.glob(os.path.join(image_path, '*.jp2'))
-        # if neither jp2s nor tiffs were found, look for jpgs
-        if not len(images):
-            images = glob.glob('%s/*.jpg' % image_path)
+        image_files = self.directory_files(image_path)
+        # look for TIFFs (in some cases, extension is upper case), then
+        # JP2s, then jpgs
+        images = []
+        for extension in self.image_extensions:
+            images = image_files.get(extension, [])
+            if len(images):
+                break
 
         # if images were not found, error
         if not len(images):
@@ -120,7 +200,7 @@ class LsdiBaggee(bag.Baggee):
             raise Exception('Found %d images for %s instead of expected %d' %
                             (len(images), self.item.item_id,
                             self.item.display_image_count))
-        return images
+        return list(images)
 
     def page_text_files(self):
         '''Find text and position files based on ocr file path returned from the
@@ -128,11 +208,11 @@ class LsdiBaggee(bag.Baggee):
         of position files found doesn't match the expected count in the
         item information returned by the DigWF APi.
         '''
-        ocr_path = self.item.ocr_file_path
+        ocr_files = self.directory_files(self.item.ocr_file_path)
         # plain text files generated from ocr
-        text_files = glob.glob('%s/*.txt' % ocr_path)
+        text_files = ocr_files.get('.txt', [])
         # position files generated from ocr process
-        pos_files = glob.glob('%s/*.pos' % ocr_path)
+        pos_files = ocr_files.get('.pos', [])
         if len(text_files) != self.item.ocr_file_count:
             raise Exception('Found %d text files for %s instead of expected %d',
                             len(text_files), self.item.item_id,
@@ -157,84 +237,144 @@ class LsdiBaggee(bag.Baggee):
                 print "volume %s doesn't exist or Fedora connection failed" % vol.pid
 
             if vol.exists:
-                # parent book info
-                if vol.book.exists:
-                    # NOTE: using str to avoid unicode weirdness in yaml output
-                    book_info = {'pid': str(vol.book.pid),
-                                 'name': str(vol.book.label)}
-                    # include ark if available
-                    if vol.book.ark_uri:
-                        book_info.update({
-                            'ark_uri': vol.book.ark_uri,
-                            'ark': vol.book.ark
-                        })
+                # book and collection are shared by many volumes, so
+                # use cached information when available; objects not
+                # found are not cached, since that may be the result of
+                # a transient Fedora error
+                book_info, coll_pid = self.fedora_cache.get_or_set(
+                    'book:%s' % vol.book.pid,
+                    lambda: self.fedora_book_info(vol.book),
+                    cache_if=lambda info: info[0] is not None)
+                if book_info:
                     rel_info['Fedora Book'] = book_info
-                # collection
-                if vol.book.collection.exists:
-                    coll_info = {'pid': str(vol.book.collection.pid),
-                                 'name': str(vol.book.collection.label)}
-                    # include ark if available (but probably not available)
-                    if vol.book.collection.ark_uri:
-                        coll_info.update({
-                            'ark_uri': vol.book.collection.ark_uri,
-                            'ark': vol.book.collection.ark
-                        })
-                    rel_info['Fedora Collection'] = coll_info
+                if coll_pid:
+                    coll_info = self.fedora_cache.get_or_set(
+                        'collection:%s' % coll_pid,
+                        lambda: fedora_object_info(
+                            self.repo.get_object(coll_pid, type=Collection)),
+                        cache_if=lambda info: info is not None)
+                    if coll_info:
+                        rel_info['Fedora Collection'] = coll_info
 
         return rel_info
 
-    def mets_metadata_info(self):
-        #list all files in the bag in mets format and for struct map for it
-        mets = Mets()
-        mets.create_dmd()
+    def fedora_book_info(self, book):
+        '''Information about a Fedora book and the pid of its collection,
+        for inclusion in relationship metadata.  Collection information
+        is added to :attr:`fedora_cache` if not already cached.'''
+        book_info = fedora_object_info(book)
+        if book_info is None:
+            # collection can't be determined without the book
+            return None, None
+        coll_pid = None
+        if book.collection is not None:
+            coll_pid = str(book.collection.pid)
+            self.fedora_cache.get_or_set(
+                'collection:%s' % coll_pid,
+                lambda: fedora_object_info(book.collection),
+                cache_if=lambda info: info is not None)
+        return book_info, coll_pid
+
+    #: METS file groups for page images, which get technical metadata
+    mets_image_groups = ('TIFF', 'JPEG', 'JP2000')
+
+    def mets_file_info(self):
+        '''Files and page structure for the METS content metadata,
+        determined in a single pass over the sorted data files.  Sizes
+        and checksums are taken from :attr:`payload` when the payload
+        has already been staged, so files are not read again.
+
+        :returns: tuple of METS file groups, as a list of tuples of group
+            id and a list of :class:`~baggins.lsdi.mets.FileInfo`; a list
+            of file ids for each complete page (image, position, and text
+            files), in page order; and a list of page image files that
+            should have technical metadata
+        '''
+        payload = self.payload or {}
         data_files = sorted(self.data_files())
         tif_idx = 0
         pos_idx = 0
         txt_idx = 0
-        all_idx = 0
-        for idx, file in enumerate(data_files):
-            file_name = os.path.split(file)
-            filename, file_extension = os.path.splitext(file_name[1])
+        # files for each group, with groups in the order first found
+        file_groups = OrderedDict()
+        # file ids for each numbered page, keyed on page file name without
+        # extension; built in a single pass over the data files so the
+        # struct map can be generated without searching the file list
+        pages = {}
+        techmd = []
+        for file in data_files:
+            file_name = os.path.split(file)[1]
+            filename, file_extension = os.path.splitext(file_name)
             split_str = filename.split("_")
-            split_char = re.split('(\d+)',split_str[-1])
+            page_file = None
+            mets_file = None
             if file_extension == ".TIF" or file_extension == ".tif":
                 tif_idx += 1
-                tif_file = METSFile(id="TIF%s" % str(tif_idx).zfill(4), mimetype="image/tiff", loctype="URL", href=file_name[1])
-                mets.tiffs.append(tif_file)
+                mets_file = ('TIFF', "TIF%s" % str(tif_idx).zfill(4), "image/tiff")
+                page_file = 'image'
             if file_extension == ".jpg":
-                jpg_file = METSFile(id="JPG%s" % split_str[-1], mimetype="image/jpg", loctype="URL", href=file_name[1])
-                mets.jpgs.append(jpg_file)
+                mets_file = ('JPEG', "JPG%s" % split_str[-1], "image/jpg")
+                page_file = 'image'
             if file_extension == ".jp2s":
-                jp2_file = METSFile(id="JP2%s" % split_str[-1], mimetype="image/jp2", loctype="URL", href=file_name[1])
-                mets.jp2s.append(jp2_file)
+                mets_file = ('JP2000', "JP2%s" % split_str[-1], "image/jp2")
+                page_file = 'image'
             if file_extension == ".txt":
                 txt_idx += 1
-                txt_file = METSFile(id="TXT%s" % str(txt_idx).zfill(4), mimetype="plain/text", loctype="URL", href=file_name[1])
-                mets.txts.append(txt_file)
+                mets_file = ('TXT', "TXT%s" % str(txt_idx).zfill(4), "plain/text")
+                page_file = 'txt'
             if file_extension == ".pdf":
-                pdf_file = METSFile(id="PDF%s" % split_str[-1], mimetype="application/pdf", loctype="URL", href=file_name[1])
-                mets.pdfs.append(pdf_file)
+                mets_file = ('PDF', "PDF%s" % split_str[-1], "application/pdf")
             if file_extension == ".pos":
-                pos_idx +=1
-                pos_file = METSFile(id="POS%s" % str(pos_idx).zfill(4), mimetype="text/plain", loctype="URL", href=file_name[1])
-                mets.pos.append(pos_file)
+                pos_idx += 1
+                mets_file = ('ALTO', "POS%s" % str(pos_idx).zfill(4), "text/plain")
+                page_file = 'pos'
             if file_extension == ".xml":
-                afr_file = METSFile(id="AFR%s" % split_str[-1], mimetype="text/xml", loctype="URL", href=file_name[1])
-                mets.afrs.append(afr_file)
-            
-            if split_str[-1].isdigit():
-                matching = [s for s in data_files if filename in s]
-                if len(matching) == 3 and file_extension != '.pos' and file_extension != '.txt':
-                    all_idx += 1
-                    pid_struct = METSMap(order=all_idx, page_type='page', tif="TIF"+str(all_idx).zfill(4), pos="POS"+str(all_idx).zfill(4))
-                    pid_struct.txt = "TXT"+str(all_idx).zfill(4)
-                    mets.structmap.append(pid_struct)
-                else:
-                    print 'Error! Some files are missing in the volume %s' % matching
+                mets_file = ('AFR', "AFR%s" % split_str[-1], "text/xml")
+
+            if mets_file is None:
+                continue
+            group_id, file_id, mimetype = mets_file
+            info = mets.FileInfo(file_id, mimetype, file_name)
+            payload_info = payload.get('data/%s' % file_name)
+            if payload_info is not None:
+                info.size = payload_info['size']
+                checksum = mets.preferred_checksum(
+                    payload_info['checksums'] or {})
+                if checksum is not None:
+                    info.checksum_type, info.checksum = checksum
+                if group_id in self.mets_image_groups:
+                    info.admid = 'AMD_TECHMD_%s' % file_id
+                    techmd.append(info)
+            file_groups.setdefault(group_id, []).append(info)
+            if split_str[-1].isdigit() and page_file is not None:
+                pages.setdefault(filename, {})[page_file] = file_id
+
+        # struct map: one entry per page with image, position, and text files
+        page_files = []
+        for page in sorted(pages):
+            files = pages[page]
+            if 'image' in files and 'pos' in files and 'txt' in files:
+                page_files.append([files['image'], files['pos'], files['txt']])
+            else:
+                print 'Error! Some files are missing in the volume for page %s (found %s)' % \
+                    (page, ', '.join(sorted(files.values())))
+
+        return file_groups.items(), page_files, techmd
 
-        root = etree.fromstring(mets.serialize(pretty=True))
-        root.attrib['{http://www.w3.org/2001/XMLSchema-instance}schemaLocation']= "http://www.loc.gov/METS/ http://www.loc.gov/standards/mets/mets.xsd"
-        return etree.tostring(root, pretty_print=True)
+    def write_mets_metadata(self, output):
+        '''Write METS content metadata listing all data files in the bag,
+        with a struct map for the pages, directly to a file name or
+        file object.  Once the payload has been staged, this includes
+        file sizes and checksums, and technical metadata for page
+        images.'''
+        mets.write_mets(output, *self.mets_file_info())
+
+    def mets_metadata_info(self):
+        '''METS content metadata, as a string; see
+        :meth:`write_mets_metadata`.'''
+        output = BytesIO()
+        self.write_mets_metadata(output)
+        return output.getvalue()
 
     def add_relationship_metadata(self, bagdir):
         # override default implementation, since we don't just want to
@@ -242,7 +382,8 @@ class LsdiBaggee(bag.Baggee):
         rel_dir = super(LsdiBaggee, self).add_relationship_metadata(bagdir)
         rel_file = os.path.join(rel_dir, 'machine-relationship.txt')
         with open(rel_file, 'w') as outfile:
-            yaml.dump(self.relationship_metadata_info(), outfile,
+            yaml.dump(self.relationship_info or
+                      self.relationship_metadata_info(), outfile,
                       default_flow_style=False)
         rel_file2 = os.path.join(rel_dir, 'human-relationship.txt')
         with open(rel_file2, 'w') as f1:
@@ -282,9 +423,8 @@ class LsdiBaggee(bag.Baggee):
         # copy existig content in, but need to output content
         rel_dir = super(LsdiBaggee, self).add_content_metadata(bagdir)
         rel_file = os.path.join(rel_dir, '%s.mets.xml' % self.item.pid)
-        print self.mets_metadata_info()
-        with open(rel_file, 'w') as outfile:
-            outfile.write(self.mets_metadata_info())
+        with open(rel_file, 'wb') as outfile:
+            self.write_mets_metadata(outfile)
         rel_file2 = os.path.join(rel_dir, 'human-content.txt')
         with open(rel_file2, 'w') as f1:
             f1.write("This folder contains relevant information describing the content model "
@@ -295,6 +435,7 @@ class LsdiBaggee(bag.Baggee):
         # override default implementation, since we don't just want to
         # copy existig content in, but need to output content
         rel_dir = super(LsdiBaggee, self).add_technical_metadata(bagdir)
+        self.add_image_characterization(rel_dir)
         rel_file = os.path.join(rel_dir, 'human-technical.txt')
         with open(rel_file, 'w') as f1:
             f1.write("This directory should contain technical metadata"
@@ -302,9 +443,27 @@ class LsdiBaggee(bag.Baggee):
                      "such as FITS, MediaInfo, MIX, etc).\n\n" 
                      "POS files in the bag are ascii text and contain Windows-style"
                      " (CR/LF) line feeds that may need to be converted prior to any digital repository"
-                     " ingest.\n\nWe identified no other viable technical metadata"
-                     " for the existing source data files and will not attempt to generate"
-                     " new characterization data during the initial LSDI Bags generation.")
+                     " ingest.\n\nThe mix directory contains a NISO MIX record for each"
+                     " page image, with dimensions, bit depth, compression, and color space"
+                     " read from the image file headers during LSDI Bags generation.")
+
+    def add_image_characterization(self, techmetadata_dir):
+        '''Characterize page images from their file headers (see
+        :mod:`baggins.characterize`), using :attr:`characterization_workers`
+        threads, and write a MIX record for each image to a ``mix``
+        directory.  Images that can't be characterized are logged and
+        skipped.'''
+        mix_dir = os.path.join(techmetadata_dir, 'mix')
+        os.makedirs(mix_dir)
+        results = characterize.characterize_files(
+            self.image_files(), self.characterization_workers)
+        for path, info in results:
+            if info is None:
+                continue
+            filename = os.path.basename(path)
+            characterize.write_mix(
+                os.path.join(mix_dir, '%s.mix.xml' % filename), info, filename)
+        return mix_dir
 
     def add_audit_metadata(self, bagdir):
         # override default implementation, since we don't just want to
@@ -362,6 +521,25 @@ class LsdiBagger(object):
     #: parsed argument and configuration options
     options = argparse.Namespace()   # start with an empty args namespace
 
+    #: :class:`~baggins.lsdi.fedora.FedoraMonitor` for the configured
+    #: repository; initialized when items are processed
+    fedora_monitor = None
+
+    #: default number of seconds to use cached DigWF API responses,
+    #: when a DigWF cache file is configured
+    digwf_cache_ttl = 24 * 60 * 60
+
+    #: default job journal file name, in the output directory
+    journal_file = '.lsdi-bagger-journal.db'
+
+    #: :class:`~baggins.journal.Journal` recording the state of each
+    #: item; initialized when items are processed
+    job_journal = None
+
+    #: list of metrics for each bag created in this run (see
+    #: :meth:`baggins.metrics.BagMetrics.as_dict`), with item id and status
+    run_metrics = None
+
     def get_options(self):
         parser = argparse.ArgumentParser(
             description='Generate bagit bags from LSDI digitized book content')
@@ -378,6 +556,89 @@ class LsdiBagger(object):
         parser.add_argument('-o', '--output', metavar='OUTPUT_DIR',
                             help='Directory for generated bag content')
 
+        parser.add_argument('--journal', metavar='FILE',
+                            help='''Job journal recording the state of each
+                            item (default: %s in the output directory)''' %
+                            self.journal_file)
+
+        parser.add_argument('--resume', action='store_true',
+                            help='''Resume a previous run using the job
+                            journal: skip items that were already bagged,
+                            remove incomplete bags, and retry items that
+                            failed or were interrupted''')
+
+        parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                            help='Number of items to bag in parallel (default: %(default)s)')
+
+        parser.add_argument('--staging', choices=staging.STRATEGIES,
+                            default=staging.COPY,
+                            help='''How payload files are staged in the bag;
+                            falls back to the next option in the list when
+                            not possible (default: %(default)s)''')
+
+        parser.add_argument('--checksum-threads', metavar='N', type=int,
+                            default=1, dest='checksum_threads',
+                            help='''Number of threads used to stage and
+                            checksum payload files for each bag
+                            (default: %(default)s)''')
+
+        parser.add_argument('--parallel-digests', action='store_true',
+                            dest='parallel_digests',
+                            help='''Calculate each checksum algorithm in a
+                            separate thread''')
+
+        parser.add_argument('--characterization-threads', metavar='N',
+                            type=int, default=4,
+                            dest='characterization_threads',
+                            help='''Number of threads used to read page image
+                            headers for technical metadata
+                            (default: %(default)s)''')
+
+        parser.add_argument('--serialize', choices=archive.FORMATS,
+                            help='''Create each bag as a single archive file
+                            in the requested format, streaming payload
+                            files directly into the archive''')
+
+        parser.add_argument('--metrics', metavar='FILE',
+                            help='''Write timing and throughput for each stage
+                            of bag creation to FILE, as JSON or (with a .prom
+                            extension) in Prometheus textfile format;
+                            stage timings are logged with --verbose''')
+
+        pipeline_args = parser.add_argument_group(
+            'Pipeline options',
+            '''Bag items in a staged pipeline within a single process
+            (instead of --jobs), so that metadata for the next items is
+            fetched and their payload staged while earlier items are
+            being checksummed''')
+        pipeline_args.add_argument(
+            '--pipeline', action='store_true',
+            help='Process items in a staged pipeline')
+        pipeline_args.add_argument(
+            '--fetch-workers', metavar='N', type=int, default=4,
+            dest='fetch_workers',
+            help='''Threads retrieving item metadata from the DigWF and
+            Fedora (default: %(default)s)''')
+        pipeline_args.add_argument(
+            '--stage-workers', metavar='N', type=int, default=2,
+            dest='stage_workers',
+            help='''Threads staging payload files (default:
+            %(default)s)''')
+        pipeline_args.add_argument(
+            '--hash-workers', metavar='N', type=int, default=2,
+            dest='hash_workers',
+            help='''Threads checksumming staged payload (default:
+            %(default)s)''')
+        pipeline_args.add_argument(
+            '--finalize-workers', metavar='N', type=int, default=1,
+            dest='finalize_workers',
+            help='''Threads writing metadata and tag files and moving
+            completed bags into place (default: %(default)s)''')
+        pipeline_args.add_argument(
+            '--queue-size', metavar='N', type=int, dest='queue_size',
+            help='''Maximum number of items waiting between stages
+            (default: number of workers in the next stage)''')
+
         # config file options
         cfg_args = parser.add_argument_group('Config file options')
         cfg_args.add_argument(
@@ -418,60 +679,488 @@ class LsdiBagger(object):
             parser.print_help()
             exit()
 
+        # paths used from worker threads must be absolute; see
+        # load_configfile
+        self.options.output = os.path.abspath(self.options.output)
+        if not self.options.journal:
+            self.options.journal = os.path.join(self.options.output,
+                                                self.journal_file)
+        self.options.journal = os.path.abspath(self.options.journal)
+
     def run(self):
         self.get_options()
+        self.init_logging()
         self.process_items()
+        self.write_metrics()
+
+    def init_logging(self):
+        '''Configure logging; in verbose mode, this includes timing and
+        throughput for each stage of bag creation.'''
+        logging.basicConfig(
+            format='%(asctime)s %(name)s %(levelname)s %(message)s',
+            level=logging.INFO if getattr(self.options, 'verbose', False)
+            else logging.WARNING)
+
+    def record_metrics(self, item_id, baggee, status):
+        '''Add metrics for a bag to :attr:`run_metrics`.'''
+        if baggee.metrics is None:
+            return
+        if self.run_metrics is None:
+            self.run_metrics = []
+        bag_metrics = baggee.metrics.as_dict()
+        bag_metrics.update({'item_id': item_id, 'status': status})
+        self.run_metrics.append(bag_metrics)
+
+    def write_metrics(self):
+        '''Write metrics for the run to the configured metrics file,
+        if any.'''
+        path = getattr(self.options, 'metrics', None)
+        if path:
+            metrics.write_metrics(path, self.run_metrics or [])
 
     def process_items(self):
+        self.init_journal()
+        item_ids = self.items_to_process()
+
+        if getattr(self.options, 'pipeline', False):
+            return self.process_items_pipeline(item_ids)
+
+        jobs = getattr(self.options, 'jobs', None) or 1
+        if jobs > 1:
+            return self.process_items_parallel(jobs, item_ids)
+
+        digwf_api = self.digwf_client()
+        repo = self.fedora_repository()
+        self.init_fedora_monitor()
+        self.init_caches()
+        items = self.prefetch_items(digwf_api, item_ids)
+        relationships = self.prefetch_relationships(items, repo)
+
+        for item_id in item_ids:
+            self.process_item(item_id, digwf_api, repo,
+                              item=items.get(item_id),
+                              relationship_info=relationships.get(item_id))
+
+    def init_journal(self):
+        '''Initialize the job journal, if one is configured.'''
+        path = getattr(self.options, 'journal', None)
+        self.job_journal = journal.Journal(path) if path else None
+
+    def update_journal(self, item_id, state, **kwargs):
+        '''Record the state of an item in the job journal, if any.'''
+        if self.job_journal is not None:
+            self.job_journal.update(item_id, state, **kwargs)
+
+    def items_to_process(self):
+        '''List of item ids to be processed, which are recorded in the
+        job journal as pending.  When resuming a previous run, items
+        that were already bagged are skipped.'''
+        item_ids = self.options.item_ids
+        if self.job_journal is None:
+            return item_ids
+
+        if getattr(self.options, 'resume', False):
+            remaining = []
+            for item_id in item_ids:
+                job = self.job_journal.get(item_id)
+                if job is not None and job['state'] == journal.DONE and \
+                   job['bag'] and os.path.exists(job['bag']):
+                    print 'Skipping item %s; bag already created at %s' % \
+                        (item_id, job['bag'])
+                else:
+                    remaining.append(item_id)
+            item_ids = remaining
+
+        self.job_journal.update_all(item_ids, journal.PENDING)
+        return item_ids
+
+    def remove_incomplete_bag(self, item_id, bagpath):
+        '''When resuming, remove any bag left from a previous attempt to
+        bag this item at `bagpath` that did not complete.'''
+        if self.job_journal is None or \
+           not getattr(self.options, 'resume', False):
+            return
+        job = self.job_journal.get(item_id)
+        if job is None or job['state'] == journal.DONE or not job['bag']:
+            return
+        # bags are built in a temporary directory and then moved into
+        # place; remove temporary directories, but never a completed
+        # bag in the final location (e.g., when a previous attempt
+        # failed because the bag already existed)
+        bagpaths = set([bagpath, job['bag']])
+        incomplete = []
+        for path in bagpaths:
+            incomplete.extend(bag.temp_bag_dirs(path))
+            if os.path.isdir(path) and not bag.is_complete_bag(path):
+                incomplete.append(path)
+        for bagdir in incomplete:
+            print 'Removing incomplete bag %s' % bagdir
+            shutil.rmtree(bagdir)
+
+    def prefetch_items(self, digwf_api, item_ids=None):
+        '''Look up DigWF information for all items to be processed before
+        bagging starts, using concurrent requests, so that bagging does
+        not wait on the DigWF API for each item.  Items not found by the
+        prefetch are looked up individually when they are processed.
+
+        :returns: dictionary of :class:`~baggins.lsdi.digwf.Item` keyed
+            on item id
+        '''
+        if item_ids is None:
+            item_ids = self.options.item_ids
+        items = digwf_api.get_items_by_id(item_ids)
+        if getattr(self.options, 'verbose', False):
+            print 'Retrieved DigWF information for %d of %d items' % \
+                (len(items), len(item_ids))
+        return items
+
+    def prefetch_relationships(self, items, repo):
+        '''Look up Fedora relationship information (volume, book, and
+        collection, with ARKs) for prefetched items before bagging starts,
+        using concurrent requests over the repository connection pool,
+        with at most `fedora_pool_size` items looked up at once.  Book
+        and collection information is shared between volumes through
+        :attr:`LsdiBaggee.fedora_cache`.  Skipped if Fedora was not
+        available when last checked; items that could not be looked up
+        are not included in the result, and are looked up again when
+        they are bagged.
+
+        :param items: dictionary of :class:`~baggins.lsdi.digwf.Item`
+            keyed on item id, as returned by :meth:`prefetch_items`
+        :returns: dictionary of relationship information keyed on item id
+        '''
+        if not items or self.fedora_monitor.last_success is None:
+            return {}
 
-        digwf_api = Client(self.options.digwf_url)
-        repo = Repository(self.options.fedora_url)
-
-        for item_id in self.options.item_ids:
-            try:
-                result = digwf_api.get_items(item_id=item_id)
-            except requests.exceptions.HTTPError as err:
-                print 'Domokun Connection Error! Unable to query DigWF REST API for %s: %s' % (item_id, err)
-                continue
-
+        def lookup(item_id):
             try:
-                r = requests.head(self.options.fedora_url)
-                # prints the int of the status code.
+                baggee = LsdiBaggee(items[item_id], repo)
+                return item_id, baggee.relationship_metadata_info()
             except requests.ConnectionError:
-                print 'Fedora Connection Error! Unable to query Fedora REST API'
-                continue
-
-
-            if result.count == 1:
-                item = result.items[0]
-                print 'Found item %s (pid %s, control key %s, marc %s)' % \
-                    (item_id, item.pid or '-', item.control_key,
-                     item.marc_path)
-                try:
-                    repo.get_object(pid=item.pid)
-                except requests.exceptions.HTTPError as err:
-                    print 'Fedora Connection Error! Unable to query Fedora REST API for %s: %s' % (item.pid, err)
-                    continue
-
-
-            elif result.count == 0:
-                print 'No item found for this item id %s' % item_id
-                continue
-            else:
-                # shouldn't get more than one match when looking up by
-                # item id, but just in case
-                print 'Error! DigWF returned %d matches for this item id %s' % \
-                    (result.count, item_id)
-
-                continue
-
-            # returns a bagit bag object.
-            newbag = LsdiBaggee(item, repo).create_bag(self.options.output)
-
-            # generate source organization summary for this bag
-            # self.load_source_summary(newbag)
-
-            print 'Bag created at %s' % newbag
+                self.fedora_monitor.failed()
+            except Exception:
+                # errors are reported if they recur when bagging
+                pass
+            return item_id, None
+
+        workers = min(getattr(self.options, 'fedora_pool_size', None) or
+                      fedora.POOL_SIZE, len(items))
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(lookup, list(items))
+        finally:
+            pool.close()
+            pool.join()
+        relationships = dict((item_id, info) for item_id, info in results
+                             if info is not None)
+        if getattr(self.options, 'verbose', False):
+            print 'Retrieved Fedora relationships for %d of %d items' % \
+                (len(relationships), len(items))
+        return relationships
+
+    def process_items_parallel(self, jobs, item_ids=None):
+        '''Process items using a pool of worker processes.  Each worker
+        initializes its own DigWF and Fedora clients; output for each item
+        is collected in the worker and reported here in the order the
+        items were requested, so messages for different items are never
+        interleaved.'''
+        if item_ids is None:
+            item_ids = self.options.item_ids
+        items = self.prefetch_items(self.digwf_client(), item_ids)
+        self.init_fedora_monitor()
+        self.init_caches()
+        relationships = self.prefetch_relationships(
+            items, self.fedora_repository())
+        # send item information to the workers as xml, since parsed
+        # xml objects can't be pickled
+        work = [(item_id, items[item_id].serialize()
+                 if item_id in items else None,
+                 relationships.get(item_id))
+                for item_id in item_ids]
+
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker,
+                                    initargs=(self.options,))
+        try:
+            for output, bag_metrics in pool.imap(_process_item_worker, work):
+                sys.stdout.write(output)
+                sys.stdout.flush()
+                if bag_metrics:
+                    self.run_metrics = (self.run_metrics or []) + bag_metrics
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def process_items_pipeline(self, item_ids=None):
+        '''Process items in a staged pipeline: items are fetched (DigWF,
+        MARC, and Fedora metadata and directory listings), staged,
+        checksummed, and finalized (metadata, tag files, and moving the
+        bag into place) by separate pools of threads, connected by
+        bounded queues, so the stages for different items overlap.
+        Results are reported as each item completes.'''
+        if item_ids is None:
+            item_ids = self.options.item_ids
+        # an item listed more than once would be bagged concurrently
+        # by different jobs for the same bag; process it once
+        item_ids = list(OrderedDict.fromkeys(item_ids))
+        digwf_api = self.digwf_client()
+        repo = self.fedora_repository()
+        self.init_fedora_monitor()
+        self.init_caches()
+        items = self.prefetch_items(digwf_api, item_ids)
+
+        stages = [
+            pipeline.Stage('fetch', partial(self.fetch_item, digwf_api=digwf_api,
+                                            repo=repo, items=items),
+                           getattr(self.options, 'fetch_workers', None)),
+            pipeline.Stage('stage', partial(self.stage_item,
+                                            output=self.options.output),
+                           getattr(self.options, 'stage_workers', None)),
+            pipeline.Stage('hash', self.checksum_item,
+                           getattr(self.options, 'hash_workers', None)),
+            pipeline.Stage('finalize', self.finalize_item,
+                           getattr(self.options, 'finalize_workers', None)),
+        ]
+        jobs = pipeline.Pipeline(
+            stages, queue_size=getattr(self.options, 'queue_size', None))
+        for job in jobs.run(item_ids):
+            if job.baggee is not None:
+                self.item_found(job.item, job.baggee.item)
+            if job.failed:
+                self.bag_failed(job.item, job.baggee, job.error,
+                                job.traceback)
+            elif job.bag is not None:
+                self.update_journal(job.item, journal.DONE,
+                                    bag=job.bagpath)
+                self.record_metrics(job.item, job.baggee, journal.DONE)
+                print 'Bag created at %s' % job.bag
+
+    def fetch_item(self, job, digwf_api, repo, items):
+        '''Pipeline stage: look up an item in the DigWF (if not already
+        retrieved) and fetch the metadata needed to bag it.  Items that
+        can't be found or bagged are reported here and not processed
+        by later stages.'''
+        item_id = job.item
+        job.baggee = job.bag = job.bagpath = job.bagdir = \
+            job.tmp_bagdir = None
+        self.update_journal(item_id, journal.FETCHING)
+        item = items.get(item_id)
+        if item is None:
+            item = self.lookup_item(item_id, digwf_api)
+            if item is None:
+                return
+        if not self.fedora_monitor.available():
+            return self.item_failed(
+                item_id, 'Fedora Connection Error! Unable to query Fedora REST API')
+        job.baggee = self.init_baggee(item_id, item, repo)
+        job.baggee.prefetch_metadata()
+
+    def stage_item(self, job, output):
+        '''Pipeline stage: stage payload files in a temporary bag
+        directory.  Serialized bags are streamed into the archive and
+        checksummed in a single pass, so they are created here.'''
+        baggee = job.baggee
+        if baggee is None:
+            return
+        job.bagpath = baggee.bag_path(output)
+        self.remove_incomplete_bag(job.item, job.bagpath)
+        if baggee.serialization:
+            job.bag = baggee.create_bag(output)
+            return
+        job.bagdir, job.tmp_bagdir = baggee.start_bag(output)
+        try:
+            baggee.stage_payload(job.tmp_bagdir)
+        except BaseException:
+            baggee.abort_bag(job.tmp_bagdir)
+            raise
+
+    def checksum_item(self, job):
+        '''Pipeline stage: checksum payload files that were not
+        checksummed while they were staged.'''
+        if job.tmp_bagdir is None:
+            return
+        try:
+            job.baggee.checksum_payload(job.tmp_bagdir)
+        except BaseException:
+            job.baggee.abort_bag(job.tmp_bagdir)
+            raise
+
+    def finalize_item(self, job):
+        '''Pipeline stage: add metadata and tag files and move the
+        completed bag into place.'''
+        if job.tmp_bagdir is None:
+            return
+        job.bag = job.baggee.finish_bag(job.tmp_bagdir, job.bagdir)
+
+    def digwf_client(self):
+        '''Initialize a DigWF API client, with connection pool and retry
+        settings from the config file if specified.'''
+        api_cache = None
+        cache_path = getattr(self.options, 'digwf_cache', None)
+        if cache_path:
+            ttl = getattr(self.options, 'digwf_cache_ttl', None)
+            api_cache = cache.Cache(
+                ttl=ttl if ttl is not None else self.digwf_cache_ttl,
+                path=cache_path, name='digwf')
+        return Client(self.options.digwf_url,
+                      pool_size=getattr(self.options, 'digwf_pool_size', None),
+                      timeout=getattr(self.options, 'digwf_timeout', None),
+                      retries=getattr(self.options, 'digwf_retries', None),
+                      cache=api_cache)
+
+    def fedora_repository(self):
+        '''Initialize a Fedora repository connection, with a connection
+        pool sized from the config file if specified.'''
+        return fedora.pool_connections(
+            Repository(self.options.fedora_url),
+            getattr(self.options, 'fedora_pool_size', None))
+
+    def init_caches(self):
+        '''Initialize the shared cache of Fedora book and collection
+        information used by :class:`LsdiBaggee`, with expiration and
+        optional cache file from the config file.  If a DigWF cache
+        file is configured, parsed MARC records are cached there too.'''
+        ttl = getattr(self.options, 'fedora_cache_ttl', None)
+        LsdiBaggee.fedora_cache = cache.Cache(
+            ttl=ttl if ttl is not None else LsdiBaggee.fedora_cache.ttl,
+            path=getattr(self.options, 'fedora_cache', None) or None,
+            name='fedora')
+
+        Item.marc_cache = None
+        cache_path = getattr(self.options, 'digwf_cache', None)
+        if cache_path:
+            Item.marc_cache = cache.Cache(path=cache_path, name='marc')
+
+    def init_fedora_monitor(self):
+        '''Initialize a :class:`~baggins.lsdi.fedora.FedoraMonitor` for the
+        configured Fedora repository and check it once at startup.'''
+        self.fedora_monitor = FedoraMonitor(
+            self.options.fedora_url,
+            interval=getattr(self.options, 'fedora_check_interval', None))
+        self.fedora_monitor.check()
+
+    def configure_baggee(self, baggee):
+        '''Apply bagging options from the command line to a baggee.'''
+        if getattr(self.options, 'staging', None):
+            baggee.staging_strategy = self.options.staging
+        if getattr(self.options, 'checksum_threads', None):
+            baggee.checksum_workers = self.options.checksum_threads
+        if getattr(self.options, 'parallel_digests', False):
+            baggee.parallel_digests = True
+        if getattr(self.options, 'serialize', None):
+            baggee.serialization = self.options.serialize
+        if getattr(self.options, 'characterization_threads', None):
+            baggee.characterization_workers = \
+                self.options.characterization_threads
+
+    def process_item(self, item_id, digwf_api, repo, item=None,
+                     relationship_info=None):
+        '''Look up a single item in the DigWF and create a bag for it.
+        Errors are reported and do not prevent other items from
+        being processed.  If DigWF information or Fedora relationship
+        information for the item has already been retrieved, it can be
+        passed in as `item` and `relationship_info`.  Progress is
+        recorded in the job journal, if there is one.'''
+        self.update_journal(item_id, journal.FETCHING)
+        if item is None:
+            item = self.lookup_item(item_id, digwf_api)
+            if item is None:
+                return
+
+        if self.fedora_monitor is None:
+            self.init_fedora_monitor()
+        if not self.fedora_monitor.available():
+            return self.item_failed(
+                item_id, 'Fedora Connection Error! Unable to query Fedora REST API')
+
+        self.item_found(item_id, item)
+
+        baggee = None
+        try:
+            baggee = self.init_baggee(item_id, item, repo)
+            baggee.relationship_info = relationship_info
+            bagpath = baggee.bag_path(self.options.output)
+            self.remove_incomplete_bag(item_id, bagpath)
+            # returns a bagit bag object (or archive path, if serialized)
+            newbag = baggee.create_bag(self.options.output)
+        except Exception as err:
+            return self.bag_failed(item_id, baggee, err,
+                                   traceback.format_exc())
+
+        # generate source organization summary for this bag
+        # self.load_source_summary(newbag)
+
+        self.update_journal(item_id, journal.DONE, bag=bagpath)
+        self.record_metrics(item_id, baggee, journal.DONE)
+        print 'Bag created at %s' % newbag
+
+    def item_found(self, item_id, item):
+        '''Report the DigWF item found for an item id.'''
+        print 'Found item %s (pid %s, control key %s, marc %s)' % \
+            (item_id, item.pid or '-', item.control_key, item.marc_path)
+
+    def init_baggee(self, item_id, item, repo):
+        '''Initialize and configure an :class:`LsdiBaggee` for an item,
+        reporting bag creation status in the job journal.'''
+        baggee = LsdiBaggee(item, repo)
+        self.configure_baggee(baggee)
+
+        def status_callback(status):
+            # record the bag location once payload staging has started,
+            # i.e. once the temporary bag directory has been created; a
+            # bag that was already there when this attempt started is
+            # never recorded for this attempt
+            bagpath = None
+            if status == journal.STAGING:
+                bagpath = baggee.bag_path(self.options.output)
+            self.update_journal(item_id, status, bag=bagpath)
+
+        baggee.status_callback = status_callback
+        return baggee
+
+    def bag_failed(self, item_id, baggee, err, tb=None):
+        '''Report an error creating a bag for an item, including the
+        traceback `tb` in verbose mode, and record metrics for the
+        failed bag.'''
+        if isinstance(err, requests.ConnectionError):
+            self.fedora_monitor.failed()
+        self.item_failed(
+            item_id, 'Error! Unable to create bag for item %s: %s' % (item_id, err))
+        if getattr(self.options, 'verbose', False) and tb:
+            print tb
+        if baggee is not None:
+            self.record_metrics(item_id, baggee, journal.FAILED)
+
+    def item_failed(self, item_id, message):
+        '''Report an error processing an item and record it in the
+        job journal.'''
+        print message
+        self.update_journal(item_id, journal.FAILED, error=message)
+
+    def lookup_item(self, item_id, digwf_api):
+        '''Look up a single item in the DigWF by item id.  Returns
+        None and reports the problem if the item could not be found.'''
+        try:
+            result = digwf_api.get_items(item_id=item_id)
+        except requests.exceptions.RequestException as err:
+            # includes connection errors and timeouts once the client's
+            # retries are exhausted, not just error responses
+            return self.item_failed(
+                item_id, 'Domokun Connection Error! Unable to query DigWF REST API for %s: %s' % (item_id, err))
+
+        if result.count == 1:
+            return result.items[0]
+        elif result.count == 0:
+            self.item_failed(
+                item_id, 'No item found for this item id %s' % item_id)
+        else:
+            # shouldn't get more than one match when looking up by
+            # item id, but just in case
+            self.item_failed(
+                item_id, 'Error! DigWF returned %d matches for this item id %s' %
+                (result.count, item_id))
 
     # config file section headings
     digwf_cfg = 'Digitization Workflow'
@@ -485,12 +1174,29 @@ class LsdiBagger(object):
         # digwf
         config.add_section(self.digwf_cfg)
         config.set(self.digwf_cfg, 'url', 'http://server:port/digwf_api/')
+        config.set(self.digwf_cfg, 'timeout', str(Client.timeout))
+        config.set(self.digwf_cfg, 'retries', str(Client.retries))
+        config.set(self.digwf_cfg, 'pool_size', str(Client.pool_size))
+        # optional file for caching DigWF responses and parsed MARC
+        # records between runs
+        config.set(self.digwf_cfg, 'cache', '')
+        config.set(self.digwf_cfg, 'cache_ttl', str(self.digwf_cache_ttl))
         # file paths
         config.add_section(self.filepaths_cfg)
         config.set(self.filepaths_cfg, 'output', self.options.output or '')
         # fedora
         config.add_section(self.fedora_cfg)
         config.set(self.fedora_cfg, 'url', 'http://fedora.server:8080/fedora/')
+        config.set(self.fedora_cfg, 'check_interval',
+                   str(FedoraMonitor.interval))
+        # connections kept open to fedora; also the number of items
+        # whose relationships are looked up concurrently
+        config.set(self.fedora_cfg, 'pool_size', str(fedora.POOL_SIZE))
+        # optional file for caching book and collection information
+        # between runs
+        config.set(self.fedora_cfg, 'cache', '')
+        config.set(self.fedora_cfg, 'cache_ttl',
+                   str(LsdiBaggee.fedora_cache.ttl))
         # eventually we will have more config options here...
         return config
 
@@ -525,6 +1231,22 @@ class LsdiBagger(object):
             print 'Error: Digitization Workflow URL not configured'
             exit()
 
+        # - digwf connection settings are optional
+        for opt, getter in [('timeout', cfg.getfloat),
+                            ('retries', cfg.getint),
+                            ('pool_size', cfg.getint),
+                            ('cache', cfg.get),
+                            ('cache_ttl', cfg.getint)]:
+            value = None
+            if cfg.has_option(self.digwf_cfg, opt):
+                value = getter(self.digwf_cfg, opt)
+            setattr(self.options, 'digwf_%s' % opt, value)
+        # cache files may be opened from worker threads while bagit has
+        # changed the working directory, so paths must be absolute
+        if self.options.digwf_cache:
+            self.options.digwf_cache = \
+                os.path.abspath(self.options.digwf_cache)
+
         # - fedora url is required
         try:
             self.options.fedora_url = cfg.get(self.fedora_cfg, 'url')
@@ -535,6 +1257,28 @@ class LsdiBagger(object):
             print 'Error: Fedora URL not configured'
             exit()
 
+        # - how often to check fedora is available is optional
+        self.options.fedora_check_interval = None
+        if cfg.has_option(self.fedora_cfg, 'check_interval'):
+            self.options.fedora_check_interval = \
+                cfg.getint(self.fedora_cfg, 'check_interval')
+
+        # - connection pool size is optional
+        self.options.fedora_pool_size = None
+        if cfg.has_option(self.fedora_cfg, 'pool_size'):
+            self.options.fedora_pool_size = \
+                cfg.getint(self.fedora_cfg, 'pool_size')
+
+        # - book and collection cache settings are optional
+        self.options.fedora_cache = None
+        self.options.fedora_cache_ttl = None
+        if cfg.has_option(self.fedora_cfg, 'cache'):
+            self.options.fedora_cache = \
+                os.path.abspath(cfg.get(self.fedora_cfg, 'cache'))
+        if cfg.has_option(self.fedora_cfg, 'cache_ttl'):
+            self.options.fedora_cache_ttl = \
+                cfg.getint(self.fedora_cfg, 'cache_ttl')
+
         # output could be specified via command line or config file;
         # command line flag overrules config
         if cfg.has_option(self.filepaths_cfg, 'output') and \
@@ -549,9 +1293,40 @@ class LsdiBagger(object):
             print "Unable to load specified id file"
 
 
-
-
-
-
-
-
+# per-process bagger and clients used by worker processes when bagging
+# items in parallel; initialized once in each worker by _init_worker
+_worker = {}
+
+
+def _init_worker(options):
+    bagger = LsdiBagger()
+    bagger.options = options
+    _worker['bagger'] = bagger
+    _worker['digwf_api'] = bagger.digwf_client()
+    _worker['repo'] = bagger.fedora_repository()
+    bagger.init_fedora_monitor()
+    bagger.init_caches()
+    bagger.init_journal()
+
+
+def _process_item_worker(work):
+    # process a single item in a worker process, capturing anything
+    # printed so it can be reported in order by the parent process,
+    # along with metrics for the bag
+    item_id, item_xml, relationship_info = work
+    output = StringIO()
+    stdout = sys.stdout
+    sys.stdout = output
+    _worker['bagger'].run_metrics = []
+    try:
+        item = None
+        if item_xml is not None:
+            item = load_xmlobject_from_string(item_xml, Item)
+        _worker['bagger'].process_item(item_id, _worker['digwf_api'],
+                                       _worker['repo'], item=item,
+                                       relationship_info=relationship_info)
+    except Exception as err:
+        print 'Error! Unable to process item %s: %s' % (item_id, err)
+    finally:
+        sys.stdout = stdout
+    return output.getvalue(), _worker['bagger'].run_metrics
@@ -0,0 +1,133 @@
+'''
+Caches for information looked up from external services (such as
+Fedora or the DigWF API) that is needed repeatedly when bagging many
+items, e.g. the parent book and collection shared by every volume in
+a set.
+
+Values are kept in memory with least-recently-used eviction and an
+optional expiration time, and can optionally be stored in a local
+sqlite database, so that cached information can be shared by parallel
+worker processes and reused by later runs.
+
+'''
+
+import cPickle as pickle
+from collections import OrderedDict
+import os
+import sqlite3
+import threading
+import time
+
+
+#: marker for values not found in the cache (None is a valid value)
+MISSING = object()
+
+
+class Cache(object):
+    '''Least-recently-used cache of values keyed on string, with
+    optional expiration and optional persistence to disk.
+
+    :param max_size: maximum number of values to keep in memory
+    :param ttl: number of seconds before a cached value expires;
+        values never expire if None
+    :param path: optional path to a sqlite database file where cached
+        values should also be stored
+    :param name: name of the table in the database file, so that
+        several caches can share the same file
+    '''
+
+    def __init__(self, max_size=1000, ttl=None, path=None, name='cache'):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.name = name
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+        self._db = None
+        self._db_pid = None
+
+    def _expired(self, timestamp, now=None):
+        if self.ttl is None:
+            return False
+        return (now or time.time()) - timestamp > self.ttl
+
+    @property
+    def db(self):
+        # database connection, opened on first use in each process
+        # (connections should not be shared with forked worker processes)
+        if self.path is None:
+            return None
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=30,
+                                       check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, '
+                'value BLOB, timestamp REAL)' % self.name)
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    def get(self, key, default=None):
+        '''Get a value from the cache, if it is present and has not
+        expired.  Returns `default` otherwise.'''
+        now = time.time()
+        with self._lock:
+            if key in self._items:
+                timestamp, value = self._items.pop(key)
+                if not self._expired(timestamp, now):
+                    # re-add as most recently used
+                    self._items[key] = (timestamp, value)
+                    return value
+
+            if self.db is not None:
+                row = self.db.execute(
+                    'SELECT value, timestamp FROM %s WHERE key = ?'
+                    % self.name, (key,)).fetchone()
+                if row is not None and not self._expired(row[1], now):
+                    value = pickle.loads(str(row[0]))
+                    self._store(key, value, row[1])
+                    return value
+
+        return default
+
+    def _store(self, key, value, timestamp):
+        # store a value in memory, evicting least recently used values
+        self._items.pop(key, None)
+        self._items[key] = (timestamp, value)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def set(self, key, value):
+        '''Add or replace a value in the cache.'''
+        timestamp = time.time()
+        with self._lock:
+            self._store(key, value, timestamp)
+            if self.db is not None:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO %s (key, value, timestamp) '
+                    'VALUES (?, ?, ?)' % self.name,
+                    (key, sqlite3.Binary(pickle.dumps(value, 2)), timestamp))
+                self.db.commit()
+
+    def get_or_set(self, key, func, cache_if=None):
+        '''Get a value from the cache; if it is not present, generate
+        the value by calling `func` and cache the result.  If `cache_if`
+        is specified, the result is only cached if ``cache_if(value)``
+        is true (e.g., to avoid caching a lookup that failed).'''
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            value = func()
+            if cache_if is None or cache_if(value):
+                self.set(key, value)
+        return value
+
+    def clear(self):
+        '''Remove all values from the cache.'''
+        with self._lock:
+            self._items.clear()
+            if self.db is not None:
+                self.db.execute('DELETE FROM %s' % self.name)
+                self.db.commit()
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,336 @@
+'''
+Lightweight characterization of page images (TIFF, JPEG 2000, and JPEG)
+for technical metadata.  Only image headers are read: the first TIFF
+image file directory, the JP2 header box, or the JPEG markers up to the
+start of frame.  Image data is never read, so characterizing a volume
+costs a few small reads per image rather than a full read of every file
+(as with tools like FITS).
+
+Results are reported as dictionaries, and can be written as NISO MIX
+(Z39.87) records with :func:`write_mix`.
+
+'''
+
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import struct
+
+from lxml import etree
+
+
+logger = logging.getLogger(__name__)
+
+#: NISO MIX 2.0 namespace
+MIX_NS = 'http://www.loc.gov/mix/v20'
+
+#: TIFF compression scheme names, keyed on TIFF Compression tag value
+TIFF_COMPRESSION = {
+    1: 'Uncompressed',
+    2: 'CCITT 1D',
+    3: 'CCITT Group 3',
+    4: 'CCITT Group 4',
+    5: 'LZW',
+    6: 'JPEG',
+    7: 'JPEG',
+    8: 'Deflate',
+    32773: 'PackBits',
+    32946: 'Deflate',
+    34712: 'JPEG 2000',
+}
+
+#: color space names, keyed on TIFF PhotometricInterpretation tag value
+TIFF_COLOR_SPACE = {
+    0: 'WhiteIsZero',
+    1: 'BlackIsZero',
+    2: 'RGB',
+    3: 'PaletteColor',
+    4: 'TransparencyMask',
+    5: 'CMYK',
+    6: 'YCbCr',
+    8: 'CIELab',
+}
+
+#: color space names, keyed on JP2 enumerated colourspace
+JP2_COLOR_SPACE = {
+    16: 'sRGB',
+    17: 'greyscale',
+    18: 'sYCC',
+}
+
+#: JPEG color space, based on the number of components in the frame
+JPEG_COLOR_SPACE = {
+    1: 'BlackIsZero',
+    3: 'YCbCr',
+    4: 'CMYK',
+}
+
+# TIFF tags used for characterization
+_TIFF_WIDTH = 256
+_TIFF_HEIGHT = 257
+_TIFF_BITS_PER_SAMPLE = 258
+_TIFF_COMPRESSION = 259
+_TIFF_PHOTOMETRIC = 262
+_TIFF_SAMPLES_PER_PIXEL = 277
+_TIFF_TAGS = set([_TIFF_WIDTH, _TIFF_HEIGHT, _TIFF_BITS_PER_SAMPLE,
+                  _TIFF_COMPRESSION, _TIFF_PHOTOMETRIC,
+                  _TIFF_SAMPLES_PER_PIXEL])
+# struct formats for the integer TIFF field types (BYTE, SHORT, LONG)
+_TIFF_TYPES = {1: 'B', 3: 'H', 4: 'I'}
+
+# JPEG start of frame markers (SOF0-SOF15, except DHT, JPG, and DAC)
+_JPEG_SOF = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+# JPEG markers without a length or payload
+_JPEG_STANDALONE = set([0x01] + range(0xD0, 0xDA))
+# JPEG start of scan; image data follows
+_JPEG_SOS = 0xDA
+
+_JP2_SIGNATURE = '\x00\x00\x00\x0cjP  \r\n\x87\n'
+
+
+class CharacterizationError(Exception):
+    '''Image header could not be read or is not a supported format.'''
+    pass
+
+
+def _read(imgfile, size):
+    data = imgfile.read(size)
+    if len(data) != size:
+        raise CharacterizationError('Unexpected end of file')
+    return data
+
+
+def characterize_tiff(imgfile):
+    '''Characterize a TIFF image from the first image file directory.'''
+    header = _read(imgfile, 8)
+    byte_order = '<' if header[:2] == 'II' else '>'
+    magic, ifd_offset = struct.unpack(byte_order + 'HI', header[2:])
+    if magic != 42:
+        raise CharacterizationError('Unsupported TIFF variant (BigTIFF?)')
+
+    imgfile.seek(ifd_offset)
+    count = struct.unpack(byte_order + 'H', _read(imgfile, 2))[0]
+    entries = _read(imgfile, count * 12)
+    values = {}
+    for i in range(count):
+        tag, field_type, value_count, value = struct.unpack(
+            byte_order + 'HHI4s', entries[i * 12:(i + 1) * 12])
+        if tag not in _TIFF_TAGS or field_type not in _TIFF_TYPES:
+            continue
+        fmt = '%s%d%s' % (byte_order, value_count, _TIFF_TYPES[field_type])
+        size = struct.calcsize(fmt)
+        if size > 4:
+            # values that don't fit in the entry are stored elsewhere
+            # in the header; offsets are relative to the start of file
+            imgfile.seek(struct.unpack(byte_order + 'I', value)[0])
+            value = _read(imgfile, size)
+        values[tag] = list(struct.unpack(fmt, value[:size]))
+
+    if _TIFF_WIDTH not in values or _TIFF_HEIGHT not in values:
+        raise CharacterizationError('TIFF image dimensions not found')
+    samples = values.get(_TIFF_SAMPLES_PER_PIXEL, [1])[0]
+    bits = values.get(_TIFF_BITS_PER_SAMPLE, [1])
+    if len(bits) == 1 and samples > 1:
+        bits = bits * samples
+    compression = values.get(_TIFF_COMPRESSION, [1])[0]
+    photometric = values.get(_TIFF_PHOTOMETRIC, [None])[0]
+    return {
+        'mimetype': 'image/tiff',
+        'width': values[_TIFF_WIDTH][0],
+        'height': values[_TIFF_HEIGHT][0],
+        'bits_per_sample': bits,
+        'samples_per_pixel': samples,
+        'compression': TIFF_COMPRESSION.get(compression, str(compression)),
+        'color_space': TIFF_COLOR_SPACE.get(photometric),
+        'byte_order': 'little endian' if byte_order == '<' else 'big endian',
+    }
+
+
+def characterize_jp2(imgfile):
+    '''Characterize a JPEG 2000 (JP2) image from the image header and
+    colour specification boxes in the JP2 header box.  The contiguous
+    codestream box is never read.'''
+    info = {'mimetype': 'image/jp2', 'compression': 'JPEG 2000',
+            'color_space': None}
+    imgfile.seek(0)
+    end = None
+    while end is None or imgfile.tell() < end:
+        box_start = imgfile.tell()
+        header = imgfile.read(8)
+        if len(header) < 8:
+            break
+        length, box_type = struct.unpack('>I4s', header)
+        if length == 1:
+            length = struct.unpack('>Q', _read(imgfile, 8))[0]
+        if box_type == 'jp2h':
+            # header superbox: read the boxes it contains
+            end = box_start + length if length else None
+            continue
+        if box_type == 'ihdr':
+            height, width, components, bpc = struct.unpack(
+                '>IIHB', _read(imgfile, 11))
+            info.update({
+                'width': width,
+                'height': height,
+                'samples_per_pixel': components,
+                # bit depth is stored minus one, with a sign bit;
+                # 255 means components vary (see the bpcc box)
+                'bits_per_sample': [(bpc & 0x7F) + 1] * components
+                if bpc != 255 else [],
+            })
+        elif box_type == 'bpcc' and 'samples_per_pixel' in info:
+            info['bits_per_sample'] = [
+                (ord(bpc) & 0x7F) + 1
+                for bpc in _read(imgfile, info['samples_per_pixel'])]
+        elif box_type == 'colr':
+            method = ord(_read(imgfile, 3)[0])
+            if method == 1:
+                colourspace = struct.unpack('>I', _read(imgfile, 4))[0]
+                info['color_space'] = JP2_COLOR_SPACE.get(colourspace)
+        elif box_type == 'jp2c' or not length:
+            # codestream, or last box in the file
+            break
+        imgfile.seek(box_start + length)
+
+    if 'width' not in info:
+        raise CharacterizationError('JP2 image header box not found')
+    return info
+
+
+def characterize_jpeg(imgfile):
+    '''Characterize a JPEG image from its start of frame marker, skipping
+    over the payload of any markers before it.'''
+    imgfile.seek(2)
+    while True:
+        # markers may be preceded by any number of fill bytes
+        byte = _read(imgfile, 1)
+        if byte != '\xff':
+            raise CharacterizationError('Invalid JPEG marker')
+        marker = ord(_read(imgfile, 1))
+        while marker == 0xFF:
+            marker = ord(_read(imgfile, 1))
+        if marker in _JPEG_STANDALONE:
+            continue
+        if marker == _JPEG_SOS:
+            raise CharacterizationError('JPEG start of frame not found')
+        length = struct.unpack('>H', _read(imgfile, 2))[0]
+        if marker in _JPEG_SOF:
+            precision, height, width, components = struct.unpack(
+                '>BHHB', _read(imgfile, 6))
+            return {
+                'mimetype': 'image/jpeg',
+                'width': width,
+                'height': height,
+                'bits_per_sample': [precision] * components,
+                'samples_per_pixel': components,
+                'compression': 'JPEG',
+                'color_space': JPEG_COLOR_SPACE.get(components),
+            }
+        imgfile.seek(length - 2, os.SEEK_CUR)
+
+
+def characterize(path):
+    '''Characterize an image file based on its header.  The format is
+    determined from the file signature, not the file name.
+
+    :returns: dictionary with mimetype, size (in bytes), width, height,
+        bits_per_sample (list, one per sample), samples_per_pixel,
+        compression, color_space, and (for TIFF) byte_order
+    :raises CharacterizationError: if the file is not a supported image
+        or the header can't be read
+    '''
+    with open(path, 'rb') as imgfile:
+        signature = imgfile.read(12)
+        imgfile.seek(0)
+        if signature[:4] in ('II*\x00', 'MM\x00*'):
+            info = characterize_tiff(imgfile)
+        elif signature == _JP2_SIGNATURE:
+            info = characterize_jp2(imgfile)
+        elif signature[:2] == '\xff\xd8':
+            info = characterize_jpeg(imgfile)
+        else:
+            raise CharacterizationError('Unsupported image format')
+        info['size'] = os.fstat(imgfile.fileno()).st_size
+    return info
+
+
+def _characterize(path):
+    # characterize an image for a worker pool, reporting errors in the
+    # result instead of raising them
+    try:
+        return path, characterize(path)
+    except (CharacterizationError, IOError, struct.error) as err:
+        logger.warning('Unable to characterize %s: %s', path, err)
+        return path, None
+
+
+def characterize_files(paths, workers=1):
+    '''Characterize a list of image files, using a pool of `workers`
+    threads (reading headers is dominated by file open and seek latency,
+    particularly on network storage).  Images that can't be characterized
+    are logged as warnings.
+
+    :returns: list of tuples of path and characterization (as returned
+        by :func:`characterize`), or None for images that could not be
+        characterized, in the order of `paths`
+    '''
+    paths = list(paths)
+    if workers > 1 and len(paths) > 1:
+        pool = ThreadPool(min(workers, len(paths)))
+        try:
+            return pool.map(_characterize, paths)
+        finally:
+            pool.close()
+            pool.join()
+    return map(_characterize, paths)
+
+
+def _mix(parent, name, text=None):
+    element = etree.SubElement(parent, '{%s}%s' % (MIX_NS, name))
+    if text is not None:
+        element.text = unicode(text)
+    return element
+
+
+def mix_record(info, name):
+    '''Generate a MIX record for a characterized image.
+
+    :param info: characterization, as returned by :func:`characterize`
+    :param name: file name, used as the object identifier
+    :returns: :class:`lxml.etree.Element`
+    '''
+    mix = etree.Element('{%s}mix' % MIX_NS, nsmap={'mix': MIX_NS})
+    basic = _mix(mix, 'BasicDigitalObjectInformation')
+    identifier = _mix(basic, 'ObjectIdentifier')
+    _mix(identifier, 'objectIdentifierType', 'filename')
+    _mix(identifier, 'objectIdentifierValue', name)
+    _mix(basic, 'fileSize', info['size'])
+    _mix(_mix(basic, 'FormatDesignation'), 'formatName', info['mimetype'])
+    if info.get('byte_order'):
+        _mix(basic, 'byteOrder', info['byte_order'])
+    _mix(_mix(basic, 'Compression'), 'compressionScheme', info['compression'])
+
+    image = _mix(_mix(mix, 'BasicImageInformation'),
+                 'BasicImageCharacteristics')
+    _mix(image, 'imageWidth', info['width'])
+    _mix(image, 'imageHeight', info['height'])
+    if info.get('color_space'):
+        _mix(_mix(image, 'PhotometricInterpretation'), 'colorSpace',
+             info['color_space'])
+
+    encoding = _mix(_mix(mix, 'ImageAssessmentMetadata'),
+                    'ImageColorEncoding')
+    if info['bits_per_sample']:
+        bits = _mix(encoding, 'BitsPerSample')
+        _mix(bits, 'bitsPerSampleValue',
+             ','.join(str(value) for value in info['bits_per_sample']))
+        _mix(bits, 'bitsPerSampleUnit', 'integer')
+    _mix(encoding, 'samplesPerPixel', info['samples_per_pixel'])
+    return mix
+
+
+def write_mix(path, info, name):
+    '''Write a MIX record for a characterized image to a file; see
+    :func:`mix_record`.'''
+    etree.ElementTree(mix_record(info, name)).write(
+        path, encoding='UTF-8', xml_declaration=True, pretty_print=True)
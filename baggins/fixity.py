@@ -0,0 +1,146 @@
+'''
+Checksum utilities for bag payload content.  Checksums for all requested
+algorithms are calculated from a single read of each file, including
+while content is being copied into a bag, so that payload files never
+need to be read a second time just to generate manifests.
+
+'''
+
+import hashlib
+from Queue import Queue
+import shutil
+import threading
+
+
+#: size of blocks read when copying or checksumming files
+BLOCK_SIZE = 1024 * 1024
+
+#: maximum number of blocks queued for each digest thread when
+#: calculating digests in parallel
+DIGEST_QUEUE_SIZE = 4
+
+
+def get_hashers(algorithms):
+    '''Initialize a :mod:`hashlib` hash object for each of the requested
+    algorithms, as a dictionary keyed on algorithm name.'''
+    return dict((alg, hashlib.new(alg)) for alg in algorithms)
+
+
+def hexdigests(hashers):
+    '''Dictionary of hex digests keyed on algorithm name for a
+    dictionary of hash objects as returned by :meth:`get_hashers`.'''
+    return dict((alg, hasher.hexdigest()) for alg, hasher in hashers.items())
+
+
+class MultiHasher(object):
+    '''Calculate digests for several algorithms over the same content.
+
+    If threaded, each algorithm is updated in its own thread, so that
+    digests of the same block are calculated concurrently (:mod:`hashlib`
+    releases the GIL when hashing large blocks).  Memory use is bounded
+    by :data:`DIGEST_QUEUE_SIZE` blocks per algorithm.
+
+    :param algorithms: list of :mod:`hashlib` algorithm names
+    :param threaded: calculate each digest in a separate thread
+    '''
+
+    def __init__(self, algorithms, threaded=False):
+        self.hashers = get_hashers(algorithms)
+        self.queues = []
+        self.threads = []
+        if threaded and len(self.hashers) > 1:
+            for hasher in self.hashers.values():
+                queue = Queue(DIGEST_QUEUE_SIZE)
+                thread = threading.Thread(target=self._digest,
+                                          args=(hasher, queue))
+                thread.daemon = True
+                thread.start()
+                self.queues.append(queue)
+                self.threads.append(thread)
+
+    @staticmethod
+    def _digest(hasher, queue):
+        while True:
+            block = queue.get()
+            if block is None:
+                break
+            hasher.update(block)
+
+    def update(self, block):
+        if self.queues:
+            for queue in self.queues:
+                queue.put(block)
+        else:
+            for hasher in self.hashers.values():
+                hasher.update(block)
+
+    def close(self):
+        '''Wait for any digest threads to finish.'''
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.queues = []
+        self.threads = []
+
+    def hexdigests(self):
+        '''Dictionary of hex digests keyed on algorithm name.'''
+        self.close()
+        return hexdigests(self.hashers)
+
+
+def hash_file(path, algorithms, threaded=False):
+    '''Calculate checksums for a file, reading the file only once
+    regardless of how many algorithms are requested.
+
+    :param path: path to the file to checksum
+    :param algorithms: list of :mod:`hashlib` algorithm names
+    :param threaded: calculate each algorithm in a separate thread;
+        see :class:`MultiHasher`
+    :returns: tuple of size in bytes and a dictionary of hex digests
+        keyed on algorithm name
+    '''
+    hasher = MultiHasher(algorithms, threaded)
+    size = 0
+    try:
+        with open(path, 'rb') as infile:
+            while True:
+                block = infile.read(BLOCK_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                hasher.update(block)
+    finally:
+        hasher.close()
+    return size, hasher.hexdigests()
+
+
+def copy_and_hash(src, dest, algorithms, threaded=False):
+    '''Copy a file and calculate checksums for it from the same reads
+    used to copy the content.  File statistics are preserved, as with
+    :meth:`shutil.copy2`.
+
+    :param src: path to the file to be copied
+    :param dest: full path for the new copy of the file
+    :param algorithms: list of :mod:`hashlib` algorithm names
+    :param threaded: calculate each algorithm in a separate thread;
+        see :class:`MultiHasher`
+    :returns: tuple of size in bytes and a dictionary of hex digests
+        keyed on algorithm name
+    '''
+    hasher = MultiHasher(algorithms, threaded)
+    size = 0
+    try:
+        with open(src, 'rb') as infile:
+            with open(dest, 'wb') as outfile:
+                while True:
+                    block = infile.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    size += len(block)
+                    hasher.update(block)
+                    outfile.write(block)
+    finally:
+        hasher.close()
+    shutil.copystat(src, dest)
+    return size, hasher.hexdigests()
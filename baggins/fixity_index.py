@@ -0,0 +1,150 @@
+'''
+Index of file signatures and verified checksums for incremental fixity
+checking.  For each verified file, the index records the size,
+modification time, and inode the file had when it was checksummed,
+along with the checksums and the time they were verified.
+
+When bags are re-verified, files whose signature has changed (or that
+have never been verified) are always checksummed again.  Files that
+appear unchanged are only re-checksummed on a rolling schedule: each
+run re-checks a sample of them, oldest verification first, so that
+every file is eventually re-read, and any file not verified within
+a maximum age is always re-checked.  This keeps the ongoing cost
+of verification proportional to the amount of change and the sample
+rate, rather than the total size of the archive.
+
+'''
+
+import json
+import math
+import os
+import sqlite3
+import time
+
+
+class FixityIndex(object):
+    '''Index of file signatures and checksums in a sqlite database.
+    Safe to use from multiple processes; each process opens its own
+    database connection.
+
+    :param path: path to the index database file
+    :param sample_rate: fraction of unchanged files to re-checksum on
+        each verification run
+    :param max_age: maximum number of seconds since a file was last
+        checksummed before it is always re-checked; no maximum if None
+    '''
+
+    #: default fraction of unchanged files re-checksummed on each run
+    sample_rate = 0.1
+
+    def __init__(self, path, sample_rate=None, max_age=None):
+        self.path = path
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        self.max_age = max_age
+        self._db = None
+        self._db_pid = None
+
+    def __getstate__(self):
+        # database connections can't be pickled (e.g., when sent to
+        # worker processes); a new connection is opened on first use
+        state = self.__dict__.copy()
+        state['_db'] = None
+        state['_db_pid'] = None
+        return state
+
+    @property
+    def db(self):
+        # database connection, opened on first use in each process
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=30)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+                'size INTEGER, mtime REAL, inode INTEGER, checksums TEXT, '
+                'verified REAL)')
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    @staticmethod
+    def signature(path):
+        '''Signature used to detect changes to a file: tuple of size,
+        modification time, and inode.'''
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime, stat.st_ino
+
+    def _key(self, path):
+        # files are indexed on absolute path, as unicode
+        path = os.path.abspath(path)
+        if isinstance(path, str):
+            path = path.decode('utf-8')
+        return path
+
+    def get(self, path):
+        '''Get the indexed information for a file, as a dictionary with
+        path, size, mtime, inode, checksums, and verified; returns None
+        if the file is not in the index.'''
+        row = self.db.execute('SELECT * FROM files WHERE path = ?',
+                              (self._key(path),)).fetchone()
+        if row is not None:
+            info = dict(zip(row.keys(), row))
+            info['checksums'] = json.loads(info['checksums'])
+            return info
+
+    def stale(self, files):
+        '''Determine which files need to be checksummed.  Files are
+        stale if they are not in the index, their signature has changed,
+        the indexed checksums do not match the expected checksums, or
+        they have not been verified within :attr:`max_age`; a sample of
+        the remaining files (those verified longest ago) is also
+        included, based on :attr:`sample_rate`.
+
+        :param files: dictionary of expected checksums (a dictionary
+            keyed on algorithm) keyed on file path
+        :returns: dictionary of signatures keyed on file path, for
+            the files that should be checksummed; files that can't
+            be accessed are included with a signature of None
+        '''
+        now = time.time()
+        stale = {}
+        unchanged = []
+        for path, expected in files.items():
+            try:
+                signature = self.signature(path)
+            except OSError:
+                stale[path] = None
+                continue
+            info = self.get(path)
+            if info is None or \
+               (info['size'], info['mtime'], info['inode']) != signature or \
+               any(info['checksums'].get(alg) != checksum
+                   for alg, checksum in expected.items()) or \
+               (self.max_age is not None and
+                    now - info['verified'] > self.max_age):
+                stale[path] = signature
+            else:
+                unchanged.append((info['verified'], path, signature))
+
+        # rolling sample of unchanged files, oldest verification first
+        unchanged.sort()
+        sample = int(math.ceil(len(unchanged) * self.sample_rate))
+        for verified, path, signature in unchanged[:sample]:
+            stale[path] = signature
+        return stale
+
+    def update(self, records):
+        '''Record signatures and checksums for files that have been
+        checksummed, in a single transaction.
+
+        :param records: list of tuples of file path, signature (as
+            returned by :meth:`signature`), and checksums
+        '''
+        now = time.time()
+        self.db.executemany(
+            'INSERT OR REPLACE INTO files (path, size, mtime, inode, '
+            'checksums, verified) VALUES (?, ?, ?, ?, ?, ?)',
+            [(self._key(path), size, mtime, inode,
+              json.dumps(checksums, sort_keys=True), now)
+             for path, (size, mtime, inode), checksums in records])
+        self.db.commit()
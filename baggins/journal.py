@@ -0,0 +1,106 @@
+'''
+Job journal for batch bagging runs.  The state of each item is recorded
+in a sqlite database as it is processed, so that an interrupted or
+partially failed run can be resumed without redoing completed bags.
+
+'''
+
+import os
+import sqlite3
+import threading
+import time
+
+
+#: item is queued to be processed
+PENDING = 'pending'
+#: item information is being retrieved
+FETCHING = 'fetching'
+#: payload files are being staged in the bag
+STAGING = 'staging'
+#: payload checksums are being calculated
+HASHING = 'hashing'
+#: bag was created successfully
+DONE = 'done'
+#: bag could not be created
+FAILED = 'failed'
+
+#: all job states, in processing order
+STATES = [PENDING, FETCHING, STAGING, HASHING, DONE, FAILED]
+
+
+class Journal(object):
+    '''Record of the processing state of items in a sqlite database.
+    Safe to use from multiple processes and threads; each process and
+    thread opens its own database connection.
+
+    :param path: path to the journal database file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        # database connection, opened on first use in each process and
+        # thread (sqlite connections can't be shared between threads)
+        local = self._local
+        if getattr(local, 'db', None) is None or local.pid != os.getpid():
+            local.db = sqlite3.connect(self.path, timeout=30)
+            local.db.row_factory = sqlite3.Row
+            local.db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs (item_id TEXT PRIMARY KEY, '
+                'state TEXT, bag TEXT, error TEXT, updated REAL)')
+            local.db.commit()
+            local.pid = os.getpid()
+        return local.db
+
+    def update(self, item_id, state, bag=None, error=None):
+        '''Record the state of an item.  A previously recorded bag path
+        is kept unless a new one is specified; any previous error is
+        cleared.'''
+        if state not in STATES:
+            raise ValueError('Unknown job state %s' % state)
+        item_id = unicode(item_id)
+        self.db.execute(
+            'INSERT OR IGNORE INTO jobs (item_id) VALUES (?)', (item_id,))
+        self.db.execute(
+            'UPDATE jobs SET state = ?, bag = coalesce(?, bag), error = ?, '
+            'updated = ? WHERE item_id = ?',
+            (state, bag, error, time.time(), item_id))
+        self.db.commit()
+
+    def update_all(self, item_ids, state):
+        '''Record the same state for a list of items, in a single
+        transaction.'''
+        if state not in STATES:
+            raise ValueError('Unknown job state %s' % state)
+        now = time.time()
+        item_ids = [unicode(item_id) for item_id in item_ids]
+        self.db.executemany(
+            'INSERT OR IGNORE INTO jobs (item_id) VALUES (?)',
+            [(item_id,) for item_id in item_ids])
+        self.db.executemany(
+            'UPDATE jobs SET state = ?, error = NULL, updated = ? '
+            'WHERE item_id = ?',
+            [(state, now, item_id) for item_id in item_ids])
+        self.db.commit()
+
+    def get(self, item_id):
+        '''Get the recorded state of an item, as a dictionary with
+        item_id, state, bag, error, and updated; returns None if the
+        item is not in the journal.'''
+        row = self.db.execute('SELECT * FROM jobs WHERE item_id = ?',
+                              (unicode(item_id),)).fetchone()
+        if row is not None:
+            return dict(zip(row.keys(), row))
+
+    def items(self, state=None):
+        '''List of recorded items, optionally filtered by state.'''
+        if state is None:
+            rows = self.db.execute('SELECT * FROM jobs ORDER BY item_id')
+        else:
+            rows = self.db.execute(
+                'SELECT * FROM jobs WHERE state = ? ORDER BY item_id',
+                (state,))
+        return [dict(zip(row.keys(), row)) for row in rows]
@@ -13,23 +13,74 @@ Large Scale Digitization Initiative (LSDI) content.
 from cached_property import cached_property
 from eulxml import xmlmap
 import requests
-import pymarc
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from pymarc.marcxml import XmlHandler, parse_xml
 import codecs
+from multiprocessing.pool import ThreadPool
 from pymarc import MARCReader
 import os.path
 import sys
+from urllib import urlencode
 
 
 class Client(object):
     """A simple client to query the Digitization Workflow REST(ish)
     API for information about files associated with LSDI/DigWF items.
 
+    Requests are made through a :class:`requests.Session` with a pool
+    of persistent connections, so repeated lookups reuse connections
+    to the API.  Requests that fail with a connection error or a server
+    error (5xx) are retried with exponential backoff.
+
     :param baseurl: base url of the api for the DigWF REST service., e.g.
                     ``http://my.domain.com/digwf_api/``
+    :param pool_size: number of connections to keep open to the API
+    :param timeout: timeout in seconds for connecting to and reading
+        from the API
+    :param retries: number of times to retry a failed request
+    :param backoff_factor: backoff factor for retries; the delay before
+        each retry is ``backoff_factor * (2 ** (retry number - 1))``
+        seconds
+    :param cache: optional :class:`~baggins.cache.Cache` for API
+        responses; cached responses are used until they expire
     """
 
-    def __init__(self, url):
+    #: default number of pooled connections
+    pool_size = 10
+    #: default timeout in seconds
+    timeout = 30
+    #: default number of retries for failed requests
+    retries = 3
+    #: default backoff factor for retries
+    backoff_factor = 0.5
+    #: response status codes that should be retried
+    retry_status = (500, 502, 503, 504)
+
+    def __init__(self, url, pool_size=None, timeout=None, retries=None,
+                 backoff_factor=None, cache=None):
         self.base_url = url.rstrip('/')
+        self.cache = cache
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if timeout is not None:
+            self.timeout = timeout
+        if retries is not None:
+            self.retries = retries
+        if backoff_factor is not None:
+            self.backoff_factor = backoff_factor
+
+        retry = Retry(total=self.retries, backoff_factor=self.backoff_factor,
+                      status_forcelist=self.retry_status,
+                      # return the last response when retries run out,
+                      # so errors are reported the same way as without
+                      # retries
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def get_items(self, **kwargs):
         '''Query the DigWF API getItems method.  If no search terms
@@ -45,13 +96,122 @@ class Client(object):
         :returns: :class:`Items`
         '''
         url = '%s/getItems' % self.base_url
-        r = requests.get(url, params=kwargs)
+        if self.cache is not None:
+            cache_key = '%s?%s' % (url, urlencode(sorted(kwargs.items())))
+            content = self.cache.get(cache_key)
+            if content is not None:
+                return xmlmap.load_xmlobject_from_string(content, Items)
+
+        r = self.session.get(url, params=kwargs, timeout=self.timeout)
         if r.status_code == requests.codes.ok:
-            return xmlmap.load_xmlobject_from_string(r.content, Items)
+            items = xmlmap.load_xmlobject_from_string(r.content, Items)
+            # don't cache empty results, so that items added to the
+            # DigWF after a failed lookup are found on the next lookup
+            if self.cache is not None and items.count:
+                self.cache.set(cache_key, r.content)
+            return items
         else:
             # raise the error so it can be caught downstream
             r.raise_for_status()
 
+    def get_items_by_id(self, item_ids, max_workers=None):
+        '''Look up a list of items by DigWF item id.  The getItems
+        method only accepts a single item id, so lookups are made as
+        concurrent requests over the pooled session, with at most
+        `max_workers` (by default, the connection pool size) requests
+        in progress at once.
+
+        Ids that do not match exactly one item, or that could not be
+        looked up due to an error, are not included in the result,
+        so that they can be looked up and reported on individually.
+
+        :param item_ids: list of DigWF item ids
+        :param max_workers: maximum number of concurrent requests
+        :returns: dictionary of :class:`Item` keyed on item id
+        '''
+        item_ids = list(item_ids)
+        if not item_ids:
+            return {}
+
+        def lookup(item_id):
+            try:
+                result = self.get_items(item_id=item_id)
+            except requests.exceptions.RequestException:
+                return item_id, None
+            if result is not None and result.count == 1:
+                return item_id, result.items[0]
+            return item_id, None
+
+        workers = min(max_workers or self.pool_size, len(item_ids))
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(lookup, item_ids)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(lookup, item_ids)
+
+        return dict((item_id, item) for item_id, item in results
+                    if item is not None)
+
+
+#: MARC fields used in generating bags; other fields are not kept when
+#: MARC XML is parsed for an item
+MARC_FIELDS = ['035', '245', '260', '583', '590']
+
+
+class _StopParsing(Exception):
+    # raised to stop parsing once the first MARC record is found
+    pass
+
+
+class FirstRecordHandler(XmlHandler):
+    ''':class:`pymarc.marcxml.XmlHandler` that stops parsing after the
+    first record in a MARC XML file, so that files with many records
+    are not read or held in memory in full.
+
+    :param fields: optional list of MARC tags; if specified, only
+        those fields are kept in the record
+    '''
+
+    def __init__(self, fields=None):
+        XmlHandler.__init__(self)
+        self.fields = fields
+        #: the first record in the file
+        self.record = None
+
+    def endElementNS(self, name, qname):
+        if self.fields is not None and self._field is not None and \
+           name[1] in ('controlfield', 'datafield') and \
+           self._field.tag not in self.fields:
+            # skip fields that were not requested
+            self._field = None
+            self._text = []
+            return
+        XmlHandler.endElementNS(self, name, qname)
+
+    def process_record(self, record):
+        self.record = record
+        raise _StopParsing()
+
+
+def parse_first_marc_record(marc_file, fields=None):
+    '''Parse the first record from a MARC XML file, without reading
+    the rest of the file.
+
+    :param marc_file: file name or file object
+    :param fields: optional list of MARC tags to keep
+    :returns: :class:`pymarc.Record` or None if no record is found
+    '''
+    handler = FirstRecordHandler(fields)
+    try:
+        parse_xml(marc_file, handler)
+    except _StopParsing:
+        pass
+    return handler.record
+
 
 class Item(xmlmap.XmlObject):
     ''':class:`~eulxml.xmlmap.XmlObject` to read Item information returned
@@ -95,17 +255,36 @@ class Item(xmlmap.XmlObject):
     # NOTE: these mappings are incomplete, and only include what was pused
     # for readux page ingest; we will likely need to add more mappings
 
+    #: optional :class:`~baggins.cache.Cache` of parsed MARC records,
+    #: keyed on MARC file path; cached records are used as long as the
+    #: file modification time and size have not changed
+    marc_cache = None
+
     @cached_property
     def marc(self):
         # use pymarc to read the marcxml to make fields available
         if os.path.exists(self.marc_path):
-            # with codecs.open(self.marc_path, 'r', "utf-8") as marcdata:
-            with open(self.marc_path, 'r') as marcdata:
-                # reader = MARCReader(marcdata, utf8_handling='ignore')
-                return pymarc.parse_xml_to_array(marcdata)[0]
+            if self.marc_cache is None:
+                return self.parse_marc()
+
+            stat = os.stat(self.marc_path)
+            cached = self.marc_cache.get(self.marc_path)
+            if cached is not None and \
+               cached[:2] == (stat.st_mtime, stat.st_size):
+                return cached[2]
+            record = self.parse_marc()
+            self.marc_cache.set(self.marc_path,
+                                (stat.st_mtime, stat.st_size, record))
+            return record
         else:
             print "Check if file %s exists or your mount connection" % self.marc_path
 
+    def parse_marc(self):
+        '''Parse the first record in the MARC XML file for this item,
+        keeping only the fields listed in :data:`MARC_FIELDS`.'''
+        with open(self.marc_path, 'r') as marcdata:
+            return parse_first_marc_record(marcdata, MARC_FIELDS)
+
 class Items(xmlmap.XmlObject):
     ''':class:`~eulxml.xmlmap.XmlObject` for the response returned by getItems.
     Has a count of the number of items found, and a list of :class:`Item`
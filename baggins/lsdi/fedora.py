@@ -1,6 +1,31 @@
+import time
+
 from eulfedora.models import DigitalObject, Relation
 from eulfedora.rdfns import relsext
 from cached_property import cached_property
+import requests
+from requests.adapters import HTTPAdapter
+
+#: default number of pooled connections to the repository, which is
+#: also the maximum number of concurrent metadata lookups
+POOL_SIZE = 10
+
+
+def pool_connections(repo, pool_size=None):
+    '''Configure the HTTP session used by a
+    :class:`eulfedora.server.Repository` to keep a pool of `pool_size`
+    persistent connections, so that lookups made concurrently from
+    multiple threads reuse connections instead of opening (and then
+    discarding) new ones.
+
+    :returns: the repository
+    '''
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=pool_size or POOL_SIZE)
+    repo.api.session.mount('http://', adapter)
+    repo.api.session.mount('https://', adapter)
+    return repo
+
 
 # minimual book/volume fedora objects for looking up identifiers
 # and relationships
@@ -52,3 +77,53 @@ class Volume(ArkDigitalObject):
 
     #: :class:`Book` this volume is associated with, via isConstituentOf
     book = Relation(relsext.isConstituentOf, type=Book)
+
+
+class FedoraMonitor(object):
+    '''Keep track of whether the Fedora repository is reachable, without
+    checking for every item.  A successful check is trusted for
+    `interval` seconds; after a failed check, or when a failure is
+    reported via :meth:`failed`, the next call to :meth:`available`
+    checks again.
+
+    :param url: base url for the Fedora repository
+    :param interval: seconds to trust a successful check
+    :param timeout: timeout in seconds for the check request
+    '''
+
+    #: default number of seconds to trust a successful check
+    interval = 600
+    #: default timeout in seconds for the check request
+    timeout = 10
+
+    def __init__(self, url, interval=None, timeout=None):
+        self.url = url
+        if interval is not None:
+            self.interval = interval
+        if timeout is not None:
+            self.timeout = timeout
+        #: time of the last successful check, if any
+        self.last_success = None
+
+    def check(self):
+        '''Check that the repository responds to a request.'''
+        try:
+            requests.head(self.url, timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            self.last_success = None
+            return False
+        self.last_success = time.time()
+        return True
+
+    def available(self):
+        '''Check if the repository is available, using the result of
+        the last successful check if it is recent enough.'''
+        if self.last_success is not None and \
+           time.time() - self.last_success < self.interval:
+            return True
+        return self.check()
+
+    def failed(self):
+        '''Report a connection failure, so that the repository will be
+        checked again before it is next used.'''
+        self.last_success = None
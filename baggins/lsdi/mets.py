@@ -10,9 +10,26 @@ Large Scale Digitization Initiative (LSDI) content.
     to import cover images and selected page images.
 '''
 
+from contextlib import contextmanager
+import os
+
 from eulxml import xmlmap
 from eulxml.xmlmap.core import StringField, IntegerField, NodeListField
+from lxml import etree
+
+from baggins import PACKAGE_DIR
+
+
+# local copies of schemas, so that loading and validating METS
+# does not require network access
+SCHEMA_DIR = os.path.join(PACKAGE_DIR, 'lsdi', 'content', 'schemas')
 
+#: canonical location of the METS schema, for use in xsi:schemaLocation
+METS_SCHEMA_URL = "http://www.loc.gov/standards/mets/mets.xsd"
+#: local copy of the METS schema (which imports a local copy of the
+#: xlink schema); loaded and cached by eulxml the first time a schema
+#: is needed for validation
+METS_SCHEMA = os.path.join(SCHEMA_DIR, 'mets.xsd')
 
 
 
@@ -60,12 +77,9 @@ class METStechMD(xmlmap.XmlObject):
     checksum = StringField('mets:mdWrap/mets:xmlData/mix:mix/mix:BasicDigitalObjectInformation/mix:Fixity/mix:messageDigest')
 
 class Mets(xmlmap.XmlObject):
-    # XSD_SCHEMA = "http://www.loc.gov/standards/mets/mets.xsd"
-    # xmlschema = xmlmap.loadSchema(XSD_SCHEMA)
     ROOT_NAME = 'mets'
     ROOT_NS = "http://www.loc.gov/METS/"
-    XSD_SCHEMA = "http://www.loc.gov/standards/mets/mets.xsd"
-    xmlschema = xmlmap.loadSchema(XSD_SCHEMA)
+    XSD_SCHEMA = METS_SCHEMA
     ROOT_NAMESPACES = {
         'mets': ROOT_NS,
         'xlink' : "http://www.w3.org/1999/xlink",
@@ -87,3 +101,172 @@ class Mets(xmlmap.XmlObject):
     structmap = NodeListField('mets:structMap[@TYPE="physical"]/mets:div[@DMDID="DMD1"][@LABEL=""][@TYPE="volume"]/mets:div', METSMap)
     techmd = NodeListField('mets:amdSec/mets:techMD[starts-with(@ID, "AMD_TECHMD_TIF") or starts-with(@ID, "AMD_TECHMD_JPG") or starts-with(@ID, "AMD_TECHMD_JP2")]', METStechMD)
 
+
+#: METS namespace
+METS_NS = Mets.ROOT_NS
+#: xlink namespace
+XLINK_NS = Mets.ROOT_NAMESPACES['xlink']
+#: XML Schema instance namespace
+XSI_NS = Mets.ROOT_NAMESPACES['xsi']
+#: NISO MIX namespace, for technical metadata
+MIX_NS = METStechMD.ROOT_NAMESPACES['mix']
+
+#: namespaces declared on the root element of a METS document written by
+#: :func:`write_mets`; technical metadata uses the MIX 2.0 namespace
+WRITER_NAMESPACES = dict(Mets.ROOT_NAMESPACES, mix=MIX_NS)
+
+#: checksum algorithms and the corresponding METS CHECKSUMTYPE and MIX
+#: messageDigestAlgorithm values, in order of preference
+CHECKSUM_TYPES = [
+    ('sha512', 'SHA-512'),
+    ('sha256', 'SHA-256'),
+    ('sha1', 'SHA-1'),
+    ('md5', 'MD5'),
+]
+
+
+def preferred_checksum(checksums):
+    '''Choose the checksum to include in METS from a dictionary of
+    checksums keyed on algorithm name, based on :data:`CHECKSUM_TYPES`.
+
+    :returns: tuple of METS checksum type and checksum, or None if none
+        of the algorithms can be represented in METS
+    '''
+    for algorithm, checksum_type in CHECKSUM_TYPES:
+        if checksums.get(algorithm):
+            return checksum_type, checksums[algorithm]
+
+
+class FileInfo(object):
+    '''Information about a file listed in a METS document written by
+    :func:`write_mets`.  Size and checksum are optional; if `admid` is
+    set, the file references technical metadata with that id.'''
+
+    __slots__ = ('id', 'mimetype', 'href', 'size', 'checksum_type',
+                 'checksum', 'admid')
+
+    def __init__(self, id, mimetype, href, size=None, checksum_type=None,
+                 checksum=None, admid=None):
+        self.id = id
+        self.mimetype = mimetype
+        self.href = href
+        self.size = size
+        self.checksum_type = checksum_type
+        self.checksum = checksum
+        self.admid = admid
+
+
+class _IndentingWriter(object):
+    # wrapper around an lxml incremental writer that indents elements
+    # by nesting level as they are written, since xmlfile can't
+    # pretty-print a document it never holds in memory
+
+    indent = '  '
+
+    def __init__(self, xf):
+        self.xf = xf
+        # for each open element, whether it has child elements
+        self.open_elements = []
+
+    @contextmanager
+    def element(self, name, attrib=None, nsmap=None, ns=METS_NS):
+        if self.open_elements:
+            self.open_elements[-1] = True
+            self.xf.write('\n' + self.indent * len(self.open_elements))
+        self.open_elements.append(False)
+        with self.xf.element('{%s}%s' % (ns, name),
+                             dict(attrib or []), nsmap=nsmap):
+            yield
+            if self.open_elements.pop():
+                self.xf.write('\n' + self.indent * len(self.open_elements))
+
+    def text_element(self, name, text, ns=METS_NS):
+        with self.element(name, ns=ns):
+            self.xf.write(unicode(text))
+
+
+def _write_techmd(writer, info):
+    # MIX technical metadata for a single file, with the basic object
+    # information available without reading the file
+    with writer.element('techMD', [('ID', info.admid)]):
+        with writer.element('mdWrap', [('MDTYPE', 'NISOIMG'),
+                                       ('MIMETYPE', 'text/xml')]):
+            with writer.element('xmlData'):
+                with writer.element('mix', ns=MIX_NS):
+                    with writer.element('BasicDigitalObjectInformation',
+                                        ns=MIX_NS):
+                        with writer.element('ObjectIdentifier', ns=MIX_NS):
+                            writer.text_element('objectIdentifierValue',
+                                                info.href, ns=MIX_NS)
+                        if info.size is not None:
+                            writer.text_element('fileSize', info.size,
+                                                ns=MIX_NS)
+                        with writer.element('FormatDesignation', ns=MIX_NS):
+                            writer.text_element('formatName', info.mimetype,
+                                                ns=MIX_NS)
+                        if info.checksum:
+                            with writer.element('Fixity', ns=MIX_NS):
+                                writer.text_element('messageDigestAlgorithm',
+                                                    info.checksum_type,
+                                                    ns=MIX_NS)
+                                writer.text_element('messageDigest',
+                                                    info.checksum, ns=MIX_NS)
+
+
+def write_mets(output, file_groups, pages, techmd=None):
+    '''Write a METS document for a digitized volume, with a file section
+    and a physical struct map, and optionally an administrative section
+    with technical metadata.  The document is written incrementally
+    with :class:`lxml.etree.xmlfile`, so no element tree is built for
+    the whole document and memory use does not grow with the number
+    of files in the volume.
+
+    :param output: file name or file object to write to
+    :param file_groups: list of tuples of file group id and the files in
+        that group, as :class:`FileInfo`
+    :param pages: list of file ids for each page in the struct map, in
+        page order (image, position, and text files)
+    :param techmd: optional list of :class:`FileInfo` with `admid` set,
+        for which MIX technical metadata should be included
+    '''
+    with etree.xmlfile(output) as xf:
+        writer = _IndentingWriter(xf)
+        schema_location = '%s %s' % (METS_NS, METS_SCHEMA_URL)
+        with writer.element('mets', [('{%s}schemaLocation' % XSI_NS,
+                                      schema_location)],
+                            nsmap=WRITER_NAMESPACES):
+            with writer.element('dmdSec', [('ID', 'DMD1')]):
+                pass
+            if techmd:
+                with writer.element('amdSec'):
+                    for info in techmd:
+                        _write_techmd(writer, info)
+            with writer.element('fileSec'):
+                for group_id, files in file_groups:
+                    with writer.element('fileGrp', [('ID', group_id)]):
+                        for info in files:
+                            attrib = [('ID', info.id),
+                                      ('MIMETYPE', info.mimetype)]
+                            if info.size is not None:
+                                attrib.append(('SIZE', str(info.size)))
+                            if info.checksum:
+                                attrib.extend([
+                                    ('CHECKSUM', info.checksum),
+                                    ('CHECKSUMTYPE', info.checksum_type)])
+                            if info.admid:
+                                attrib.append(('ADMID', info.admid))
+                            with writer.element('file', attrib):
+                                with writer.element('FLocat', [
+                                        ('LOCTYPE', 'URL'),
+                                        ('{%s}href' % XLINK_NS, info.href)]):
+                                    pass
+            with writer.element('structMap', [('TYPE', 'physical')]):
+                with writer.element('div', [('DMDID', 'DMD1'), ('LABEL', ''),
+                                            ('TYPE', 'volume')]):
+                    for order, file_ids in enumerate(pages, 1):
+                        with writer.element('div', [('TYPE', 'page'),
+                                                    ('ORDER', str(order))]):
+                            for file_id in file_ids:
+                                with writer.element('fptr',
+                                                    [('FILEID', file_id)]):
+                                    pass
@@ -0,0 +1,225 @@
+'''
+Timing and throughput instrumentation for bag creation.  Each stage of
+creating a bag (staging payload, generating metadata, writing tag files,
+etc.) records wall time, files handled, and bytes read and written, so
+it is possible to tell where the time for a slow bag went.
+
+Stage results are logged as structured ``key=value`` lines on the
+``baggins.metrics`` logger as each stage completes, and metrics for a
+batch run can be written to a JSON file or a Prometheus textfile
+(for the node exporter textfile collector) to compare across runs.
+
+'''
+
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+#: JSON metrics file format
+JSON = 'json'
+#: Prometheus textfile format
+PROMETHEUS = 'prometheus'
+
+#: metrics file formats, keyed on file extension
+FILE_FORMATS = {'.json': JSON, '.prom': PROMETHEUS}
+
+#: prefix for Prometheus metric names
+PROMETHEUS_PREFIX = 'baggins'
+
+
+def directory_totals(path):
+    '''Number of files and total size of all files under a directory.'''
+    files = size = 0
+    for root, dirs, filenames in os.walk(path):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+    return files, size
+
+
+class StageMetrics(object):
+    '''Metrics for a single stage of bag creation.
+
+    :param name: stage name
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        #: wall time in seconds
+        self.seconds = 0
+        #: number of files handled
+        self.files = 0
+        #: bytes read
+        self.bytes_read = 0
+        #: bytes written
+        self.bytes_written = 0
+
+    @property
+    def mb_per_sec(self):
+        '''Throughput in MB per second, based on the larger of bytes
+        read or written.'''
+        if not self.seconds:
+            return 0
+        return max(self.bytes_read, self.bytes_written) / \
+            self.seconds / (1024 * 1024)
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'seconds': round(self.seconds, 6),
+            'files': self.files,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'mb_per_sec': round(self.mb_per_sec, 2)
+        }
+
+
+class BagMetrics(object):
+    '''Metrics for the stages of creating a single bag.
+
+    :param bag: bag name, included in log lines and metrics files
+    '''
+
+    def __init__(self, bag=None):
+        self.bag = bag
+        #: list of :class:`StageMetrics`, in the order completed
+        self.stages = []
+        self.start = time.time()
+        #: total wall time, set by :meth:`finish`
+        self.seconds = None
+
+    @contextmanager
+    def stage(self, name):
+        '''Context manager to time a stage of bag creation.  Yields a
+        :class:`StageMetrics` so that files and bytes handled can be
+        recorded; the stage is logged when it completes, including
+        on error.'''
+        stage = StageMetrics(name)
+        start = time.time()
+        try:
+            yield stage
+        finally:
+            stage.seconds = time.time() - start
+            self.stages.append(stage)
+            logger.info(self.log_line(stage))
+
+    def log_line(self, stage):
+        '''Structured log line for a stage.'''
+        return 'bag=%s stage=%s seconds=%.3f files=%d bytes_read=%d ' \
+            'bytes_written=%d mb_per_sec=%.2f' % \
+            (self.bag, stage.name, stage.seconds, stage.files,
+             stage.bytes_read, stage.bytes_written, stage.mb_per_sec)
+
+    def finish(self):
+        '''Record the total time for bag creation.'''
+        self.seconds = time.time() - self.start
+        logger.info('bag=%s stage=total seconds=%.3f files=%d bytes_read=%d '
+                    'bytes_written=%d', self.bag, self.seconds,
+                    self.total('files'), self.total('bytes_read'),
+                    self.total('bytes_written'))
+
+    def total(self, attr):
+        '''Total of a stage attribute (e.g. bytes_read) for all stages.'''
+        return sum(getattr(stage, attr) for stage in self.stages)
+
+    def as_dict(self):
+        seconds = self.seconds
+        if seconds is None:
+            seconds = self.total('seconds')
+        return {
+            'bag': self.bag,
+            'seconds': round(seconds, 6),
+            'stages': [stage.as_dict() for stage in self.stages]
+        }
+
+
+def _write_file(path, content):
+    # write to a temporary file and rename, so a partially written file
+    # is never read (e.g., by the Prometheus textfile collector)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as outfile:
+        outfile.write(content)
+    os.rename(tmp_path, path)
+
+
+def write_json(path, bags):
+    '''Write metrics for a run as JSON.
+
+    :param path: output file
+    :param bags: list of bag metrics, as returned by
+        :meth:`BagMetrics.as_dict`
+    '''
+    _write_file(path, json.dumps({
+        'created': datetime.now().isoformat(),
+        'bags': bags
+    }, indent=2, sort_keys=True))
+
+
+def _prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+                     .replace('\n', '\\n')
+
+
+def write_prometheus(path, bags):
+    '''Write metrics for a run in the Prometheus text exposition format,
+    as totals for each stage across all bags in the run (per-bag labels
+    would create a new time series for every bag).
+
+    :param path: output file
+    :param bags: list of bag metrics, as returned by
+        :meth:`BagMetrics.as_dict`
+    '''
+    totals = {}
+    for bag in bags:
+        for stage in bag['stages']:
+            stage_totals = totals.setdefault(stage['stage'], {
+                'seconds': 0, 'files': 0, 'bytes_read': 0,
+                'bytes_written': 0})
+            for key in stage_totals:
+                stage_totals[key] += stage[key]
+
+    lines = []
+    metrics = [
+        ('stage_seconds', 'seconds', 'Wall time spent in each bag creation stage'),
+        ('stage_files', 'files', 'Files handled in each bag creation stage'),
+        ('stage_read_bytes', 'bytes_read', 'Bytes read in each bag creation stage'),
+        ('stage_written_bytes', 'bytes_written', 'Bytes written in each bag creation stage'),
+    ]
+    for name, key, description in metrics:
+        name = '%s_%s' % (PROMETHEUS_PREFIX, name)
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s gauge' % name)
+        for stage in sorted(totals):
+            lines.append('%s{stage="%s"} %s' % (
+                name, _prometheus_label(stage), totals[stage][key]))
+
+    name = '%s_bags' % PROMETHEUS_PREFIX
+    lines.extend(['# HELP %s Bags created in the run' % name,
+                  '# TYPE %s gauge' % name,
+                  '%s %d' % (name, len(bags))])
+    name = '%s_bag_seconds' % PROMETHEUS_PREFIX
+    lines.extend(['# HELP %s Total wall time for creating bags in the run' % name,
+                  '# TYPE %s gauge' % name,
+                  '%s %s' % (name, sum(bag['seconds'] for bag in bags))])
+    name = '%s_run_timestamp_seconds' % PROMETHEUS_PREFIX
+    lines.extend(['# HELP %s Time the run metrics were written' % name,
+                  '# TYPE %s gauge' % name,
+                  '%s %d' % (name, time.time())])
+    _write_file(path, '\n'.join(lines) + '\n')
+
+
+def write_metrics(path, bags, file_format=None):
+    '''Write metrics for a run, in JSON or Prometheus format based on
+    the file extension (.json or .prom) if no format is specified.'''
+    if file_format is None:
+        file_format = FILE_FORMATS.get(os.path.splitext(path)[1], JSON)
+    if file_format == PROMETHEUS:
+        write_prometheus(path, bags)
+    else:
+        write_json(path, bags)
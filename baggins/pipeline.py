@@ -0,0 +1,145 @@
+'''
+Staged processing pipeline.  Work items pass through a sequence of
+stages, each with its own pool of worker threads, connected by bounded
+queues; while one item is in a slow stage (e.g., checksumming payload),
+the next items are already moving through the earlier stages (e.g.,
+fetching metadata and staging files), and each stage can be sized for
+the resource it is limited by (network, storage, or CPU).
+
+Bounded queues provide back-pressure: when a later stage falls behind,
+earlier stages block rather than piling up work (and, for bagging,
+staged payload on disk).
+
+'''
+
+import logging
+from Queue import Queue
+import sys
+import threading
+import traceback
+
+
+logger = logging.getLogger(__name__)
+
+# marks the end of the work items on a queue
+_DONE = object()
+
+
+class Stage(object):
+    '''A single stage of a :class:`Pipeline`.
+
+    :param name: stage name, used in error reporting and thread names
+    :param func: function to be called with each :class:`Job`; can
+        store results for later stages as attributes on the job
+    :param workers: number of worker threads for this stage
+    '''
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers or 1)
+
+
+class Job(object):
+    '''A work item moving through a :class:`Pipeline`.  Stage functions
+    can set attributes on the job to pass results to later stages.
+
+    :param item: the work item
+    '''
+
+    def __init__(self, item):
+        self.item = item
+        #: exception raised by a stage, if any; stages after an error
+        #: are skipped
+        self.error = None
+        #: name of the stage where the error occurred
+        self.failed_stage = None
+        #: formatted traceback for the error
+        self.traceback = None
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+
+class Pipeline(object):
+    '''Run work items through a sequence of :class:`Stage` objects,
+    each with its own pool of worker threads.
+
+    :param stages: list of :class:`Stage`
+    :param queue_size: maximum number of jobs waiting between two
+        stages; defaults to the number of workers in the next stage
+    '''
+
+    def __init__(self, stages, queue_size=None):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items):
+        '''Process work items through all stages.  Generator that yields
+        each :class:`Job` as it completes the last stage (or fails), in
+        the order the jobs finish.  Errors in a stage are recorded on the
+        job and do not stop the pipeline.'''
+        # one queue in front of each stage; output queue is unbounded
+        # so that finished jobs never block the last stage
+        queues = [Queue(self.queue_size or stage.workers)
+                  for stage in self.stages]
+        queues.append(Queue())
+
+        threads = []
+        for index, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for i in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(stage, queues[index], queues[index + 1],
+                          remaining, lock),
+                    name='%s-%d' % (stage.name, i + 1))
+                threads.append(thread)
+
+        feeder = threading.Thread(target=self._feed, args=(items, queues[0]),
+                                  name='pipeline-feeder')
+        threads.append(feeder)
+        for thread in threads:
+            # don't keep the process alive on interrupt
+            thread.daemon = True
+            thread.start()
+
+        while True:
+            # get with a timeout, so that the main thread can be
+            # interrupted while waiting
+            job = queues[-1].get(True, sys.maxint)
+            if job is _DONE:
+                break
+            yield job
+
+    def _feed(self, items, queue):
+        for item in items:
+            queue.put(Job(item))
+        queue.put(_DONE)
+
+    def _worker(self, stage, inqueue, outqueue, remaining, lock):
+        while True:
+            job = inqueue.get()
+            if job is _DONE:
+                # leave the marker for the other workers in this stage
+                inqueue.put(_DONE)
+                break
+            if not job.failed:
+                try:
+                    stage.func(job)
+                except Exception as err:
+                    job.error = err
+                    job.failed_stage = stage.name
+                    job.traceback = traceback.format_exc()
+                    logger.debug('Error in stage %s for %s: %s',
+                                 stage.name, job.item, err)
+            outqueue.put(job)
+
+        # the last worker to finish passes the marker to the next stage
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            outqueue.put(_DONE)
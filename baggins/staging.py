@@ -0,0 +1,170 @@
+'''
+Strategies for staging payload files into a bag directory.
+
+When the source content and the bag output are on the same filesystem,
+payload files can be hard linked or (on filesystems that support it,
+such as XFS or btrfs) reflinked instead of copied.  Otherwise, content
+can be copied by the kernel with `copy_file_range` or `sendfile`, or
+copied normally, which allows checksums to be calculated as the
+content is copied.  When a strategy is not possible for a file, the
+next strategy in :data:`STRATEGIES` is tried.
+
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+
+from baggins import fixity
+
+
+#: hard link payload files to the source content (payload files and source
+#: files will share permissions and content)
+HARDLINK = 'hardlink'
+#: copy-on-write clone of the source content
+REFLINK = 'reflink'
+#: copy content within the kernel, via copy_file_range or sendfile
+KERNEL = 'kernel'
+#: copy content normally
+COPY = 'copy'
+
+#: available staging strategies, in fallback order
+STRATEGIES = [HARDLINK, REFLINK, KERNEL, COPY]
+
+#: ioctl request to clone a file (FICLONE, from linux/fs.h)
+FICLONE = 0x40049409
+
+#: maximum number of bytes to request per kernel copy call
+KERNEL_COPY_CHUNK = 64 * 1024 * 1024
+
+
+def _libc_function(name, restype, argtypes):
+    # load a libc function via ctypes, if available on this platform
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+_copy_file_range = _libc_function(
+    'copy_file_range', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+     ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _libc_function(
+    'sendfile', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+
+
+def hardlink(src, dest):
+    '''Stage a file by creating a hard link to it.'''
+    os.link(src, dest)
+
+
+def reflink(src, dest):
+    '''Stage a file by cloning it (copy-on-write), on filesystems that
+    support it.'''
+    with open(src, 'rb') as infile:
+        with open(dest, 'wb') as outfile:
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+    shutil.copystat(src, dest)
+
+
+def _kernel_copy_fd(copy_func, infd, outfd, size):
+    remaining = size
+    while remaining > 0:
+        copied = copy_func(infd, outfd, min(remaining, KERNEL_COPY_CHUNK))
+        if copied < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if copied == 0:
+            break
+        remaining -= copied
+
+
+def kernel_copy(src, dest):
+    '''Stage a file by copying it within the kernel, using
+    `copy_file_range` if available and `sendfile` otherwise, so that
+    content does not have to be read into user space.'''
+    copy_funcs = []
+    if _copy_file_range is not None:
+        copy_funcs.append(lambda infd, outfd, count:
+                          _copy_file_range(infd, None, outfd, None, count, 0))
+    if _sendfile is not None:
+        copy_funcs.append(lambda infd, outfd, count:
+                          _sendfile(outfd, infd, None, count))
+    if not copy_funcs:
+        raise OSError(errno.ENOSYS, 'Kernel copy is not supported')
+
+    with open(src, 'rb') as infile:
+        size = os.fstat(infile.fileno()).st_size
+        with open(dest, 'wb') as outfile:
+            for copy_func in copy_funcs:
+                try:
+                    _kernel_copy_fd(copy_func, infile.fileno(),
+                                    outfile.fileno(), size)
+                    break
+                except OSError as err:
+                    # copy_file_range is not supported across filesystems
+                    # on older kernels; try sendfile if nothing was copied
+                    copied = os.lseek(infile.fileno(), 0, os.SEEK_CUR)
+                    if copy_func is copy_funcs[-1] or copied or \
+                       err.errno not in (errno.ENOSYS, errno.EXDEV,
+                                         errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+    shutil.copystat(src, dest)
+
+
+_staging_methods = {
+    HARDLINK: hardlink,
+    REFLINK: reflink,
+    KERNEL: kernel_copy,
+}
+
+
+def stage_file(src, dest, strategy=COPY, algorithms=None, threaded=False):
+    '''Stage a file at the specified destination using the requested
+    strategy.  If the strategy is not possible (e.g., source and
+    destination are on different filesystems for a hard link), the next
+    strategy in :data:`STRATEGIES` is tried, ending with a plain copy.
+
+    When the file is copied normally and checksum algorithms are
+    specified, checksums are calculated as the file is copied.
+
+    :param src: path to the file to be staged
+    :param dest: full path for the staged file
+    :param strategy: one of :data:`STRATEGIES`
+    :param algorithms: optional list of :mod:`hashlib` algorithm names
+    :param threaded: calculate each checksum algorithm in a separate
+        thread; see :class:`baggins.fixity.MultiHasher`
+    :returns: tuple of the strategy used, size in bytes, and dictionary
+        of checksums keyed on algorithm (None if the file was not copied
+        or no algorithms were requested)
+    '''
+    if strategy not in STRATEGIES:
+        raise ValueError('Unknown staging strategy %s' % strategy)
+
+    for method in STRATEGIES[STRATEGIES.index(strategy):]:
+        if method == COPY:
+            break
+        try:
+            _staging_methods[method](src, dest)
+            return method, os.stat(dest).st_size, None
+        except EnvironmentError:
+            # not possible for this file; remove anything partially
+            # staged and fall back to the next strategy
+            if os.path.lexists(dest):
+                os.remove(dest)
+
+    if algorithms:
+        size, checksums = fixity.copy_and_hash(src, dest, algorithms,
+                                               threaded)
+        return COPY, size, checksums
+
+    shutil.copy2(src, dest)
+    return COPY, os.stat(dest).st_size, None
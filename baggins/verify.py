@@ -0,0 +1,540 @@
+'''
+Verification of existing bags, either bag directories or serialized bags
+(as created by :meth:`baggins.baggers.bag.Baggee.create_bag`).
+
+Each bag is checked in two passes.  The first is cheap and only looks at
+file listings and sizes: the Payload-Oxum declared in bag-info.txt is
+compared with the payload actually present, and manifests are checked
+for missing or unlisted payload files.  Only if that passes is the full
+fixity check run, which reads each file once and calculates checksums
+for all of the manifest algorithms from that single read.  Files in a
+bag directory are checksummed by a pool of threads; several bags can
+be verified at once by a pool of worker processes.
+
+Bag directories can also be verified incrementally, using a
+:class:`~baggins.fixity_index.FixityIndex` to skip re-reading files
+that are unchanged since they were last verified (apart from a rolling
+sample of them on each run).
+
+'''
+
+import argparse
+from datetime import datetime
+import hashlib
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import sys
+import tarfile
+import time
+import zipfile
+
+from baggins import fixity
+from baggins.fixity_index import FixityIndex
+
+
+#: bag has a file listed in a manifest that is not present
+MISSING = 'missing'
+#: bag has a payload file that is not listed in a manifest
+UNLISTED = 'unlisted'
+#: payload size or file count does not match the Payload-Oxum
+OXUM = 'oxum'
+#: file content does not match the manifest checksum
+CHECKSUM = 'checksum'
+#: bag could not be read or is not structured as a bag
+INVALID = 'invalid'
+
+#: manifest and tag manifest file names, with the algorithm
+MANIFEST_RE = re.compile(r'^(tag)?manifest-(\w+)\.txt$')
+
+
+class VerificationError(Exception):
+    '''Bag could not be verified because it is unreadable or is not
+    structured as a bag.'''
+    pass
+
+
+def decode_path(path):
+    '''Decode line breaks encoded in a manifest file path.'''
+    return path.replace('%0D', '\r').replace('%0A', '\n')
+
+
+def parse_manifest(content):
+    '''Parse the content of a bagit manifest file.
+
+    :returns: dictionary of checksums keyed on bag-relative path
+    '''
+    checksums = {}
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            checksum, path = line.split(None, 1)
+        except ValueError:
+            raise VerificationError('Invalid manifest line: %s' % line)
+        # ignore the binary mode indicator used by md5sum and friends
+        path = decode_path(path.lstrip('*'))
+        checksums[os.path.normpath(path).replace(os.sep, '/')] = \
+            checksum.lower()
+    return checksums
+
+
+def parse_tags(content):
+    '''Parse the content of a bagit tag file such as bag-info.txt.
+
+    :returns: dictionary of lists of values keyed on tag name
+    '''
+    tags = {}
+    tag = None
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        if line[0] in ' \t' and tag is not None:
+            # continuation of the previous value
+            tags[tag][-1] += ' ' + line.strip()
+            continue
+        tag, _, value = line.partition(':')
+        tag = tag.strip()
+        tags.setdefault(tag, []).append(value.strip())
+    return tags
+
+
+class BagDirectory(object):
+    '''Access to the files in a bag directory.
+
+    :param path: path to the bag directory
+    :param threads: number of threads used to checksum files
+    '''
+
+    def __init__(self, path, threads=1):
+        self.path = path
+        self.threads = threads
+
+    def files(self):
+        '''Sizes of all files in the bag, keyed on bag-relative path.'''
+        files = {}
+        for root, dirs, filenames in os.walk(self.path):
+            for filename in filenames:
+                fullpath = os.path.join(root, filename)
+                relpath = os.path.relpath(fullpath, self.path)
+                files[relpath.replace(os.sep, '/')] = \
+                    os.path.getsize(fullpath)
+        return files
+
+    def read(self, relpath):
+        '''Content of a (small) file in the bag.'''
+        with open(os.path.join(self.path, relpath), 'rb') as tagfile:
+            return tagfile.read()
+
+    def checksum(self, files):
+        '''Calculate checksums for files in the bag, reading each file
+        once regardless of how many algorithms are requested.
+
+        :param files: dictionary of algorithm lists keyed on
+            bag-relative path
+        :returns: generator of tuples of path and a dictionary of hex
+            digests keyed on algorithm name; digests are None if the
+            file could not be read
+        '''
+        def checksum(relpath):
+            try:
+                size, checksums = fixity.hash_file(
+                    os.path.join(self.path, relpath), files[relpath])
+            except EnvironmentError:
+                checksums = None
+            return relpath, checksums
+
+        paths = sorted(files.keys())
+        if self.threads > 1 and len(paths) > 1:
+            pool = ThreadPool(min(self.threads, len(paths)))
+            try:
+                for result in pool.imap(checksum, paths):
+                    yield result
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for relpath in paths:
+                yield checksum(relpath)
+
+
+class BagArchive(object):
+    '''Access to the files in a serialized bag (tar, tar.gz, or zip
+    archive).  Archives are read sequentially: the first pass lists
+    files and reads the tag files, and payload files are checksummed
+    as a single stream.
+
+    :param path: path to the archive file
+    :param threads: if more than one, calculate each checksum algorithm
+        in a separate thread
+    '''
+
+    def __init__(self, path, threads=1):
+        self.path = path
+        self.threads = threads
+        self.is_zip = zipfile.is_zipfile(path)
+        if not self.is_zip and not tarfile.is_tarfile(path):
+            raise VerificationError('%s is not a bag directory or a '
+                                    'tar or zip file' % path)
+        self._files = None
+        self._tags = {}
+
+    def _members(self):
+        # generator of bag-relative path, size, and a function to open
+        # the content, for each file in the archive; content must be
+        # read before moving on to the next file
+        if self.is_zip:
+            zfile = zipfile.ZipFile(self.path)
+            try:
+                for info in zfile.infolist():
+                    if not info.filename.endswith('/'):
+                        yield info.filename, info.file_size, \
+                            lambda: zfile.open(info)
+            finally:
+                zfile.close()
+        else:
+            with tarfile.open(self.path) as tar:
+                for member in tar:
+                    if member.isfile():
+                        yield member.name, member.size, \
+                            lambda: tar.extractfile(member)
+
+    def _relpath(self, name):
+        # archive member path relative to the top-level bag directory
+        parts = name.lstrip('/').split('/', 1)
+        if len(parts) != 2:
+            raise VerificationError('%s is not in a bag directory' % name)
+        return parts[1]
+
+    def files(self):
+        '''Sizes of all files in the bag, keyed on bag-relative path.
+        Content of tag files (any file not in the payload directory)
+        is read and kept for :meth:`read`.'''
+        if self._files is None:
+            self._files = {}
+            for name, size, open_member in self._members():
+                relpath = self._relpath(name)
+                self._files[relpath] = size
+                if not relpath.startswith('data/'):
+                    self._tags[relpath] = open_member().read()
+        return self._files
+
+    def read(self, relpath):
+        '''Content of a tag file in the bag.'''
+        self.files()
+        if relpath not in self._tags:
+            raise VerificationError('%s not found' % relpath)
+        return self._tags[relpath]
+
+    def checksum(self, files):
+        '''Calculate checksums for files in the bag; see
+        :meth:`BagDirectory.checksum`.  Results are generated in
+        archive order.'''
+        self.files()
+        for relpath in sorted(files.keys()):
+            if relpath in self._tags:
+                hasher = fixity.MultiHasher(files[relpath])
+                hasher.update(self._tags[relpath])
+                yield relpath, hasher.hexdigests()
+
+        for name, size, open_member in self._members():
+            relpath = self._relpath(name)
+            if relpath not in files or relpath in self._tags:
+                continue
+            hasher = fixity.MultiHasher(files[relpath], self.threads > 1)
+            try:
+                member = open_member()
+                while True:
+                    block = member.read(fixity.BLOCK_SIZE)
+                    if not block:
+                        break
+                    hasher.update(block)
+            finally:
+                hasher.close()
+            yield relpath, hasher.hexdigests()
+
+
+def open_bag(path, threads=1):
+    '''Open a bag directory or serialized bag for verification.'''
+    if os.path.isdir(path):
+        return BagDirectory(path, threads)
+    if not os.path.exists(path):
+        raise VerificationError('%s does not exist' % path)
+    return BagArchive(path, threads)
+
+
+def verify_bag(path, threads=1, fast=False, index=None):
+    '''Verify a bag directory or serialized bag.  Payload-Oxum and
+    manifest completeness are checked first; if those pass (and
+    `fast` is not requested), checksums are verified for all files
+    listed in manifests and tag manifests.
+
+    :param path: path to the bag directory or archive file
+    :param threads: number of threads used to checksum files
+    :param fast: only check Payload-Oxum and manifest completeness
+    :param index: optional :class:`~baggins.fixity_index.FixityIndex`;
+        if specified, files in a bag directory that are unchanged since
+        they were last verified are only checksummed when sampled, and
+        the index is updated with the checksums calculated
+    :returns: dictionary with verification results, including
+        `valid` and a list of `errors`
+    '''
+    start = time.time()
+    result = {'bag': path, 'valid': False, 'fixity': False,
+              'files': 0, 'bytes': 0, 'oxum': None, 'checked': 0,
+              'skipped': 0, 'errors': []}
+    errors = result['errors']
+    try:
+        bag = open_bag(path, threads)
+        files = bag.files()
+        if 'bagit.txt' not in files:
+            raise VerificationError('bagit.txt not found')
+
+        manifests = {}
+        tagmanifests = {}
+        for relpath in files:
+            match = MANIFEST_RE.match(relpath)
+            if match:
+                algorithm = match.group(2)
+                try:
+                    hashlib.new(algorithm)
+                except ValueError:
+                    raise VerificationError(
+                        'Unsupported checksum algorithm %s' % algorithm)
+                entries = parse_manifest(bag.read(relpath))
+                if match.group(1):
+                    tagmanifests[algorithm] = entries
+                else:
+                    manifests[algorithm] = entries
+        if not manifests:
+            raise VerificationError('No payload manifest found')
+
+        # cheap pass: payload oxum and manifest completeness
+        payload = dict((relpath, size) for relpath, size in files.items()
+                       if relpath.startswith('data/'))
+        result['files'] = len(payload)
+        result['bytes'] = sum(payload.values())
+        found_oxum = '%d.%d' % (result['bytes'], result['files'])
+        info = {}
+        if 'bag-info.txt' in files:
+            info = parse_tags(bag.read('bag-info.txt'))
+        oxum = info.get('Payload-Oxum', [None])[0]
+        result['oxum'] = oxum
+        if oxum is not None and oxum != found_oxum:
+            errors.append({'error': OXUM, 'expected': oxum,
+                           'found': found_oxum})
+
+        expected = {}
+        for entries in manifests.values() + tagmanifests.values():
+            for relpath in entries:
+                if relpath not in files and relpath not in expected:
+                    errors.append({'error': MISSING, 'path': relpath})
+                expected.setdefault(relpath, {})
+        for relpath in sorted(payload):
+            for algorithm in sorted(manifests):
+                if relpath not in manifests[algorithm]:
+                    errors.append({'error': UNLISTED, 'path': relpath,
+                                   'algorithm': algorithm})
+
+        if not errors and not fast:
+            # full fixity check, reading each file only once
+            for algorithm, entries in manifests.items() + \
+                    tagmanifests.items():
+                for relpath, checksum in entries.items():
+                    expected[relpath][algorithm] = checksum
+            to_check = dict((relpath, sorted(checksums.keys()))
+                            for relpath, checksums in expected.items())
+
+            signatures = None
+            if index is not None and isinstance(bag, BagDirectory):
+                # only checksum files that are changed or sampled
+                fullpaths = dict((relpath, os.path.join(path, relpath))
+                                 for relpath in to_check)
+                signatures = index.stale(
+                    dict((fullpaths[relpath], expected[relpath])
+                         for relpath in to_check))
+                for relpath in fullpaths:
+                    if fullpaths[relpath] not in signatures:
+                        del to_check[relpath]
+                        result['skipped'] += 1
+            result['checked'] = len(to_check)
+
+            verified = []
+            for relpath, checksums in bag.checksum(to_check):
+                if checksums is None:
+                    errors.append({'error': MISSING, 'path': relpath})
+                    continue
+                if signatures is not None and \
+                   signatures[fullpaths[relpath]] is not None:
+                    verified.append((fullpaths[relpath],
+                                     signatures[fullpaths[relpath]],
+                                     checksums))
+                for algorithm, checksum in sorted(checksums.items()):
+                    if checksum != expected[relpath][algorithm]:
+                        errors.append({
+                            'error': CHECKSUM, 'path': relpath,
+                            'algorithm': algorithm,
+                            'expected': expected[relpath][algorithm],
+                            'found': checksum})
+            if verified:
+                index.update(verified)
+            result['fixity'] = True
+
+    except (VerificationError, EnvironmentError, tarfile.TarError,
+            zipfile.BadZipfile) as err:
+        errors.append({'error': INVALID, 'message': str(err)})
+
+    result['valid'] = not errors
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+def _verify_bag_worker(args):
+    # verify a single bag in a worker process
+    path, threads, fast, index = args
+    return verify_bag(path, threads, fast, index)
+
+
+def verify_bags(paths, jobs=1, threads=1, fast=False, index=None):
+    '''Verify a list of bags, using a pool of `jobs` worker processes
+    to verify several bags at once.  See :meth:`verify_bag` for
+    the other options.
+
+    :returns: generator of verification results (see :meth:`verify_bag`)
+        in the same order as the requested bags
+    '''
+    if jobs <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield verify_bag(path, threads, fast, index)
+        return
+
+    pool = multiprocessing.Pool(min(jobs, len(paths)))
+    try:
+        for result in pool.imap(_verify_bag_worker,
+                                [(path, threads, fast, index)
+                                 for path in paths]):
+            yield result
+    except BaseException:
+        # includes interrupts, and GeneratorExit when the caller stops
+        # consuming results early; stop any bags still being verified
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+class BagVerifier(object):
+    '''Logic for the baggins-verify script.  Handles argument parsing,
+    verifying bags, and writing the verification report.
+    '''
+
+    #: parsed argument options
+    options = argparse.Namespace()
+
+    def get_options(self, args=None):
+        parser = argparse.ArgumentParser(
+            description='''Verify bag directories or serialized bags,
+            and write a JSON report of the results''')
+        parser.add_argument('bags', metavar='BAG', nargs='*',
+                            help='Bag directory or archive file')
+        parser.add_argument('-f', '--file', metavar='FILE',
+                            help='File with a list of bags to verify')
+        parser.add_argument('-o', '--output', metavar='REPORT',
+                            help='File for the JSON report (default: stdout)')
+        parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                            help='Number of bags to verify in parallel (default: %(default)s)')
+        parser.add_argument('-t', '--threads', metavar='N', type=int,
+                            default=4,
+                            help='''Number of threads used to checksum files
+                            in each bag (default: %(default)s)''')
+        parser.add_argument('--fast', action='store_true',
+                            help='''Only check Payload-Oxum and manifest
+                            completeness, without verifying checksums''')
+        parser.add_argument('-v', '--verbose', action='store_true',
+                            help='Report progress for each bag')
+
+        index_args = parser.add_argument_group(
+            'Incremental verification options')
+        index_args.add_argument(
+            '--index', metavar='FILE',
+            help='''Fixity index file; files in bag directories that are
+            unchanged since they were last verified are only
+            re-checksummed when sampled''')
+        index_args.add_argument(
+            '--sample-rate', metavar='FRACTION', type=float,
+            default=FixityIndex.sample_rate, dest='sample_rate',
+            help='''Fraction of unchanged files to re-checksum on each run,
+            least recently verified first (default: %(default)s)''')
+        index_args.add_argument(
+            '--max-age', metavar='DAYS', type=float, dest='max_age',
+            help='''Always re-checksum files not verified within this
+            many days''')
+        self.options = parser.parse_args(args)
+
+        if self.options.file:
+            with open(self.options.file) as bagfile:
+                self.options.bags.extend(line.strip() for line in bagfile
+                                         if line.strip())
+        if not self.options.bags:
+            parser.error('Please specify at least one bag to verify')
+
+    def run(self, args=None):
+        self.get_options(args)
+        report = self.verify()
+        self.write_report(report)
+        sys.exit(0 if report['summary']['invalid'] == 0 else 1)
+
+    def verify(self):
+        '''Verify all requested bags.
+
+        :returns: report dictionary, with results for each bag and
+            an overall summary
+        '''
+        start = time.time()
+        report = {'created': datetime.now().isoformat(), 'bags': []}
+        for result in verify_bags(self.options.bags, self.options.jobs,
+                                  self.options.threads, self.options.fast,
+                                  self.fixity_index()):
+            report['bags'].append(result)
+            if self.options.verbose:
+                sys.stderr.write('%s %s\n' % (
+                    'valid' if result['valid'] else 'INVALID', result['bag']))
+
+        results = report['bags']
+        report['summary'] = {
+            'bags': len(results),
+            'valid': len([r for r in results if r['valid']]),
+            'invalid': len([r for r in results if not r['valid']]),
+            'files': sum(r['files'] for r in results),
+            'bytes': sum(r['bytes'] for r in results),
+            'checked': sum(r['checked'] for r in results),
+            'skipped': sum(r['skipped'] for r in results),
+            'seconds': round(time.time() - start, 3),
+        }
+        return report
+
+    def fixity_index(self):
+        '''Initialize the fixity index for incremental verification,
+        if one is configured.'''
+        path = getattr(self.options, 'index', None)
+        if not path:
+            return None
+        max_age = getattr(self.options, 'max_age', None)
+        if max_age is not None:
+            max_age = max_age * 24 * 60 * 60
+        return FixityIndex(path, getattr(self.options, 'sample_rate', None),
+                           max_age)
+
+    def write_report(self, report):
+        '''Write the report as JSON to the output file or stdout.'''
+        if self.options.output:
+            with open(self.options.output, 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+        else:
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
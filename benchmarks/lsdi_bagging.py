@@ -0,0 +1,593 @@
+#!/usr/bin/env python
+'''
+Benchmarks for bagging LSDI volumes.
+
+Generates synthetic LSDI volumes (page images, text and position files,
+PDF, OCR xml, and a MARC xml record) at several page counts and page
+image sizes, and times each stage of bagging them.  The Digitization
+Workflow API is replaced by a local HTTP server returning stub item
+information, and Fedora by an in-memory stand-in, so results do not
+depend on network services.
+
+Results are written as JSON, and can be compared with the results of
+an earlier run (e.g., from a previous release)::
+
+    pip install -e .
+    python benchmarks/lsdi_bagging.py --pages 10,100 --page-size 64K,1M \\
+        -o results.json
+    python benchmarks/lsdi_bagging.py --pages 10,100 --page-size 64K,1M \\
+        --compare results.json
+
+Stages timed for each volume:
+
+* fetch: look up the item via the DigWF API client and parse the MARC
+* discovery: find the payload files for the volume
+* file_title: generate the bag file title (repeated, see --iterations)
+* staging: stage payload files in a bag (using the --staging strategy;
+  copied files are checksummed as they are staged)
+* hashing: checksum all payload files
+* mets: generate METS content metadata
+* tags: write bagit tag files, manifests, and metadata
+* create_bag: create a complete bag
+
+'''
+
+import argparse
+import BaseHTTPServer
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+from baggins import __version__, archive, fixity, staging
+from baggins.baggers.lsdi import LsdiBaggee
+from baggins.lsdi import digwf
+
+
+#: stages timed for each volume, in order
+STAGES = ['fetch', 'discovery', 'file_title', 'staging', 'hashing', 'mets',
+          'tags', 'create_bag']
+
+#: size of the block of random content used to fill page images
+FILL_BLOCK_SIZE = 1024 * 1024
+
+#: DigWF getItems response for a single item
+ITEM_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<items version="2.0" count="1">
+  <item pid="%(pid)s" barcode="%(barcode)s" id="%(item_id)s" control_key="%(control_key)s">
+    <pages_per_image>1</pages_per_image>
+    <volume>v. %(item_id)s</volume>
+    <display_images_path count="%(pages)d">%(output_dir)s</display_images_path>
+    <ocr_files_path count="%(pages)d">%(output_dir)s</ocr_files_path>
+    <pdf_file>%(output_dir)s/Output.pdf</pdf_file>
+    <ocr_file>%(output_dir)s/Output.xml</ocr_file>
+    <marc_file>%(marc_file)s</marc_file>
+    <collection id="10">Atlanta City Directories</collection>
+  </item>
+</items>
+'''
+
+#: DigWF getItems response when no items match
+NO_ITEMS_XML = '<?xml version="1.0" encoding="UTF-8"?>\n<items version="2.0"/>\n'
+
+#: MARC xml record for a synthetic volume
+MARC_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<collection xmlns="http://www.loc.gov/MARC21/slim">
+  <record>
+    <leader>01234nam a2200289Ia 4500</leader>
+    <controlfield tag="001">%(control_key)s</controlfield>
+    <controlfield tag="008">821112s1909    gau           000 0 eng d</controlfield>
+    <datafield tag="035" ind1=" " ind2=" ">
+      <subfield code="a">(OCoLC)%(control_key)s</subfield>
+    </datafield>
+    <datafield tag="245" ind1="0" ind2="0">
+      <subfield code="a">Synthetic benchmark volume %(item_id)s, with a title long enough to be truncated</subfield>
+      <subfield code="b">a generated test record</subfield>
+      <subfield code="c">Emory University Libraries.</subfield>
+    </datafield>
+    <datafield tag="260" ind1=" " ind2=" ">
+      <subfield code="a">Atlanta, Ga. :</subfield>
+      <subfield code="b">Benchmark Press,</subfield>
+      <subfield code="c">1909.</subfield>
+    </datafield>
+    <datafield tag="583" ind1="1" ind2=" ">
+      <subfield code="a">digitized</subfield>
+      <subfield code="c">2010</subfield>
+      <subfield code="x">public domain</subfield>
+    </datafield>
+    <datafield tag="590" ind1=" " ind2=" ">
+      <subfield code="a">Synthetic record for benchmarking.</subfield>
+    </datafield>
+  </record>
+</collection>
+'''
+
+#: little-endian TIFF header, so page images are recognizable as TIFFs
+TIFF_HEADER = 'II*\x00\x08\x00\x00\x00'
+
+
+def parse_size(value):
+    '''Parse a size in bytes, with an optional K, M, or G suffix.'''
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper()
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+
+def parse_list(value, parse=int):
+    '''Parse a comma-separated list of values.'''
+    return [parse(item) for item in value.split(',') if item.strip()]
+
+
+def write_filled(path, size, fill, header=''):
+    '''Write a file of `size` bytes, starting with `header` and filled
+    with repeated `fill` content.'''
+    with open(path, 'wb') as outfile:
+        outfile.write(header[:size])
+        remaining = size - min(len(header), size)
+        while remaining > 0:
+            block = fill[:remaining]
+            outfile.write(block)
+            remaining -= len(block)
+
+
+def make_volume(basedir, item_id, pages, page_size, seed=0):
+    '''Generate a synthetic LSDI volume, in the directory layout used by
+    LSDI content, with `pages` page images of `page_size` bytes plus
+    text and position files for each page.
+
+    :returns: DigWF getItems response xml for the volume
+    '''
+    control_key = 'ocm%08d' % item_id
+    voldir = os.path.join(basedir, '%s-%s' % (control_key, item_id),
+                          control_key)
+    output_dir = os.path.join(voldir, 'Output')
+    os.makedirs(output_dir)
+    rand = random.Random(seed)
+    fill = ''.join(chr(rand.randint(0, 255))
+                   for i in range(min(page_size, FILL_BLOCK_SIZE)))
+    words = ['atlanta', 'directory', 'street', 'avenue', 'residence',
+             'grocer', 'clerk', 'railroad', 'church', 'company']
+
+    for page in range(1, pages + 1):
+        name = os.path.join(output_dir, '%08d' % page)
+        write_filled(name + '.tif', page_size, fill, TIFF_HEADER)
+        text = ' '.join(rand.choice(words) for i in range(400))
+        with open(name + '.txt', 'w') as txtfile:
+            txtfile.write(text)
+        with open(name + '.pos', 'w') as posfile:
+            for i, word in enumerate(text.split()):
+                posfile.write('%d %d %d %d %s\r\n' %
+                              (i % 20 * 100, i / 20 * 40, 90, 30, word))
+
+    write_filled(os.path.join(output_dir, 'Output.pdf'),
+                 pages * max(page_size / 10, 1024), fill, '%PDF-1.4\n')
+    with open(os.path.join(output_dir, 'Output.xml'), 'w') as ocrfile:
+        ocrfile.write('<?xml version="1.0" encoding="UTF-8"?>\n<document>\n')
+        for page in range(1, pages + 1):
+            ocrfile.write('  <page n="%d"/>\n' % page)
+        ocrfile.write('</document>\n')
+
+    marc_file = os.path.join(voldir, '%s_MRC.xml' % control_key)
+    with open(marc_file, 'w') as marc:
+        marc.write(MARC_XML % {'control_key': control_key,
+                               'item_id': item_id})
+
+    return ITEM_XML % {
+        'pid': 'bench%d' % item_id, 'barcode': '%012d' % item_id,
+        'item_id': item_id, 'control_key': control_key, 'pages': pages,
+        'output_dir': output_dir, 'marc_file': marc_file
+    }
+
+
+class DigWFHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Request handler for a local stand-in for the DigWF API; responds
+    to getItems requests by item id from the server's `items`.'''
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path.rstrip('/') != '/getItems':
+            self.send_error(404)
+            return
+        item_id = urlparse.parse_qs(url.query).get('item_id', [None])[0]
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        content = self.server.items.get(item_id, NO_ITEMS_XML)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # don't report every request
+        pass
+
+
+class DigWFServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Local stand-in for the DigWF API, run in a background thread.
+
+    :param latency: seconds to wait before responding, to simulate
+        network and database latency
+    '''
+    daemon_threads = True
+
+    def __init__(self, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           DigWFHandler)
+        #: getItems response xml keyed on item id
+        self.items = {}
+        self.latency = latency
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubFedoraObject(object):
+    '''Stand-in for the Fedora objects used for relationship metadata.'''
+    exists = True
+
+    def __init__(self, pid, label, book=None, collection=None):
+        self.pid = pid
+        self.label = label
+        self.ark = 'ark:/25593/%s' % pid.split(':')[-1]
+        self.ark_uri = 'http://pid.emory.edu/%s' % self.ark
+        self.book = book
+        self.collection = collection
+
+
+class StubRepository(object):
+    '''Stand-in for :class:`eulfedora.server.Repository`; every volume
+    belongs to the same book and collection.
+
+    :param latency: seconds to wait for each object, to simulate
+        Fedora API requests
+    '''
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.collection = StubFedoraObject('emory:benchcoll',
+                                           'Benchmark Collection')
+        self.book = StubFedoraObject('emory:benchbook', 'Benchmark Book',
+                                     collection=self.collection)
+
+    def get_object(self, pid, type=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if pid == self.collection.pid:
+            return self.collection
+        return StubFedoraObject(pid, 'Benchmark Volume', book=self.book)
+
+
+class NullOutput(object):
+    def write(self, content):
+        pass
+
+    def flush(self):
+        pass
+
+
+@contextmanager
+def quiet():
+    '''Suppress anything printed while bagging (e.g., METS output).'''
+    stdout = sys.stdout
+    sys.stdout = NullOutput()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def file_totals(files):
+    '''Number of files and total size for a list of file paths.'''
+    return len(files), sum(os.path.getsize(path) for path in files)
+
+
+class VolumeBenchmark(object):
+    '''Time the stages of bagging a single synthetic volume.
+
+    :param options: parsed benchmark options
+    :param item_id: DigWF item id of the volume
+    :param digwf_url: url for the DigWF API stand-in
+    :param repo: Fedora repository stand-in
+    :param workdir: directory for bags created by the benchmark
+    '''
+
+    def __init__(self, options, item_id, digwf_url, repo, workdir):
+        self.options = options
+        self.item_id = item_id
+        self.digwf_url = digwf_url
+        self.repo = repo
+        self.workdir = workdir
+        self.item = self.fetch()
+
+    def baggee(self):
+        baggee = LsdiBaggee(self.item, self.repo)
+        baggee.staging_strategy = self.options.staging
+        baggee.checksum_workers = self.options.checksum_threads
+        baggee.parallel_digests = self.options.parallel_digests
+        return baggee
+
+    def fetch(self):
+        item = digwf.Client(self.digwf_url).get_items(
+            item_id=self.item_id).items[0]
+        item.marc
+        return item
+
+    def bagdir(self):
+        return tempfile.mkdtemp(dir=self.workdir)
+
+    def time_stage(self, stage):
+        '''Run a stage :attr:`options.repeat` times.
+
+        :returns: dictionary with best time, all run times, and
+            the number of files and bytes handled
+        '''
+        runs = []
+        files = size = 0
+        for i in range(self.options.repeat):
+            # clear shared caches so every run does the same work
+            LsdiBaggee.fedora_cache.clear()
+            setup = getattr(self, 'setup_%s' % stage, lambda: None)()
+            with quiet():
+                start = time.time()
+                result = getattr(self, 'run_%s' % stage)(setup)
+                runs.append(time.time() - start)
+            if result is not None:
+                files, size = result
+            cleanup = getattr(self, 'cleanup_%s' % stage, None)
+            if cleanup is not None:
+                cleanup(setup)
+
+        seconds = min(runs)
+        info = {'seconds': round(seconds, 6),
+                'runs': [round(run, 6) for run in runs]}
+        if files:
+            info['files'] = files
+        if size:
+            info['bytes'] = size
+            if seconds:
+                info['mb_per_sec'] = round(size / seconds / 1024 / 1024, 2)
+        return info
+
+    def run(self):
+        baggee = self.baggee()
+        files, size = file_totals(baggee.data_files())
+        return {
+            'files': files,
+            'bytes': size,
+            'stages': dict((stage, self.time_stage(stage))
+                           for stage in STAGES)
+        }
+
+    # setup, run, and cleanup for each stage; run returns the number
+    # of files and bytes read, where relevant
+
+    def run_fetch(self, setup):
+        self.fetch()
+
+    def run_discovery(self, setup):
+        # files are only listed, not read
+        return len(self.baggee().data_files()), None
+
+    def run_file_title(self, setup):
+        baggee = self.baggee()
+        for i in range(self.options.iterations):
+            baggee.file_title()
+
+    def setup_staging(self):
+        baggee = self.baggee()
+        baggee.data_files()
+        return baggee, self.bagdir()
+
+    def run_staging(self, setup):
+        baggee, bagdir = setup
+        baggee.add_data_files(bagdir)
+        return len(baggee.payload), \
+            sum(info['size'] for info in baggee.payload.values())
+
+    def cleanup_staging(self, setup):
+        shutil.rmtree(setup[1])
+
+    def setup_hashing(self):
+        return self.baggee().data_files()
+
+    def run_hashing(self, data_files):
+        size = 0
+        for path in data_files:
+            size += fixity.hash_file(path, LsdiBaggee.checksum_algorithms,
+                                     self.options.parallel_digests)[0]
+        return len(data_files), size
+
+    def run_mets(self, setup):
+        self.baggee().mets_metadata_info()
+
+    def setup_tags(self):
+        # tag files are generated from payload information, so payload
+        # files don't need to be staged
+        baggee = self.baggee()
+        baggee.payload = dict(
+            ('data/%s' % os.path.basename(path),
+             {'size': os.path.getsize(path),
+              'checksums': dict((alg, '0' * 32)
+                                for alg in baggee.checksum_algorithms)})
+            for path in baggee.data_files())
+        return baggee, self.bagdir()
+
+    def run_tags(self, setup):
+        baggee, bagdir = setup
+        baggee.add_tag_files(bagdir)
+
+    def cleanup_tags(self, setup):
+        shutil.rmtree(setup[1])
+
+    def setup_create_bag(self):
+        baggee = self.baggee()
+        baggee.serialization = self.options.serialize
+        return baggee, self.bagdir()
+
+    def run_create_bag(self, setup):
+        baggee, outdir = setup
+        baggee.create_bag(outdir)
+        return len(baggee.payload), \
+            sum(info['size'] for info in baggee.payload.values())
+
+    def cleanup_create_bag(self, setup):
+        shutil.rmtree(setup[1])
+
+
+def compare(results, baseline):
+    '''Print a comparison of stage times with a baseline result set.'''
+    previous = dict(((volume['pages'], volume['page_size']), volume)
+                    for volume in baseline['results'])
+    print '\nComparison with baggins %s (%s):' % \
+        (baseline.get('baggins_version'), baseline.get('created'))
+    print '%6s %10s %-12s %10s %10s %8s' % \
+        ('pages', 'page size', 'stage', 'before', 'after', 'change')
+    for volume in results['results']:
+        before = previous.get((volume['pages'], volume['page_size']))
+        if before is None:
+            continue
+        for stage in STAGES:
+            if stage not in before['stages'] or stage not in volume['stages']:
+                continue
+            old = before['stages'][stage]['seconds']
+            new = volume['stages'][stage]['seconds']
+            change = '%+.1f%%' % ((new - old) / old * 100) if old else '-'
+            print '%6d %10d %-12s %10.4f %10.4f %8s' % \
+                (volume['pages'], volume['page_size'], stage, old, new, change)
+
+
+def get_options(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark bagging of synthetic LSDI volumes')
+    parser.add_argument('--pages', type=lambda v: parse_list(v),
+                        default=[10, 100],
+                        help='Comma-separated page counts (default: 10,100)')
+    parser.add_argument('--page-size', dest='page_sizes',
+                        type=lambda v: parse_list(v, parse_size),
+                        default=[64 * 1024, 1024 * 1024],
+                        help='''Comma-separated page image sizes, with optional
+                        K, M, or G suffix (default: 64K,1M)''')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times to run each stage; the best time is reported (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help='Number of calls per run for file_title (default: %(default)s)')
+    parser.add_argument('--staging', choices=staging.STRATEGIES,
+                        default=staging.COPY,
+                        help='Payload staging strategy (default: %(default)s)')
+    parser.add_argument('--checksum-threads', metavar='N', type=int,
+                        default=1, dest='checksum_threads',
+                        help='Number of threads used to stage and checksum payload files (default: %(default)s)')
+    parser.add_argument('--parallel-digests', action='store_true',
+                        dest='parallel_digests',
+                        help='Calculate each checksum algorithm in a separate thread')
+    parser.add_argument('--serialize', choices=archive.FORMATS,
+                        help='Create serialized bags for the create_bag stage')
+    parser.add_argument('--digwf-latency', metavar='SECONDS', type=float,
+                        default=0, dest='digwf_latency',
+                        help='Simulated DigWF API response time')
+    parser.add_argument('--fedora-latency', metavar='SECONDS', type=float,
+                        default=0, dest='fedora_latency',
+                        help='Simulated Fedora API response time')
+    parser.add_argument('--workdir', metavar='DIR',
+                        help='''Directory for generated volumes and bags
+                        (default: a temporary directory, removed afterwards)''')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='File for JSON results')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='JSON results from an earlier run to compare with')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = get_options(args)
+    workdir = options.workdir or tempfile.mkdtemp(prefix='baggins-bench-')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    results = {
+        'created': datetime.now().isoformat(),
+        'baggins_version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {
+            'repeat': options.repeat,
+            'iterations': options.iterations,
+            'staging': options.staging,
+            'checksum_algorithms': LsdiBaggee.checksum_algorithms,
+            'checksum_threads': options.checksum_threads,
+            'parallel_digests': options.parallel_digests,
+            'serialize': options.serialize,
+            'digwf_latency': options.digwf_latency,
+            'fedora_latency': options.fedora_latency,
+        },
+        'results': []
+    }
+
+    server = DigWFServer(options.digwf_latency)
+    server.start()
+    repo = StubRepository(options.fedora_latency)
+    try:
+        item_id = 0
+        for pages in options.pages:
+            for page_size in options.page_sizes:
+                item_id += 1
+                volume_dir = os.path.join(workdir, 'volumes')
+                server.items[str(item_id)] = make_volume(
+                    volume_dir, item_id, pages, page_size)
+                bag_dir = os.path.join(workdir, 'bags')
+                if not os.path.isdir(bag_dir):
+                    os.makedirs(bag_dir)
+                sys.stderr.write('Benchmarking %d pages of %d bytes\n'
+                                 % (pages, page_size))
+                benchmark = VolumeBenchmark(options, item_id, server.url,
+                                            repo, bag_dir)
+                volume = {'pages': pages, 'page_size': page_size}
+                volume.update(benchmark.run())
+                results['results'].append(volume)
+    finally:
+        server.stop()
+        if not options.workdir:
+            shutil.rmtree(workdir)
+
+    print '%6s %10s %-12s %10s %10s' % \
+        ('pages', 'page size', 'stage', 'seconds', 'MB/s')
+    for volume in results['results']:
+        for stage in STAGES:
+            info = volume['stages'][stage]
+            print '%6d %10d %-12s %10.4f %10s' % \
+                (volume['pages'], volume['page_size'], stage,
+                 info['seconds'], info.get('mb_per_sec', '-'))
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as baseline:
+            compare(results, json.load(baseline))
+    return results
+
+
+if __name__ == '__main__':
+    main()
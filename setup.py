@@ -58,8 +58,9 @@ setup(
     description='scripts and utilities for creating bagit archives of digital content',
     long_description=LONG_DESCRIPTION,
     classifiers=CLASSIFIERS,
-    scripts=['scripts/lsdi-bagger'],
+    scripts=['scripts/lsdi-bagger', 'scripts/baggins-verify'],
     package_data={'baggins': [
-        "lsdi/content/*.*"
+        "lsdi/content/*.*",
+        "lsdi/content/schemas/*.xsd"
     ]}
 )
@@ -1,46 +1,22 @@
 import bagit
 import filecmp
+import hashlib
 import os
+from mock import patch, Mock, call
 import pytest
+import shutil
+import tarfile
 import tempfile
+import zipfile
 
-from baggins.baggers.bag import Baggee
+from baggins import archive, journal, staging
+from baggins.baggers.bag import Baggee, is_complete_bag, \
+    make_temp_bag_dir, temp_bag_dirs
+from conftest import SampleBaggee
 
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), '..', 'fixtures')
 
-# extend with test subclasses, to test functionality
-
-class SampleBaggee(Baggee):
-
-    pid = '1234'
-    title = 'A Test Item to Bag'
-    files = None
-    desc_metadata = None
-    rel_metadata = None
-    bag_info = None
-
-    def __init__(self):
-        self.files = []
-        self.desc_metadata = []
-        self.rel_metadata = []
-        self.info = {"Source-Organization": "Rose Library", "Organization-Address": "Atlanta"}
-
-    def bag_info(self):
-        return self.info
-
-    def data_files(self):
-        return self.files
-
-    def descriptive_metadata(self):
-        return self.desc_metadata
-
-    def relationship_metadata(self):
-        return self.rel_metadata
-
-    def content_metadata(self):
-        return self.rel_metadata
-
 
 @pytest.mark.usefixtures("tmpdir")
 class TestBaggee:
@@ -72,11 +48,96 @@ class TestBaggee:
         # create a temporary file to act as data payload
         samplecontent = tempfile.NamedTemporaryFile()
         samplebag.files.append(samplecontent.name)
-        samplebag.add_data_files(unicode(tmpdir))
+        samplecontent.write('some payload content')
+        samplecontent.flush()
+        samplebag.status_callback = Mock()
+        data_dir = samplebag.add_data_files(unicode(tmpdir))
+        assert data_dir == os.path.join(unicode(tmpdir), 'data')
+        # progress should be reported
+        assert samplebag.status_callback.call_args_list == \
+            [call(journal.STAGING), call(journal.HASHING)]
         samplecontent_basename = os.path.basename(samplecontent.name)
         # check that temp file was copied where we expect it to be
-        filecmp.cmp(samplecontent.name,
-                    os.path.join(unicode(tmpdir), samplecontent_basename))
+        assert filecmp.cmp(samplecontent.name,
+                           os.path.join(data_dir, samplecontent_basename))
+
+        # checksums should be calculated as the file is copied
+        payload_info = samplebag.payload['data/%s' % samplecontent_basename]
+        assert payload_info['size'] == len('some payload content')
+        assert payload_info['checksums']['md5'] == \
+            hashlib.md5('some payload content').hexdigest()
+        assert payload_info['checksums']['sha256'] == \
+            hashlib.sha256('some payload content').hexdigest()
+
+    def test_add_data_files_hardlink(self, tmpdir):
+        samplebag = SampleBaggee()
+        samplebag.staging_strategy = staging.HARDLINK
+        samplecontent = tempfile.NamedTemporaryFile(dir=unicode(tmpdir))
+        samplecontent.write('some payload content')
+        samplecontent.flush()
+        os.chmod(samplecontent.name, 0440)
+        samplebag.files.append(samplecontent.name)
+        bagdir = os.path.join(unicode(tmpdir), 'bag')
+        os.mkdir(bagdir)
+        data_dir = samplebag.add_data_files(bagdir)
+
+        samplecontent_basename = os.path.basename(samplecontent.name)
+        payload_file = os.path.join(data_dir, samplecontent_basename)
+        # payload file should be linked to the source, not copied
+        assert os.stat(payload_file).st_ino == os.stat(samplecontent.name).st_ino
+        # source permissions should not be changed
+        assert os.stat(samplecontent.name).st_mode & 0777 == 0440
+        # staged file should still be checksummed
+        payload_info = samplebag.payload['data/%s' % samplecontent_basename]
+        assert payload_info['checksums']['md5'] == \
+            hashlib.md5('some payload content').hexdigest()
+
+    def test_add_data_files_threaded(self, tmpdir):
+        samplebag = SampleBaggee()
+        samplebag.checksum_workers = 3
+        samplebag.parallel_digests = True
+        srcfiles = []
+        for i in range(5):
+            srcfile = tempfile.NamedTemporaryFile(dir=unicode(tmpdir))
+            srcfile.write('payload content %d' % i)
+            srcfile.flush()
+            srcfiles.append(srcfile)
+            samplebag.files.append(srcfile.name)
+
+        for strategy in [staging.COPY, staging.HARDLINK]:
+            samplebag.staging_strategy = strategy
+            bagdir = os.path.join(unicode(tmpdir), 'bag-%s' % strategy)
+            os.mkdir(bagdir)
+            samplebag.add_data_files(bagdir)
+
+            assert len(samplebag.payload) == 5
+            for i, srcfile in enumerate(srcfiles):
+                payload_info = samplebag.payload[
+                    'data/%s' % os.path.basename(srcfile.name)]
+                assert payload_info['size'] == len('payload content %d' % i)
+                assert payload_info['checksums']['sha256'] == \
+                    hashlib.sha256('payload content %d' % i).hexdigest()
+
+    def test_make_bag(self, tmpdir):
+        samplebag = SampleBaggee()
+        samplecontent = tempfile.NamedTemporaryFile()
+        samplecontent.write('some payload content')
+        samplecontent.flush()
+        samplebag.files.append(samplecontent.name)
+        samplebag.add_data_files(unicode(tmpdir))
+
+        # payload files should not be checksummed again
+        with patch('baggins.baggers.bag.fixity') as mockfixity:
+            bag = samplebag.make_bag(unicode(tmpdir))
+            mockfixity.hash_file.assert_not_called()
+            mockfixity.copy_and_hash.assert_not_called()
+
+        assert isinstance(bag, bagit.Bag)
+        assert bag.info['Payload-Oxum'] == '%d.1' % len('some payload content')
+        assert bag.info['Source-Organization'] == 'Rose Library'
+        assert 'Bagging-Date' in bag.info
+        assert 'Bag-Software-Agent' in bag.info
+        assert bag.is_valid()
 
     def test_add_descriptive_metadata(self, tmpdir):
         samplebag = SampleBaggee()
@@ -143,3 +204,185 @@ class TestBaggee:
         # NOTE: could base this test on samplebag.checksum_algorithms
         assert 'manifest-md5.txt' in manifest_names
         assert 'manifest-sha256.txt' in manifest_names
+
+    def test_make_temp_bag_dir(self, tmpdir):
+        bagdir = os.path.join(str(tmpdir), 'bag')
+        # each attempt gets its own temporary directory
+        tmp_bagdirs = [make_temp_bag_dir(bagdir), make_temp_bag_dir(bagdir)]
+        assert tmp_bagdirs[0] != tmp_bagdirs[1]
+        assert all(os.path.isdir(path) for path in tmp_bagdirs)
+        # temporary directory left by an older version (process id)
+        old_tmp_bagdir = tmpdir.mkdir('.bag.12345.tmp')
+        # not temporary directories for this bag
+        tmpdir.mkdir('.bag.zip.12345.tmp')
+        tmpdir.mkdir('.bag-2.12345.tmp')
+        assert sorted(temp_bag_dirs(bagdir)) == \
+            sorted(tmp_bagdirs + [str(old_tmp_bagdir)])
+
+    def test_is_complete_bag(self, tmpdir):
+        bagdir = tmpdir.mkdir('bag')
+        bagdir.join('bagit.txt').write('')
+        # bag directory without a tag manifest is not complete
+        assert not is_complete_bag(str(bagdir))
+        bagdir.join('tagmanifest-md5.txt').write('')
+        assert is_complete_bag(str(bagdir))
+        # serialized bags are moved into place when complete
+        bagfile = tmpdir.join('bag.zip')
+        bagfile.write('')
+        assert is_complete_bag(str(bagfile))
+        assert not is_complete_bag(str(tmpdir.join('nonexistent')))
+
+    def test_create_bag_atomic(self, tmpdir):
+        samplebag = SampleBaggee()
+        samplecontent = tempfile.NamedTemporaryFile()
+        samplebag.files.append(samplecontent.name)
+        expected_bagdir = os.path.join(unicode(tmpdir), samplebag.bag_name())
+
+        # bag should be built in a temporary directory
+        def check_tmpdir(bagdir):
+            assert os.path.dirname(bagdir) == unicode(tmpdir)
+            assert not os.path.exists(expected_bagdir)
+            assert temp_bag_dirs(expected_bagdir) == [bagdir]
+        with patch.object(samplebag, 'add_audit_metadata') as mockaudit:
+            mockaudit.side_effect = check_tmpdir
+            bag = samplebag.create_bag(unicode(tmpdir))
+        assert bag.path == expected_bagdir
+        assert bagit.Bag(expected_bagdir).is_valid()
+        assert temp_bag_dirs(expected_bagdir) == []
+        assert is_complete_bag(expected_bagdir)
+
+        # existing bag should not be overwritten
+        with pytest.raises(OSError):
+            samplebag.create_bag(unicode(tmpdir))
+        shutil.rmtree(expected_bagdir)
+
+        # on error, nothing should be left behind
+        with patch.object(samplebag, 'add_audit_metadata') as mockaudit:
+            mockaudit.side_effect = Exception('failed')
+            with pytest.raises(Exception):
+                samplebag.create_bag(unicode(tmpdir))
+        assert os.listdir(unicode(tmpdir)) == []
+
+    def test_create_bag_steps(self, tmpdir):
+        samplebag = SampleBaggee()
+        samplebag.staging_strategy = staging.HARDLINK
+        samplecontent = tempfile.NamedTemporaryFile(dir=unicode(tmpdir))
+        samplecontent.write('some payload content')
+        samplecontent.flush()
+        samplebag.files.append(samplecontent.name)
+        outdir = unicode(tmpdir.mkdir('output'))
+
+        # steps of bag creation can be run separately
+        bagdir, tmp_bagdir = samplebag.start_bag(outdir)
+        assert bagdir == samplebag.bag_path(outdir)
+        assert temp_bag_dirs(bagdir) == [tmp_bagdir]
+        samplebag.stage_payload(tmp_bagdir)
+        payload_path = 'data/%s' % os.path.basename(samplecontent.name)
+        # linked file is not checksummed until requested
+        assert samplebag.payload[payload_path]['checksums'] is None
+        samplebag.checksum_payload(tmp_bagdir)
+        assert samplebag.payload[payload_path]['checksums']['md5'] == \
+            hashlib.md5('some payload content').hexdigest()
+        bag = samplebag.finish_bag(tmp_bagdir, bagdir)
+        assert bag.path == bagdir
+        assert bagit.Bag(bagdir).is_valid()
+        assert os.listdir(outdir) == [samplebag.bag_name()]
+        shutil.rmtree(bagdir)
+
+        # aborted bag leaves nothing behind
+        bagdir, tmp_bagdir = samplebag.start_bag(outdir)
+        samplebag.stage_payload(tmp_bagdir)
+        samplebag.abort_bag(tmp_bagdir)
+        assert os.listdir(outdir) == []
+        assert samplebag.metrics.seconds is not None
+
+        # bag path is absolute, even if the output directory isn't
+        with tmpdir.as_cwd():
+            bagdir, tmp_bagdir = samplebag.start_bag('output')
+            samplebag.add_data_files(tmp_bagdir)
+            bag = samplebag.finish_bag(tmp_bagdir, bagdir)
+        assert bag.path == os.path.join(outdir, samplebag.bag_name())
+
+    @pytest.mark.parametrize('serialization', archive.FORMATS)
+    def test_create_serialized_bag(self, tmpdir, serialization):
+        samplebag = SampleBaggee()
+        samplebag.serialization = serialization
+        samplecontent = tempfile.NamedTemporaryFile()
+        samplecontent.write('some payload content')
+        samplecontent.flush()
+        samplebag.files.append(samplecontent.name)
+        samplebag.desc_metadata.append(
+            os.path.join(FIXTURE_DIR, self.marcml_basename))
+        outdir = tmpdir.mkdir('output')
+
+        bagfile = samplebag.create_bag(unicode(outdir))
+        assert bagfile == samplebag.bag_path(unicode(outdir))
+        assert bagfile.endswith(archive.EXTENSIONS[serialization])
+        # only the archive should be created; no temporary files left
+        assert os.listdir(unicode(outdir)) == [os.path.basename(bagfile)]
+        payload_path = 'data/%s' % os.path.basename(samplecontent.name)
+        assert samplebag.payload[payload_path]['size'] == 20
+
+        # extracted archive should be a valid bag
+        extractdir = tmpdir.mkdir('extracted')
+        if serialization == archive.ZIP:
+            zipfile.ZipFile(bagfile).extractall(unicode(extractdir))
+        else:
+            with tarfile.open(bagfile) as tar:
+                tar.extractall(unicode(extractdir))
+        bagdir = os.path.join(unicode(extractdir), samplebag.bag_name())
+        bag = bagit.Bag(bagdir)
+        assert bag.is_valid()
+        assert list(bag.payload_files()) == [payload_path]
+        assert os.path.exists(os.path.join(
+            bagdir, 'metadata', 'descriptive', self.marcml_basename))
+        assert 'metadata/descriptive/%s' % self.marcml_basename in \
+            bag.tagfile_entries()
+
+        # existing bag should not be overwritten
+        with pytest.raises(OSError):
+            samplebag.create_bag(unicode(outdir))
+
+    def test_create_bag_metrics(self, tmpdir):
+        samplebag = SampleBaggee()
+        samplecontent = tempfile.NamedTemporaryFile()
+        samplecontent.write('some payload content')
+        samplecontent.flush()
+        samplebag.files.append(samplecontent.name)
+        samplebag.create_bag(unicode(tmpdir))
+
+        bag_metrics = samplebag.metrics
+        assert bag_metrics.bag == samplebag.bag_name()
+        assert bag_metrics.seconds is not None
+        stages = dict((stage.name, stage) for stage in bag_metrics.stages)
+        assert [stage.name for stage in bag_metrics.stages] == [
+            'stage_payload', 'checksum_payload', 'make_bag',
+            'add_descriptive_metadata', 'add_content_metadata',
+            'add_relationship_metadata', 'add_technical_metadata',
+            'add_rights_metadata', 'add_identity_metadata',
+            'add_audit_metadata', 'save']
+        # copied and checksummed in a single pass
+        assert stages['stage_payload'].files == 1
+        assert stages['stage_payload'].bytes_read == 20
+        assert stages['stage_payload'].bytes_written == 20
+        assert stages['checksum_payload'].files == 0
+        assert stages['make_bag'].bytes_written > 0
+        assert stages['save'].bytes_read > 0
+
+        # hard linked files are checksummed separately
+        samplebag.staging_strategy = staging.HARDLINK
+        samplebag.create_bag(unicode(tmpdir.mkdir('linked')))
+        stages = dict((stage.name, stage)
+                      for stage in samplebag.metrics.stages)
+        assert stages['stage_payload'].bytes_written == 0
+        assert stages['checksum_payload'].files == 1
+        assert stages['checksum_payload'].bytes_read == 20
+
+        # serialized bags
+        samplebag.serialization = archive.TAR
+        samplebag.create_bag(unicode(tmpdir.mkdir('serialized')))
+        stages = dict((stage.name, stage)
+                      for stage in samplebag.metrics.stages)
+        assert stages['stream_payload'].bytes_read == 20
+        assert stages['archive_tag_files'].files > 0
+        assert stages['finalize'].bytes_written > 20
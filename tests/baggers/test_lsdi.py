@@ -1,16 +1,22 @@
+import argparse
+import json
 import os
 from ConfigParser import ConfigParser
-from eulxml.xmlmap import load_xmlobject_from_file
+from eulxml.xmlmap import load_xmlobject_from_file, load_xmlobject_from_string
 from mock import patch, Mock, call
 import pytest
+import requests
 import tempfile
 import os
 import sys
 import tempfile
 import yaml
 
+from baggins import journal, metrics
 from baggins.baggers.lsdi import LsdiBagger, LsdiBaggee
 from baggins.lsdi import digwf, fedora
+from baggins.lsdi.mets import Mets
+from baggins.cache import Cache
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
 
@@ -27,7 +33,8 @@ class TestLsdiBagger:
     def test_get_options(self, mockargparse, capsys):
         mockparser = mockargparse.ArgumentParser.return_value
 
-        mockopts = Mock(item_ids=[], gen_config=False, file=False)
+        mockopts = Mock(item_ids=[], gen_config=False, file=False,
+                        output=None, journal=None)
         mockopts.config = self.test_config
         mockparser.parse_args.return_value = mockopts
 
@@ -111,6 +118,19 @@ class TestLsdiBagger:
             lbag.get_options()
             assert lbag.options.output == '/tmp/bags'
             assert lbag.options.digwf_url == 'http://example.co:3100/digwf_api/'
+            # job journal defaults to the output directory
+            assert lbag.options.journal == \
+                os.path.join('/tmp/bags', lbag.journal_file)
+            assert not lbag.options.resume
+
+        # relative paths are made absolute, since bagit changes the
+        # working directory while saving bags
+        testargs = ["lsdi-bagger", "123", "-c", test_cfgfile,
+                    "-o", "bags", "--journal", "run/journal.db"]
+        with patch.object(sys, 'argv', testargs):
+            lbag.get_options()
+            assert lbag.options.output == os.path.abspath('bags')
+            assert lbag.options.journal == os.path.abspath('run/journal.db')
 
         # test that id file logic is triggered correctly by -f flag
 
@@ -146,10 +166,19 @@ class TestLsdiBagger:
         assert isinstance(cfg, ConfigParser)
         assert cfg.has_section(lbag.digwf_cfg)
         assert cfg.has_option(lbag.digwf_cfg, 'url')
+        assert cfg.has_option(lbag.digwf_cfg, 'timeout')
+        assert cfg.has_option(lbag.digwf_cfg, 'retries')
+        assert cfg.has_option(lbag.digwf_cfg, 'pool_size')
+        assert cfg.has_option(lbag.digwf_cfg, 'cache')
+        assert cfg.has_option(lbag.digwf_cfg, 'cache_ttl')
         assert cfg.has_section(lbag.filepaths_cfg)
         assert cfg.has_option(lbag.filepaths_cfg, 'output')
         assert cfg.has_section(lbag.fedora_cfg)
         assert cfg.has_option(lbag.fedora_cfg, 'url')
+        assert cfg.has_option(lbag.fedora_cfg, 'check_interval')
+        assert cfg.has_option(lbag.fedora_cfg, 'pool_size')
+        assert cfg.has_option(lbag.fedora_cfg, 'cache')
+        assert cfg.has_option(lbag.fedora_cfg, 'cache_ttl')
 
         # NOTE: more sections will probably be added and should be tested
         # when they are
@@ -196,12 +225,52 @@ class TestLsdiBagger:
         assert lbag.options.digwf_url == 'http://example.co:3100/digwf_api/'
         assert lbag.options.output == '/tmp/bags'
         assert lbag.options.fedora_url == 'http://server.edu:8080/fedora/'
+        assert lbag.options.fedora_check_interval is None
+        assert lbag.options.fedora_pool_size is None
+        assert lbag.options.fedora_cache is None
+        assert lbag.options.fedora_cache_ttl is None
+        # optional digwf connection settings
+        assert lbag.options.digwf_timeout == 10
+        assert lbag.options.digwf_retries is None
+        assert lbag.options.digwf_pool_size is None
+        assert lbag.options.digwf_cache is None
+        assert lbag.options.digwf_cache_ttl is None
+
+        # client should be initialized with configured settings
+        client = lbag.digwf_client()
+        assert client.base_url == 'http://example.co:3100/digwf_api'
+        assert client.timeout == 10
+        assert client.retries == digwf.Client.retries
+        assert client.cache is None
+
+        # configured cache file
+        lbag.options.digwf_cache = '/tmp/digwf-cache.db'
+        client = lbag.digwf_client()
+        assert client.cache.path == lbag.options.digwf_cache
+        assert client.cache.ttl == lbag.digwf_cache_ttl
 
         # if output is specified on command line, that takes precedence
         lbag.options.output = '/i/want/bags/somewhere/else'
         lbag.load_configfile()
         assert lbag.options.output != '/tmp/bags'
 
+    def test_load_configfile_paths(self, tmpdir):
+        cfgfile = tmpdir.join('lsdi-bagger.cfg')
+        cfgfile.write('[Digitization Workflow]\n'
+                      'url = http://example.co:3100/digwf_api/\n'
+                      'cache = digwf-cache.db\n'
+                      '[Fedora]\n'
+                      'url = http://server.edu:8080/fedora/\n'
+                      'cache = cache/fedora.db\n')
+        lbag = LsdiBagger()
+        lbag.options = Mock(item_ids=[], gen_config=False, digwf_url=None,
+                            output=None, config=str(cfgfile))
+        lbag.load_configfile()
+        # cache files are opened from worker threads, so relative paths
+        # are made absolute
+        assert lbag.options.digwf_cache == os.path.abspath('digwf-cache.db')
+        assert lbag.options.fedora_cache == os.path.abspath('cache/fedora.db')
+
     def test_load_cfgfile_nonexistent(self, capsys):
         lbag = LsdiBagger()
         # use a Mock to simulate argparse options
@@ -242,6 +311,7 @@ class TestLsdiBagger:
         lbag.options.fedora_url = 'http://fed.dig:8080/fedora/'
         mockdigwf_api = mockdigwfclient.return_value
         # simuulate no matches
+        mockdigwf_api.get_items_by_id.return_value = {}
         mockdigwf_api.get_items.return_value.count = 0
 
         lbag.process_items()
@@ -262,17 +332,37 @@ class TestLsdiBagger:
         mockdigwf_api = mockdigwfclient.return_value
         lbag.options.fedora_url = 'http://fed.dig:8080/fedora/'
         # simulate multiple matches
+        mockdigwf_api.get_items_by_id.return_value = {}
         mockdigwf_api.get_items.return_value.count = 5
         lbag.process_items()
         output = capsys.readouterr()
         assert 'Error! DigWF returned 5 matches for this item id %s' % test_id \
             in output[0]
 
+    @patch('baggins.baggers.lsdi.Client')
+    def test_process_items_digwf_error(self, mockdigwfclient, capsys):
+        lbag = LsdiBagger()
+        lbag.options.item_ids = [1234, 5678]
+        lbag.options.digwf_url = 'http://some.dig/wf/api'
+        lbag.options.fedora_url = 'http://fed.dig:8080/fedora/'
+        mockdigwf_api = mockdigwfclient.return_value
+        mockdigwf_api.get_items_by_id.return_value = {}
+        # timeout for the first item, once retries are exhausted,
+        # should not stop the remaining items from being processed
+        mockdigwf_api.get_items.side_effect = [
+            requests.exceptions.Timeout('read timed out'), Mock(count=0)]
+        lbag.process_items()
+        output = capsys.readouterr()
+        assert 'Domokun Connection Error! Unable to query DigWF REST API ' \
+            'for 1234: read timed out' in output[0]
+        assert 'No item found for this item id 5678' in output[0]
+
+    @patch('baggins.lsdi.fedora.requests.head')
     @patch('baggins.baggers.lsdi.Repository')
     @patch('baggins.baggers.lsdi.Client')
     @patch('baggins.baggers.lsdi.LsdiBaggee')
     def test_process_items_valid(self, mocklsdibaggee, mockdigwfclient,
-                                 mockrepo, capsys):
+                                 mockrepo, mockhead, capsys):
         lbag = LsdiBagger()
         test_id = 1234
         lbag.options.item_ids = [test_id]
@@ -280,8 +370,6 @@ class TestLsdiBagger:
         lbag.options.output = '/tmp/lilbags'
         lbag.options.fedora_url = 'http://fed.dig:8080/fedora/'
         mockdigwf_api = mockdigwfclient.return_value
-        # simulate one match
-        mockdigwf_api.get_items.return_value.count = 1
         # set return value for mock create bag
         # NOTE: technically this returns a bagit bag; for now we are
         # just using it to display the path
@@ -291,10 +379,17 @@ class TestLsdiBagger:
         # use mock for digwf item
         mockdigwf_item = Mock(pid='789', control_key='ocm4567',
                               marc_path='/path/to/some/ocm4567_MRC.xml')
-        mockdigwf_api.get_items.return_value.items = [mockdigwf_item]
+        # item information is prefetched for all items
+        mockdigwf_api.get_items_by_id.return_value = {test_id: mockdigwf_item}
         lbag.process_items()
+        mockdigwf_api.get_items_by_id.assert_called_with([test_id])
+        # prefetched item should not be looked up again
+        mockdigwf_api.get_items.assert_not_called()
         mocklsdibaggee.assert_called_with(mockdigwf_item, mockrepo.return_value)
         mocklsdibaggee.return_value.create_bag.assert_called_with(lbag.options.output)
+        # fedora relationships are prefetched and passed to the baggee
+        assert mocklsdibaggee.return_value.relationship_info == \
+            mocklsdibaggee.return_value.relationship_metadata_info.return_value
 
         output = capsys.readouterr()
         # currently script reports that item was found with minimal
@@ -305,6 +400,357 @@ class TestLsdiBagger:
         # and where the bag was created
         assert 'Bag created at %s' % testbagpath in output[0]
 
+    @patch('baggins.lsdi.fedora.requests.head')
+    @patch('baggins.baggers.lsdi.Repository')
+    @patch('baggins.baggers.lsdi.Client')
+    @patch('baggins.baggers.lsdi.LsdiBaggee')
+    def test_process_items_error(self, mocklsdibaggee, mockdigwfclient,
+                                 mockrepo, mockhead, capsys):
+        lbag = LsdiBagger()
+        test_ids = [1234, 5678]
+        lbag.options.item_ids = test_ids
+        lbag.options.digwf_url = 'http://some.dig/wf/api'
+        lbag.options.output = '/tmp/lilbags'
+        lbag.options.fedora_url = 'http://fed.dig:8080/fedora/'
+        mockdigwf_api = mockdigwfclient.return_value
+        # second item not found by prefetch, looked up individually
+        mockdigwf_api.get_items_by_id.return_value = {
+            1234: Mock(pid='789', control_key='ocm4567',
+                       marc_path='/path/to/some/ocm4567_MRC.xml')}
+        mockdigwf_api.get_items.return_value.count = 1
+        mockdigwf_api.get_items.return_value.items = [
+            Mock(pid='790', control_key='ocm4567',
+                 marc_path='/path/to/some/ocm4567_MRC.xml')]
+        # first bag fails, second succeeds
+        mocklsdibaggee.return_value.create_bag.side_effect = [
+            Exception('Display images not found'), '/path/to/new/bag']
+        lbag.process_items()
+
+        output = capsys.readouterr()
+        assert 'Error! Unable to create bag for item 1234: Display images not found' \
+            in output[0]
+        assert 'Bag created at /path/to/new/bag' in output[0]
+        mockdigwf_api.get_items.assert_called_once_with(item_id=5678)
+        # fedora availability checked once for the run, not per item
+        assert mockhead.call_count == 1
+        mockrepo.return_value.get_object.assert_not_called()
+
+    @patch('baggins.lsdi.fedora.requests.head')
+    @patch('baggins.baggers.lsdi.Repository')
+    @patch('baggins.baggers.lsdi.Client')
+    @patch('baggins.baggers.lsdi.LsdiBaggee')
+    def test_process_items_metrics(self, mocklsdibaggee, mockdigwfclient,
+                                   mockrepo, mockhead, tmpdir):
+        lbag = LsdiBagger()
+        lbag.options = argparse.Namespace(
+            item_ids=['1', '2'], digwf_url='http://some.dig/wf/api',
+            fedora_url='http://fed.dig:8080/fedora/', output=str(tmpdir),
+            metrics=str(tmpdir.join('metrics.json')))
+        mockdigwfclient.return_value.get_items_by_id.return_value = dict(
+            (i, Mock(pid=i, control_key='ocm4567',
+                     marc_path='/path/to/some/ocm4567_MRC.xml'))
+            for i in ['1', '2'])
+        bag_metrics = metrics.BagMetrics('bag1')
+        with bag_metrics.stage('stage_payload') as stage:
+            stage.files = 3
+        mocklsdibaggee.return_value.metrics = bag_metrics
+        # first bag fails, second succeeds
+        mocklsdibaggee.return_value.create_bag.side_effect = [
+            Exception('Display images not found'), '/path/to/new/bag']
+        lbag.process_items()
+        lbag.write_metrics()
+
+        with open(lbag.options.metrics) as metricsfile:
+            data = json.load(metricsfile)
+        assert [(bag['item_id'], bag['status']) for bag in data['bags']] == \
+            [('1', journal.FAILED), ('2', journal.DONE)]
+        assert data['bags'][0]['stages'][0]['stage'] == 'stage_payload'
+        assert data['bags'][0]['stages'][0]['files'] == 3
+
+    @patch('baggins.lsdi.fedora.requests.head')
+    @patch('baggins.baggers.lsdi.Repository')
+    @patch('baggins.baggers.lsdi.Client')
+    @patch('baggins.baggers.lsdi.LsdiBaggee')
+    def test_process_items_fedora_error(self, mocklsdibaggee, mockdigwfclient,
+                                        mockrepo, mockhead, capsys):
+        lbag = LsdiBagger()
+        test_ids = [1234, 5678]
+        lbag.options.item_ids = test_ids
+        lbag.options.digwf_url = 'http://some.dig/wf/api'
+        lbag.options.output = '/tmp/lilbags'
+        lbag.options.fedora_url = 'http://fed.dig:8080/fedora/'
+        mockdigwf_api = mockdigwfclient.return_value
+        mockdigwf_api.get_items_by_id.return_value = dict(
+            (i, Mock(pid='789', control_key='ocm4567',
+                     marc_path='/path/to/some/ocm4567_MRC.xml'))
+            for i in test_ids)
+        # fedora unavailable at startup, then recovers
+        mockhead.side_effect = [requests.ConnectionError, requests.ConnectionError,
+                                Mock()]
+        mocklsdibaggee.return_value.create_bag.return_value = '/path/to/new/bag'
+        lbag.process_items()
+
+        output = capsys.readouterr()
+        assert 'Fedora Connection Error! Unable to query Fedora REST API\n' \
+            in output[0]
+        # first item skipped, fedora re-checked for second item
+        assert mockhead.call_count == 3
+        assert output[0].count('Bag created at /path/to/new/bag') == 1
+
+        # connection error while bagging should trigger a new check
+        mockhead.reset_mock()
+        mockhead.side_effect = None
+        mocklsdibaggee.return_value.create_bag.side_effect = [
+            requests.ConnectionError('connection refused'), '/path/to/new/bag']
+        lbag.process_items()
+        output = capsys.readouterr()
+        assert 'Error! Unable to create bag for item 1234: connection refused' \
+            in output[0]
+        # once at startup, once after the failure
+        assert mockhead.call_count == 2
+
+    @patch('baggins.lsdi.fedora.requests.head')
+    def test_prefetch_relationships(self, mockhead):
+        lbag = LsdiBagger()
+        lbag.options = argparse.Namespace(
+            fedora_url='http://fed.dig:8080/fedora/', fedora_pool_size=2)
+        lbag.init_fedora_monitor()
+        items = dict((i, Mock(pid=i)) for i in ['1', '2', '3'])
+
+        def relationship_info(baggee):
+            if baggee.item.pid == '2':
+                raise requests.ConnectionError
+            return {'Fedora Book': {'pid': 'book:%s' % baggee.item.pid}}
+
+        with patch.object(LsdiBaggee, 'relationship_metadata_info',
+                          autospec=True) as mockrel:
+            mockrel.side_effect = relationship_info
+            relationships = lbag.prefetch_relationships(items, Mock())
+            # items that could not be looked up are left out
+            assert relationships == {
+                '1': {'Fedora Book': {'pid': 'book:1'}},
+                '3': {'Fedora Book': {'pid': 'book:3'}}}
+            # connection error is reported to the fedora monitor
+            assert lbag.fedora_monitor.last_success is None
+
+            # skipped when fedora is not available
+            mockrel.reset_mock()
+            assert lbag.prefetch_relationships(items, Mock()) == {}
+            mockrel.assert_not_called()
+
+    @patch('baggins.lsdi.fedora.requests.head')
+    @patch('baggins.baggers.lsdi.Repository')
+    @patch('baggins.baggers.lsdi.Client')
+    def test_process_items_parallel(self, mockdigwfclient, mockrepo,
+                                    mockhead, capsys):
+        lbag = LsdiBagger()
+        test_ids = [1234, 5678, 8181, 9999]
+        lbag.options.item_ids = test_ids
+        lbag.options.digwf_url = 'http://some.dig/wf/api'
+        lbag.options.fedora_url = 'http://fed.dig:8080/fedora/'
+        lbag.options.jobs = 2
+        # simulate no matches
+        mockdigwfclient.return_value.get_items_by_id.return_value = {}
+        mockdigwfclient.return_value.get_items.return_value.count = 0
+
+        try:
+            lbag.process_items()
+        finally:
+            lbag.options.jobs = 1
+
+        output = capsys.readouterr()
+        # output should be reported in the order items were requested
+        assert output[0] == ''.join(['No item found for this item id %s\n' % i
+                                     for i in test_ids])
+
+
+    @patch('baggins.lsdi.fedora.requests.head')
+    @patch('baggins.baggers.lsdi.Repository')
+    @patch('baggins.baggers.lsdi.Client')
+    @patch('baggins.baggers.lsdi.LsdiBaggee')
+    def test_process_items_pipeline(self, mocklsdibaggee, mockdigwfclient,
+                                    mockrepo, mockhead, tmpdir, capsys):
+        lbag = LsdiBagger()
+        lbag.options = argparse.Namespace(
+            item_ids=['1', '2', '3'], digwf_url='http://some.dig/wf/api',
+            fedora_url='http://fed.dig:8080/fedora/', output=str(tmpdir),
+            journal=os.path.join(str(tmpdir), LsdiBagger.journal_file),
+            pipeline=True)
+        mockdigwf_api = mockdigwfclient.return_value
+        mockdigwf_api.get_items_by_id.return_value = dict(
+            (i, Mock(pid=i, control_key='ocm4567',
+                     marc_path='/path/to/some/ocm4567_MRC.xml'))
+            for i in ['1', '2'])
+        # third item not found
+        mockdigwf_api.get_items.return_value.count = 0
+        mockbaggee = mocklsdibaggee.return_value
+        mockbaggee.serialization = None
+        mockbaggee.bag_path.side_effect = ['/bags/bag1', '/bags/bag2']
+        mockbaggee.start_bag.side_effect = [
+            ('/bags/bag1', '/bags/.bag1.tmp'), ('/bags/bag2', '/bags/.bag2.tmp')]
+        # first item fails while checksumming, second succeeds
+        mockbaggee.checksum_payload.side_effect = [
+            Exception('checksum failed'), None]
+        mockbaggee.finish_bag.return_value = '/path/to/new/bag'
+        lbag.process_items()
+
+        output = capsys.readouterr()
+        assert 'Error! Unable to create bag for item 1: checksum failed' \
+            in output[0]
+        assert 'Bag created at /path/to/new/bag' in output[0]
+        assert 'No item found for this item id 3' in output[0]
+        assert mockbaggee.prefetch_metadata.call_count == 2
+        mockbaggee.start_bag.assert_called_with(str(tmpdir))
+        assert mockbaggee.stage_payload.call_count == 2
+        # failed bag is cleaned up; successful bag is finished
+        mockbaggee.abort_bag.assert_called_once_with('/bags/.bag1.tmp')
+        mockbaggee.finish_bag.assert_called_once_with(
+            '/bags/.bag2.tmp', '/bags/bag2')
+        mockbaggee.create_bag.assert_not_called()
+
+        jobs = dict((job['item_id'], job) for job in
+                    journal.Journal(lbag.options.journal).items())
+        assert jobs['1']['state'] == journal.FAILED
+        assert jobs['2']['state'] == journal.DONE
+        assert jobs['3']['state'] == journal.FAILED
+
+    @patch('baggins.lsdi.fedora.requests.head')
+    @patch('baggins.baggers.lsdi.Repository')
+    @patch('baggins.baggers.lsdi.Client')
+    @patch('baggins.baggers.lsdi.LsdiBaggee')
+    def test_process_items_pipeline_repeated(self, mocklsdibaggee,
+                                             mockdigwfclient, mockrepo,
+                                             mockhead, tmpdir, capsys):
+        lbag = LsdiBagger()
+        lbag.options = argparse.Namespace(
+            item_ids=['1', '2', '1'], digwf_url='http://some.dig/wf/api',
+            fedora_url='http://fed.dig:8080/fedora/', output=str(tmpdir),
+            journal=None, pipeline=True)
+        mockdigwf_api = mockdigwfclient.return_value
+        mockdigwf_api.get_items_by_id.return_value = dict(
+            (i, Mock(pid=i, control_key='ocm4567',
+                     marc_path='/path/to/some/ocm4567_MRC.xml'))
+            for i in ['1', '2'])
+        mockbaggee = mocklsdibaggee.return_value
+        mockbaggee.serialization = None
+        mockbaggee.start_bag.side_effect = [
+            ('/bags/bag1', '/bags/.bag1.tmp'), ('/bags/bag2', '/bags/.bag2.tmp')]
+        mockbaggee.finish_bag.return_value = '/path/to/new/bag'
+        lbag.process_items()
+
+        # repeated item is only bagged once
+        mockdigwf_api.get_items_by_id.assert_called_once_with(['1', '2'])
+        assert mockbaggee.start_bag.call_count == 2
+        assert mockbaggee.finish_bag.call_count == 2
+        output = capsys.readouterr()
+        assert output[0].count('Bag created at /path/to/new/bag') == 2
+
+    @patch('baggins.lsdi.fedora.requests.head')
+    @patch('baggins.baggers.lsdi.Repository')
+    @patch('baggins.baggers.lsdi.Client')
+    @patch('baggins.baggers.lsdi.LsdiBaggee')
+    def test_process_items_resume(self, mocklsdibaggee, mockdigwfclient,
+                                  mockrepo, mockhead, tmpdir, capsys):
+        lbag = LsdiBagger()
+        lbag.options = argparse.Namespace(
+            item_ids=['1', '2', '3'], digwf_url='http://some.dig/wf/api',
+            fedora_url='http://fed.dig:8080/fedora/', output=str(tmpdir),
+            journal=os.path.join(str(tmpdir), LsdiBagger.journal_file),
+            resume=True)
+        # previous run: item 1 completed, item 2 interrupted while staging
+        done_bag = tmpdir.mkdir('bag1')
+        done_bag.join('bagit.txt').write('')
+        done_bag.join('tagmanifest-md5.txt').write('')
+        partial_bag = tmpdir.mkdir('bag2')
+        partial_bag.join('bagit.txt').write('')
+        partial_tmp_bag = tmpdir.mkdir('.bag2.12345.tmp')
+        previous = journal.Journal(lbag.options.journal)
+        previous.update('1', journal.DONE, bag=str(done_bag))
+        previous.update('2', journal.STAGING, bag=str(partial_bag))
+
+        mockdigwf_api = mockdigwfclient.return_value
+        mockdigwf_api.get_items_by_id.return_value = dict(
+            (i, Mock(pid=i, control_key='ocm4567',
+                     marc_path='/path/to/some/ocm4567_MRC.xml'))
+            for i in ['2', '3'])
+        mocklsdibaggee.return_value.bag_path.side_effect = \
+            [str(partial_bag), os.path.join(str(tmpdir), 'bag3')]
+
+        def create_bag(output):
+            # partial bag should be removed before the item is retried
+            assert not partial_bag.check()
+            assert not partial_tmp_bag.check()
+            return '/path/to/new/bag'
+        mocklsdibaggee.return_value.create_bag.side_effect = create_bag
+
+        lbag.process_items()
+        output = capsys.readouterr()
+        assert 'Skipping item 1; bag already created at %s' % done_bag \
+            in output[0]
+        assert 'Removing incomplete bag %s' % partial_bag in output[0]
+        # completed items should not be looked up again
+        mockdigwf_api.get_items_by_id.assert_called_with(['2', '3'])
+        assert mocklsdibaggee.return_value.create_bag.call_count == 2
+
+        jobs = dict((job['item_id'], job) for job in previous.items())
+        assert jobs['1']['state'] == journal.DONE
+        assert jobs['2']['state'] == journal.DONE
+        assert jobs['2']['bag'] == str(partial_bag)
+        assert jobs['3']['state'] == journal.DONE
+        assert jobs['3']['bag'] == os.path.join(str(tmpdir), 'bag3')
+
+        # without resume, failures are recorded and nothing is skipped
+        lbag.options.resume = False
+        mockdigwf_api.get_items_by_id.return_value['1'] = Mock(
+            pid='1', control_key='ocm4567',
+            marc_path='/path/to/some/ocm4567_MRC.xml')
+        mocklsdibaggee.return_value.bag_path.side_effect = None
+        mocklsdibaggee.return_value.bag_path.return_value = str(done_bag)
+        mocklsdibaggee.return_value.create_bag.side_effect = \
+            Exception('Display images not found')
+        lbag.process_items()
+        output = capsys.readouterr()
+        assert 'Skipping' not in output[0]
+        assert done_bag.check()
+        job = previous.get('1')
+        assert job['state'] == journal.FAILED
+        assert job['error'] == \
+            'Error! Unable to create bag for item 1: Display images not found'
+
+        # resuming after the failure must not remove the completed bag
+        # that was already in place, only temporary directories
+        lbag.options.resume = True
+        tmp_bag = tmpdir.mkdir('.bag1.12345.tmp')
+        mocklsdibaggee.return_value.create_bag.side_effect = \
+            OSError(17, 'File exists')
+        lbag.process_items()
+        output = capsys.readouterr()
+        assert done_bag.check()
+        assert done_bag.join('tagmanifest-md5.txt').check()
+        assert not tmp_bag.check()
+        assert 'Removing incomplete bag %s\n' % done_bag not in output[0]
+        assert previous.get('1')['state'] == journal.FAILED
+
+    def test_status_callback(self, tmpdir):
+        lbag = LsdiBagger()
+        lbag.options = argparse.Namespace(
+            output=str(tmpdir),
+            journal=os.path.join(str(tmpdir), LsdiBagger.journal_file))
+        lbag.init_journal()
+        item = Mock(pid='1', control_key='ocm4567')
+        with patch('baggins.baggers.lsdi.LsdiBaggee') as mocklsdibaggee:
+            mocklsdibaggee.return_value.bag_path.return_value = \
+                os.path.join(str(tmpdir), 'bag1')
+            baggee = lbag.init_baggee('1', item, None)
+        # bag location is only recorded once staging starts
+        baggee.status_callback(journal.FETCHING)
+        assert lbag.job_journal.get('1')['bag'] is None
+        baggee.status_callback(journal.STAGING)
+        job = lbag.job_journal.get('1')
+        assert job['state'] == journal.STAGING
+        assert job['bag'] == os.path.join(str(tmpdir), 'bag1')
+        baggee.bag_path.assert_called_with(str(tmpdir))
+
 
 @pytest.fixture
 def lsdibag():
@@ -358,6 +804,8 @@ class TestLsdiBaggee:
         for i in range(10):
             jpegs.append(tempfile.NamedTemporaryFile(suffix='.jpg',
                                                      dir=unicode(tmpdir)))
+        # directory listings are cached; clear since contents changed
+        lsdibag.clear_file_cache()
         # count mismatch
         with pytest.raises(Exception):
             lsdibag.image_files()
@@ -369,24 +817,28 @@ class TestLsdiBaggee:
         for imgfile in tiffs:
             assert imgfile.name in img_files
             imgfile.close()  # close to delete
+        lsdibag.clear_file_cache()
 
         # if .tif is not present, should look for .TIF
         img_files = lsdibag.image_files()
         for imgfile in uc_tiffs:
             assert imgfile.name in img_files
             imgfile.close()   # close to delete
+        lsdibag.clear_file_cache()
 
         # if .tif/.TIF is not present, should look for .jp2
         img_files = lsdibag.image_files()
         for imgfile in jp2s:
             assert imgfile.name in img_files
             imgfile.close()   # close to delete
+        lsdibag.clear_file_cache()
 
         # if nothing else is found, should look for .jpeg
         img_files = lsdibag.image_files()
         for imgfile in jpegs:
             assert imgfile.name in img_files
             imgfile.close()   # close to delete
+        lsdibag.clear_file_cache()
 
     def test_page_text_files(self, lsdibag, tmpdir):
         # set fixture object to look in tmp dir
@@ -401,6 +853,8 @@ class TestLsdiBaggee:
         for _ in range(10):
             textfiles.append(tempfile.NamedTemporaryFile(suffix='.txt',
                                                          dir=unicode(tmpdir)))
+        # directory listings are cached; clear since contents changed
+        lsdibag.clear_file_cache()
         # without .pos files, should still error
         with pytest.raises(Exception):
             lsdibag.page_text_files()
@@ -410,6 +864,7 @@ class TestLsdiBaggee:
         for _ in range(10):
             posfiles.append(tempfile.NamedTemporaryFile(suffix='.pos',
                                                         dir=unicode(tmpdir)))
+        lsdibag.clear_file_cache()
         # count mismatch should error
         with pytest.raises(Exception):
             lsdibag.page_text_files()
@@ -422,6 +877,34 @@ class TestLsdiBaggee:
         for posfile in posfiles:
             assert posfile.name in files
 
+    def test_directory_files(self, lsdibag, tmpdir):
+        # images and ocr files in the same directory
+        lsdibag.item.display_image_path = unicode(tmpdir)
+        lsdibag.item.ocr_file_path = unicode(tmpdir)
+        lsdibag.item.display_image_count = 3
+        lsdibag.item.ocr_file_count = 3
+        for page in ['0001', '0002', '0003']:
+            for ext in ['tif', 'txt', 'pos']:
+                tmpdir.join('%s.%s' % (page, ext)).write('')
+        tmpdir.join('.hidden.tif').write('')
+
+        files = lsdibag.directory_files(unicode(tmpdir))
+        assert sorted(files.keys()) == ['.pos', '.tif', '.txt']
+        assert os.path.join(unicode(tmpdir), '0001.tif') in files['.tif']
+
+        # directory should only be listed once for all file lookups
+        lsdibag.clear_file_cache()
+        with patch('baggins.baggers.lsdi.os.listdir',
+                   side_effect=os.listdir) as mocklistdir:
+            lsdibag.image_files()
+            lsdibag.page_text_files()
+            lsdibag.image_files()
+            assert len(lsdibag.data_files()) == 11
+            mocklistdir.assert_called_once_with(unicode(tmpdir))
+
+        # nonexistent directory is treated as empty
+        assert lsdibag.directory_files('/not/a/real/dir') == {}
+
     def test_data_files(self, lsdibag):
         with patch.object(lsdibag, 'image_files') as mock_imgfiles:
             with patch.object(lsdibag, 'page_text_files') as mock_txtfiles:
@@ -466,7 +949,46 @@ class TestLsdiBaggee:
     def test_content_metadata(self,lsdibag):
         print "passing"
 
+    def test_mets_metadata_info(self, lsdibag, capsys):
+        output_dir = '/mnt/lsdi/ocm08951025/Output'
+        data_files = ['%s/Output.pdf' % output_dir, '%s/Output.xml' % output_dir]
+        for page in ['00000001', '00000002', '00000003', '00000010']:
+            data_files.extend(['%s/%s.tif' % (output_dir, page),
+                               '%s/%s.txt' % (output_dir, page),
+                               '%s/%s.pos' % (output_dir, page)])
+        # page 4 is missing a text file
+        data_files.extend(['%s/00000004.tif' % output_dir,
+                           '%s/00000004.pos' % output_dir])
+
+        with patch.object(lsdibag, 'data_files') as mock_datafiles:
+            mock_datafiles.return_value = data_files
+            mets_xml = lsdibag.mets_metadata_info()
+
+        mets = load_xmlobject_from_string(mets_xml, Mets)
+        assert len(mets.tiffs) == 5
+        assert len(mets.txts) == 4
+        assert len(mets.pos) == 5
+        # struct map should include only complete pages, in order,
+        # referencing the files for each page
+        assert len(mets.structmap) == 4
+        tiffs = dict((tif.id, tif.href) for tif in mets.tiffs)
+        txts = dict((txt.id, txt.href) for txt in mets.txts)
+        poss = dict((pos.id, pos.href) for pos in mets.pos)
+        pages = ['00000001', '00000002', '00000003', '00000010']
+        for i, page in enumerate(pages):
+            struct = mets.structmap[i]
+            assert struct.order == str(i + 1)
+            assert tiffs[struct.tif] == '%s.tif' % page
+            assert txts[struct.txt] == '%s.txt' % page
+            assert poss[struct.pos] == '%s.pos' % page
+
+        output = capsys.readouterr()
+        assert 'Error! Some files are missing in the volume for page 00000004' \
+            in output[0]
+
     def test_relationship_metadata(self, lsdibag):
+        # start with an empty book and collection cache
+        lsdibag.fedora_cache = Cache()
         # use mock for fedora repo object
         mockrepo = Mock()
         lsdibag.repo = mockrepo
@@ -480,9 +1002,21 @@ class TestLsdiBaggee:
         assert rel_info['DigWF Collection']['id'] == 10
         assert rel_info['DigWF Collection']['name'] == 'Atlanta City Directories'
 
-        # simulate actual objects
+        # simulate book and collection lookups failing (eulfedora
+        # reports any failed request as a nonexistent object)
         mockvol.exists = True
         mockvol.book.pid = 'book:1'
+        mockvol.book.exists = False
+        rel_info = lsdibag.relationship_metadata_info()
+        assert 'Fedora Book' not in rel_info
+        assert 'Fedora Collection' not in rel_info
+        # failed lookups are not cached
+        assert lsdibag.fedora_cache.get('book:1') is None
+        assert lsdibag.fedora_cache.get('collection:coll:1') is None
+        mockvol.book.exists = True
+        mockvol.book.collection.exists = True
+
+        # simulate actual objects
         mockvol.book.ark_uri = 'http:/pid.co/ark:/1234/56'
         mockvol.book.ark = 'ark:/1234/56'
         mockvol.book.label = 'ocm12345'
@@ -502,12 +1036,141 @@ class TestLsdiBaggee:
         assert rel_info['Fedora Collection']['ark_uri'] == mockvol.book.collection.ark_uri
         assert rel_info['Fedora Collection']['name'] == mockvol.book.collection.label
 
+        # book and collection information should be cached for other
+        # volumes of the same book
+        mockbook = mockvol.book
+        mockvol.book = Mock(pid=mockbook.pid)
+        cached_info = lsdibag.relationship_metadata_info()
+        assert cached_info == rel_info
+        assert not mockvol.book.collection.mock_calls
+
+        # collection info is fetched if not cached
+        del lsdibag.fedora_cache._items['collection:coll:1']
+        mockrepo.get_object.reset_mock()
+        mockrepo.get_object.side_effect = [mockvol, mockbook.collection]
+        assert lsdibag.relationship_metadata_info() == rel_info
+        mockrepo.get_object.assert_called_with('coll:1',
+                                               type=fedora.Collection)
+        mockrepo.get_object.side_effect = None
+
         # no pid, doesn't try to do fedora lookup
         lsdibag.item.pid = None
         mockrepo.get_object.reset_mock()
         lsdibag.relationship_metadata_info()
         mockrepo.get_object.assert_not_called()
 
+    def test_relationship_metadata_collection_error(self, lsdibag):
+        lsdibag.fedora_cache = Cache()
+        mockrepo = Mock()
+        lsdibag.repo = mockrepo
+        mockvol = mockrepo.get_object.return_value
+        mockvol.book.pid = 'book:1'
+        mockvol.book.label = 'ocm12345'
+        mockvol.book.ark_uri = None
+        mockvol.book.collection.pid = 'coll:1'
+        # collection lookup fails for the first volume
+        mockvol.book.collection.exists = False
+        mockrepo.get_object.side_effect = [mockvol, Mock(exists=False)]
+        rel_info = lsdibag.relationship_metadata_info()
+        assert rel_info['Fedora Book']['pid'] == 'book:1'
+        assert 'Fedora Collection' not in rel_info
+        assert lsdibag.fedora_cache.get('collection:coll:1') is None
+
+        # collection is looked up again for the next volume
+        mockcoll = Mock(pid='coll:1', label='Collection foo', ark_uri=None)
+        mockrepo.get_object.side_effect = [mockvol, mockcoll]
+        rel_info = lsdibag.relationship_metadata_info()
+        mockrepo.get_object.assert_called_with('coll:1',
+                                               type=fedora.Collection)
+        assert rel_info['Fedora Collection']['pid'] == 'coll:1'
+        assert lsdibag.fedora_cache.get('collection:coll:1') == \
+            rel_info['Fedora Collection']
+
+    def test_add_content_metadata(self, lsdibag, tmpdir, capsys):
+        output_dir = '/mnt/lsdi/ocm08951025/Output'
+        data_files = ['%s/Output.pdf' % output_dir]
+        for page in ['00000001', '00000002']:
+            data_files.extend(['%s/%s.tif' % (output_dir, page),
+                               '%s/%s.txt' % (output_dir, page),
+                               '%s/%s.pos' % (output_dir, page)])
+        with patch.object(lsdibag, 'data_files') as mock_datafiles:
+            mock_datafiles.return_value = data_files
+            lsdibag.add_content_metadata(unicode(tmpdir))
+            # file list is only generated once
+            assert mock_datafiles.call_count == 1
+
+        mets_path = os.path.join(unicode(tmpdir), 'metadata', 'content',
+                                 '%s.mets.xml' % lsdibag.item.pid)
+        mets = load_xmlobject_from_file(mets_path, Mets)
+        assert len(mets.tiffs) == 2
+        assert len(mets.pdfs) == 1
+        assert len(mets.structmap) == 2
+        # METS is written to the file, not to the console
+        assert '<mets:mets' not in capsys.readouterr()[0]
+        # no sizes or checksums before the payload is staged
+        assert mets.tiffs[0].node.get('CHECKSUM') is None
+        assert len(mets.techmd) == 0
+
+        # sizes and checksums come from the staged payload; data files
+        # don't exist, so they can't have been read again
+        lsdibag.payload = {
+            'data/00000001.tif': {'size': 2048, 'strategy': 'copy',
+                                  'checksums': {'md5': 'abc', 'sha256': 'def'}},
+            'data/00000001.txt': {'size': 10, 'strategy': 'copy',
+                                  'checksums': {'md5': '123', 'sha256': '456'}}
+        }
+        bagdir = unicode(tmpdir.mkdir('staged'))
+        with patch.object(lsdibag, 'data_files') as mock_datafiles:
+            mock_datafiles.return_value = data_files
+            lsdibag.add_content_metadata(bagdir)
+        mets_path = os.path.join(bagdir, 'metadata', 'content',
+                                 '%s.mets.xml' % lsdibag.item.pid)
+        mets = load_xmlobject_from_file(mets_path, Mets)
+        tif = mets.tiffs[0]
+        assert tif.node.get('SIZE') == '2048'
+        assert tif.node.get('CHECKSUM') == 'def'
+        assert tif.node.get('CHECKSUMTYPE') == 'SHA-256'
+        assert tif.admid == 'AMD_TECHMD_TIF0001'
+        assert mets.txts[0].node.get('CHECKSUM') == '456'
+        # technical metadata only for page images
+        assert len(mets.techmd) == 1
+        assert mets.techmd[0].href == '00000001.tif'
+        assert mets.techmd[0].size == 2048
+        assert mets.techmd[0].checksum == 'def'
+        assert mets.tiffs[1].node.get('CHECKSUM') is None
+
+    def test_add_technical_metadata(self, lsdibag, tmpdir):
+        # minimal JPEG: start of image and start of frame header only
+        jpeg = '\xff\xd8\xff\xc0\x00\x11\x08\x00\x20\x00\x10\x03' + \
+            '\x01\x11\x00' * 3
+        images = []
+        for page in ['00000001', '00000002']:
+            image = tmpdir.join('%s.jpg' % page)
+            image.write(jpeg, 'wb')
+            images.append(str(image))
+        badimage = tmpdir.join('00000003.jpg')
+        badimage.write('not a jpeg', 'wb')
+        images.append(str(badimage))
+
+        bagdir = unicode(tmpdir.mkdir('bag'))
+        lsdibag.characterization_workers = 2
+        with patch.object(lsdibag, 'image_files') as mock_imagefiles:
+            mock_imagefiles.return_value = images
+            lsdibag.add_technical_metadata(bagdir)
+
+        techdir = os.path.join(bagdir, 'metadata', 'technical')
+        assert os.path.exists(os.path.join(techdir, 'human-technical.txt'))
+        # one MIX record per page image that could be characterized
+        assert sorted(os.listdir(os.path.join(techdir, 'mix'))) == \
+            ['00000001.jpg.mix.xml', '00000002.jpg.mix.xml']
+        mix = load_xmlobject_from_file(
+            os.path.join(techdir, 'mix', '00000001.jpg.mix.xml'))
+        ns = {'mix': 'http://www.loc.gov/mix/v20'}
+        assert mix.node.xpath('string(//mix:imageWidth)', namespaces=ns) == '16'
+        assert mix.node.xpath('string(//mix:imageHeight)', namespaces=ns) == '32'
+        assert mix.node.xpath('string(//mix:colorSpace)',
+                              namespaces=ns) == 'YCbCr'
+
     def test_add_relationship_metadata(self, lsdibag, tmpdir):
         faux_rels = {'book': {'id': 'foo'}}
         with patch.object(lsdibag, 'relationship_metadata_info') as mockrel:
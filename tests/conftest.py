@@ -0,0 +1,35 @@
+from baggins.baggers.bag import Baggee
+
+
+# extend with test subclasses, to test functionality; shared by tests
+# for bag creation and bag verification
+
+class SampleBaggee(Baggee):
+
+    pid = '1234'
+    title = 'A Test Item to Bag'
+    files = None
+    desc_metadata = None
+    rel_metadata = None
+    bag_info = None
+
+    def __init__(self):
+        self.files = []
+        self.desc_metadata = []
+        self.rel_metadata = []
+        self.info = {"Source-Organization": "Rose Library", "Organization-Address": "Atlanta"}
+
+    def bag_info(self):
+        return self.info
+
+    def data_files(self):
+        return self.files
+
+    def descriptive_metadata(self):
+        return self.desc_metadata
+
+    def relationship_metadata(self):
+        return self.rel_metadata
+
+    def content_metadata(self):
+        return self.rel_metadata
@@ -1,8 +1,10 @@
 import os
 import requests
+from StringIO import StringIO
 from mock import patch
-from eulxml.xmlmap import load_xmlobject_from_file
+from eulxml.xmlmap import load_xmlobject_from_file, load_xmlobject_from_string
 
+from baggins.cache import Cache
 from baggins.lsdi import digwf
 
 
@@ -29,23 +31,121 @@ class TestDigwfClient:
         with open(self.item_response, 'r') as itemresult:
             itemresult_content = itemresult.read()
 
-        with patch('baggins.lsdi.digwf.requests') as mockrequests:
+        with patch.object(digwf_client, 'session') as mocksession:
             item_id = 3031
-            mockrequests.codes.ok = requests.codes.ok
-            mockrequests.get.return_value.status_code = requests.codes.ok
+            mocksession.get.return_value.status_code = requests.codes.ok
             # simulate valid return with fixture data
-            mockrequests.get.return_value.content = itemresult_content
+            mocksession.get.return_value.content = itemresult_content
             result = digwf_client.get_items(item_id=item_id)
             assert isinstance(result, digwf.Items)
 
             expected_url = '%s/getItems' % api_url
-            mockrequests.get.assert_called_with(
-                expected_url, params={'item_id': item_id})
+            mocksession.get.assert_called_with(
+                expected_url, params={'item_id': item_id},
+                timeout=digwf_client.timeout)
 
             # error response should raise an exception
-            mockrequests.get.return_value.status_code = 400
+            mocksession.get.return_value.status_code = 400
             result = digwf_client.get_items(item_id=item_id)
-            mockrequests.get.return_value.raise_for_status.assert_called_once()
+            mocksession.get.return_value.raise_for_status.assert_called_once()
+
+    def test_get_items_cached(self, tmpdir):
+        api_url = 'http://my.domain.com/digwf_api'
+        api_cache = Cache(path=os.path.join(str(tmpdir), 'cache.db'),
+                          name='digwf')
+        digwf_client = digwf.Client(api_url, cache=api_cache)
+        with open(self.item_response, 'r') as itemresult:
+            itemresult_content = itemresult.read()
+
+        with patch.object(digwf_client, 'session') as mocksession:
+            mocksession.get.return_value.status_code = requests.codes.ok
+            mocksession.get.return_value.content = itemresult_content
+            result = digwf_client.get_items(item_id=3031)
+            assert result.items[0].pid == '7svgb'
+            # second lookup should use the cached response
+            result = digwf_client.get_items(item_id=3031)
+            assert result.items[0].pid == '7svgb'
+            assert mocksession.get.call_count == 1
+            # different query is not cached
+            digwf_client.get_items(item_id=3032)
+            assert mocksession.get.call_count == 2
+
+            # error responses are not cached
+            mocksession.get.return_value.status_code = 500
+            digwf_client.get_items(item_id=3033)
+            digwf_client.get_items(item_id=3033)
+            assert mocksession.get.call_count == 4
+
+            # responses with no matching items are not cached
+            mocksession.get.return_value.status_code = requests.codes.ok
+            with open(self.empty_response, 'r') as nomatch:
+                mocksession.get.return_value.content = nomatch.read()
+            assert digwf_client.get_items(item_id=3034).count == 0
+            mocksession.get.return_value.content = itemresult_content
+            assert digwf_client.get_items(item_id=3034).count == 1
+            assert mocksession.get.call_count == 6
+
+        # new client using the same cache file doesn't make a request
+        digwf_client = digwf.Client(
+            api_url, cache=Cache(path=api_cache.path, name='digwf'))
+        with patch.object(digwf_client, 'session') as mocksession:
+            result = digwf_client.get_items(item_id=3031)
+            assert result.items[0].pid == '7svgb'
+            mocksession.get.assert_not_called()
+
+    def test_get_items_by_id(self):
+        digwf_client = digwf.Client('http://my.domain.com/digwf_api')
+        item_response = load_xmlobject_from_file(self.item_response,
+                                                 digwf.Items)
+        empty_response = load_xmlobject_from_file(self.empty_response,
+                                                  digwf.Items)
+        responses = {
+            '3031': item_response,
+            '3032': empty_response,
+        }
+
+        def get_items(item_id):
+            if item_id == '500':
+                raise requests.exceptions.HTTPError('server error')
+            return responses[item_id]
+
+        with patch.object(digwf_client, 'get_items') as mockget_items:
+            mockget_items.side_effect = get_items
+            items = digwf_client.get_items_by_id(['3031', '3032', '500'])
+            # only ids that match a single item are included
+            assert items.keys() == ['3031']
+            assert items['3031'] == item_response.items[0]
+            assert mockget_items.call_count == 3
+
+            # sequential lookup
+            mockget_items.reset_mock()
+            items = digwf_client.get_items_by_id(['3031', '3032'],
+                                                 max_workers=1)
+            assert items.keys() == ['3031']
+            assert mockget_items.call_count == 2
+
+            assert digwf_client.get_items_by_id([]) == {}
+
+    def test_session(self):
+        api_url = 'http://my.domain.com/digwf_api'
+        digwf_client = digwf.Client(api_url)
+        assert isinstance(digwf_client.session, requests.Session)
+        adapter = digwf_client.session.get_adapter(api_url)
+        assert adapter._pool_maxsize == digwf.Client.pool_size
+        assert adapter.max_retries.total == digwf.Client.retries
+        assert 503 in adapter.max_retries.status_forcelist
+        # https should use the same pooled adapter
+        assert digwf_client.session.get_adapter('https://my.domain.com/') \
+            is adapter
+
+        # custom settings
+        digwf_client = digwf.Client(api_url, pool_size=2, timeout=5,
+                                    retries=0, backoff_factor=1)
+        assert digwf_client.timeout == 5
+        adapter = digwf_client.session.get_adapter(api_url)
+        assert adapter._pool_maxsize == 2
+        assert adapter.max_retries.total == 0
+        assert adapter.max_retries.backoff_factor == 1
 
     def test_items_xml(self):
         # basic inspection of sample result / xml mapping
@@ -71,5 +171,62 @@ class TestDigwfClient:
         response = load_xmlobject_from_file(self.empty_response, digwf.Items)
         assert response.count == 0
 
+    def test_parse_first_marc_record(self):
+        marc_file = os.path.join(FIXTURE_DIR, 'ocm08951025_MRC.xml')
+        record = digwf.parse_first_marc_record(marc_file)
+        assert record.title().startswith("Atlanta City Directory Co.'s")
+        assert len(record.get_fields('247')) == 8
+
+        # only requested fields are kept
+        record = digwf.parse_first_marc_record(marc_file, digwf.MARC_FIELDS)
+        assert record.title().startswith("Atlanta City Directory Co.'s")
+        assert [f.tag for f in record.get_fields()] == ['245', '583', '590']
+
+        # parsing should stop after the first record; simulate a file
+        # with more records by adding invalid content after the first
+        with open(marc_file) as marcdata:
+            content = marcdata.read()
+        content = content.replace('</collection>',
+                                  '<record><leader>not a complete record')
+        record = digwf.parse_first_marc_record(StringIO(content))
+        assert record.title().startswith("Atlanta City Directory Co.'s")
+
+        # no records
+        assert digwf.parse_first_marc_record(StringIO(
+            '<collection xmlns="http://www.loc.gov/MARC21/slim"/>')) is None
+
+    def test_item_marc(self):
+        response = load_xmlobject_from_file(self.item_response, digwf.Items)
+        item = response.items[0]
+        item.marc_path = os.path.join(FIXTURE_DIR, 'ocm08951025_MRC.xml')
+        assert item.marc.title().startswith("Atlanta City Directory Co.'s")
+        assert item.marc['247'] is None
+
+    def test_item_marc_cache(self, tmpdir):
+        response = load_xmlobject_from_file(self.item_response, digwf.Items)
+        marc_path = tmpdir.join('ocm08951025_MRC.xml')
+        marc_path.write(open(os.path.join(FIXTURE_DIR, 'ocm08951025_MRC.xml')).read())
+        response.items[0].marc_path = str(marc_path)
+        item_xml = response.items[0].serialize()
+
+        marc_cache = Cache()
+        with patch.object(digwf.Item, 'marc_cache', marc_cache):
+            item = load_xmlobject_from_string(item_xml, digwf.Item)
+            title = item.marc.title()
+            assert str(marc_path) in marc_cache._items
+
+            # a new item for the same file should use the cached record
+            item = load_xmlobject_from_string(item_xml, digwf.Item)
+            with patch.object(item, 'parse_marc') as mockparse:
+                assert item.marc.title() == title
+                mockparse.assert_not_called()
+
+            # if the file changes, it should be parsed again
+            marc_path.write('\n', mode='a')
+            item = load_xmlobject_from_string(item_xml, digwf.Item)
+            with patch.object(item, 'parse_marc') as mockparse:
+                item.marc
+                mockparse.assert_called_once()
+
 
 
@@ -1,6 +1,10 @@
-from mock import Mock
+from mock import Mock, patch
+import requests
 
-from baggins.lsdi.fedora import ArkDigitalObject
+from eulfedora.server import Repository
+
+from baggins.lsdi import fedora
+from baggins.lsdi.fedora import ArkDigitalObject, FedoraMonitor
 
 
 class TestArkDigitalObject:
@@ -38,3 +42,53 @@ class TestArkDigitalObject:
         # cached property, should still be None
         assert arkobj.ark == ark
 
+
+def test_pool_connections():
+    repo = Repository('http://fed.dig:8080/fedora/')
+    assert fedora.pool_connections(repo, 25) is repo
+    adapter = repo.api.session.get_adapter('http://fed.dig:8080/fedora/')
+    assert adapter._pool_maxsize == 25
+    fedora.pool_connections(repo)
+    adapter = repo.api.session.get_adapter('https://fed.dig/fedora/')
+    assert adapter._pool_maxsize == fedora.POOL_SIZE
+
+
+class TestFedoraMonitor:
+
+    fedora_url = 'http://fed.dig:8080/fedora/'
+
+    @patch('baggins.lsdi.fedora.requests.head')
+    def test_check(self, mockhead):
+        monitor = FedoraMonitor(self.fedora_url, timeout=3)
+        assert monitor.check()
+        mockhead.assert_called_with(self.fedora_url, timeout=3)
+        assert monitor.last_success is not None
+
+        mockhead.side_effect = requests.ConnectionError
+        assert not monitor.check()
+        assert monitor.last_success is None
+
+        mockhead.side_effect = requests.Timeout
+        assert not monitor.check()
+
+    @patch('baggins.lsdi.fedora.time.time')
+    @patch('baggins.lsdi.fedora.requests.head')
+    def test_available(self, mockhead, mocktime):
+        mocktime.return_value = 1000
+        monitor = FedoraMonitor(self.fedora_url, interval=60)
+        # first call checks, then result is cached
+        assert monitor.available()
+        assert monitor.available()
+        assert mockhead.call_count == 1
+
+        # checked again once the interval has passed
+        mocktime.return_value = 1061
+        assert monitor.available()
+        assert mockhead.call_count == 2
+
+        # checked again after a reported failure
+        monitor.failed()
+        mockhead.side_effect = requests.ConnectionError
+        assert not monitor.available()
+        assert not monitor.available()
+        assert mockhead.call_count == 4
@@ -1,5 +1,6 @@
 import os
 from eulxml.xmlmap import load_xmlobject_from_file
+from lxml import etree
 from baggins.lsdi import mets
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), '..', 'fixtures')
@@ -12,3 +13,72 @@ class TestMets:
 
     def test_mets(self):
     	response = load_xmlobject_from_file(self.mets_response, mets.Mets)
+
+    def test_local_schema(self):
+        # schema should be bundled locally, and not loaded at import time
+        assert os.path.exists(mets.METS_SCHEMA)
+        assert mets.Mets.XSD_SCHEMA == mets.METS_SCHEMA
+        assert 'xmlschema' not in mets.Mets.__dict__
+
+        response = load_xmlobject_from_file(self.mets_response, mets.Mets)
+        schema = response.xmlschema
+        assert isinstance(schema, etree.XMLSchema)
+        # compiled schema should be cached and reused
+        assert response.xmlschema is schema
+        assert mets.Mets().xmlschema is schema
+
+
+def test_preferred_checksum():
+    assert mets.preferred_checksum({'md5': 'abc', 'sha256': 'def'}) == \
+        ('SHA-256', 'def')
+    assert mets.preferred_checksum({'md5': 'abc'}) == ('MD5', 'abc')
+    assert mets.preferred_checksum({'crc': '123'}) is None
+
+
+def test_write_mets(tmpdir):
+    tif1 = mets.FileInfo('TIF0001', 'image/tiff', '00000001.tif', size=1024,
+                         checksum_type='SHA-256', checksum='abc123',
+                         admid='AMD_TECHMD_TIF0001')
+    file_groups = [
+        ('TIFF', [tif1,
+                  mets.FileInfo('TIF0002', 'image/tiff', '00000002.tif')]),
+        ('TXT', [mets.FileInfo('TXT0001', 'plain/text', '00000001.txt')]),
+        ('ALTO', [mets.FileInfo('POS0001', 'text/plain', '00000001.pos')])
+    ]
+    pages = [['TIF0001', 'POS0001', 'TXT0001']]
+    metsfile = str(tmpdir.join('test.mets.xml'))
+    mets.write_mets(metsfile, file_groups, pages, techmd=[tif1])
+
+    doc = load_xmlobject_from_file(metsfile, mets.Mets)
+    assert doc.is_valid()
+    assert [(tif.id, tif.mimetype, tif.loctype, tif.href)
+            for tif in doc.tiffs] == \
+        [('TIF0001', 'image/tiff', 'URL', '00000001.tif'),
+         ('TIF0002', 'image/tiff', 'URL', '00000002.tif')]
+    assert len(doc.txts) == 1
+    assert len(doc.pos) == 1
+    assert len(doc.structmap) == 1
+    page = doc.structmap[0]
+    assert (page.order, page.tif, page.pos, page.txt) == \
+        ('1', 'TIF0001', 'POS0001', 'TXT0001')
+    assert doc.node.get('{%s}schemaLocation' % mets.XSI_NS) == \
+        '%s %s' % (mets.METS_NS, mets.METS_SCHEMA_URL)
+
+    # size and checksum on the file, with technical metadata
+    tif_node = doc.tiffs[0].node
+    assert tif_node.get('SIZE') == '1024'
+    assert tif_node.get('CHECKSUM') == 'abc123'
+    assert tif_node.get('CHECKSUMTYPE') == 'SHA-256'
+    assert doc.tiffs[0].admid == 'AMD_TECHMD_TIF0001'
+    assert doc.tiffs[1].node.get('CHECKSUM') is None
+    assert len(doc.techmd) == 1
+    techmd = doc.techmd[0]
+    assert (techmd.id, techmd.href, techmd.size, techmd.mimetype,
+            techmd.checksum) == \
+        ('AMD_TECHMD_TIF0001', '00000001.tif', 1024, 'image/tiff', 'abc123')
+
+    # written with indentation, like a pretty-printed document
+    with open(metsfile) as output:
+        lines = output.read().splitlines()
+    assert lines[1] == '  <mets:dmdSec ID="DMD1"></mets:dmdSec>'
+    assert lines[-1] == '</mets:mets>'
@@ -0,0 +1,70 @@
+import hashlib
+import os
+import pytest
+import tarfile
+import zipfile
+
+from baggins import archive, fixity
+
+
+class TestArchive:
+
+    content = 'some file content to archive' * 1000
+
+    def check_checksums(self, size, checksums):
+        assert size == len(self.content)
+        assert checksums == {
+            'md5': hashlib.md5(self.content).hexdigest(),
+            'sha256': hashlib.sha256(self.content).hexdigest()
+        }
+
+    def write_archive(self, tmpdir, serialization):
+        testfile = tmpdir.join('page.jpg')
+        testfile.write(self.content)
+        tagdir = tmpdir.mkdir('tags')
+        tagdir.join('bagit.txt').write('BagIt-Version: 0.97\n')
+        tagdir.mkdir('metadata').join('mets.xml').write('<mets/>')
+
+        path = os.path.join(unicode(tmpdir), 'bag' +
+                            archive.EXTENSIONS[serialization])
+        writer = archive.open_archive(path, serialization)
+        # use a small block size to check multiple reads
+        fixity.BLOCK_SIZE, block_size = 1024, fixity.BLOCK_SIZE
+        try:
+            size, checksums = writer.add_file(
+                str(testfile), 'bag/data/page.jpg', ['md5', 'sha256'],
+                threaded=True)
+        finally:
+            fixity.BLOCK_SIZE = block_size
+        writer.add_tree(str(tagdir), 'bag')
+        writer.close()
+        self.check_checksums(size, checksums)
+        return path
+
+    @pytest.mark.parametrize('serialization', [archive.TAR, archive.TAR_GZ])
+    def test_tar(self, tmpdir, serialization):
+        path = self.write_archive(tmpdir, serialization)
+        with tarfile.open(path) as tar:
+            assert tar.getnames() == ['bag/data/page.jpg', 'bag/bagit.txt',
+                                      'bag/metadata/mets.xml']
+            payload = tar.getmember('bag/data/page.jpg')
+            assert payload.mode == archive.PAYLOAD_MODE
+            assert tar.extractfile(payload).read() == self.content
+            assert tar.extractfile('bag/metadata/mets.xml').read() == \
+                '<mets/>'
+
+    def test_zip(self, tmpdir):
+        path = self.write_archive(tmpdir, archive.ZIP)
+        zfile = zipfile.ZipFile(path)
+        try:
+            assert zfile.namelist() == ['bag/data/page.jpg', 'bag/bagit.txt',
+                                        'bag/metadata/mets.xml']
+            assert zfile.testzip() is None
+            assert zfile.read('bag/data/page.jpg') == self.content
+            assert zfile.read('bag/metadata/mets.xml') == '<mets/>'
+        finally:
+            zfile.close()
+
+    def test_open_archive(self, tmpdir):
+        with pytest.raises(ValueError):
+            archive.open_archive(str(tmpdir.join('bag.7z')), '7z')
@@ -0,0 +1,76 @@
+import os
+
+from mock import patch, Mock
+
+from baggins.cache import Cache
+
+
+class TestCache:
+
+    def test_get_set(self):
+        cache = Cache()
+        assert cache.get('foo') is None
+        assert cache.get('foo', 'default') == 'default'
+        cache.set('foo', {'pid': 'foo:1'})
+        assert cache.get('foo') == {'pid': 'foo:1'}
+        assert len(cache) == 1
+        cache.clear()
+        assert cache.get('foo') is None
+
+    def test_lru(self):
+        cache = Cache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # access a so b is least recently used
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert len(cache) == 2
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    @patch('baggins.cache.time.time')
+    def test_ttl(self, mocktime):
+        mocktime.return_value = 1000
+        cache = Cache(ttl=60)
+        cache.set('a', 1)
+        mocktime.return_value = 1060
+        assert cache.get('a') == 1
+        mocktime.return_value = 1061
+        assert cache.get('a') is None
+
+    def test_get_or_set(self):
+        cache = Cache()
+        func = Mock(return_value=None)
+        # None values are cached
+        assert cache.get_or_set('a', func) is None
+        assert cache.get_or_set('a', func) is None
+        assert func.call_count == 1
+
+        # values can be excluded from caching
+        assert cache.get_or_set('b', func, cache_if=bool) is None
+        assert cache.get_or_set('b', func, cache_if=bool) is None
+        assert func.call_count == 3
+        func.return_value = 'found'
+        assert cache.get_or_set('b', func, cache_if=bool) == 'found'
+        assert cache.get('b') == 'found'
+
+    @patch('baggins.cache.time.time')
+    def test_persistent(self, mocktime, tmpdir):
+        mocktime.return_value = 1000
+        path = os.path.join(str(tmpdir), 'cache.db')
+        cache = Cache(path=path, ttl=60)
+        cache.set('book:1', ({'pid': 'book:1'}, 'coll:1'))
+
+        # new cache with the same file should find values
+        cache = Cache(path=path, ttl=60)
+        assert cache.get('book:1') == ({'pid': 'book:1'}, 'coll:1')
+        # separate table in the same file is independent
+        assert Cache(path=path, name='other').get('book:1') is None
+
+        # expiration applies to values loaded from disk
+        mocktime.return_value = 1100
+        assert Cache(path=path, ttl=60).get('book:1') is None
+
+        cache.clear()
+        assert Cache(path=path).get('book:1') is None
@@ -0,0 +1,191 @@
+from io import BytesIO
+import struct
+
+from lxml import etree
+import pytest
+
+from baggins import characterize
+
+
+def tiff_header(byte_order='<', width=2000, height=3000, bits=(8, 8, 8),
+                compression=5, photometric=2):
+    # minimal TIFF header with a single image file directory; bits per
+    # sample for multiple samples don't fit in the IFD entry, so they
+    # are stored after it
+    entries = [(256, 3, 1, struct.pack(byte_order + 'HH', width, 0)),
+               (257, 4, 1, struct.pack(byte_order + 'I', height)),
+               (259, 3, 1, struct.pack(byte_order + 'HH', compression, 0)),
+               (262, 3, 1, struct.pack(byte_order + 'HH', photometric, 0)),
+               (277, 3, 1, struct.pack(byte_order + 'HH', len(bits), 0)),
+               # unsupported field type (ASCII) is ignored
+               (305, 2, 4, 'abc\x00')]
+    ifd_end = 8 + 2 + 12 * (len(entries) + 1) + 4
+    if len(bits) > 2:
+        bits_value = struct.pack(byte_order + 'I', ifd_end)
+    else:
+        bits_value = struct.pack(byte_order + '%dH' % len(bits), *bits) \
+            .ljust(4, '\x00')
+    entries.insert(2, (258, 3, len(bits), bits_value))
+    data = ('II' if byte_order == '<' else 'MM') + \
+        struct.pack(byte_order + 'HI', 42, 8) + \
+        struct.pack(byte_order + 'H', len(entries))
+    for entry in entries:
+        data += struct.pack(byte_order + 'HHI4s', *entry)
+    data += struct.pack(byte_order + 'I', 0)
+    if len(bits) > 2:
+        data += struct.pack(byte_order + '%dH' % len(bits), *bits)
+    return data
+
+
+def jpeg_header(width=640, height=480, components=3):
+    return '\xff\xd8' + \
+        '\xff\xe0' + struct.pack('>H', 16) + 'JFIF\x00' + '\x00' * 9 + \
+        '\xff\xdb' + struct.pack('>H', 67) + '\x00' * 65 + \
+        '\xff\xff\xc0' + struct.pack('>HBHHB', 8 + 3 * components, 8,
+                                     height, width, components) + \
+        '\x01\x11\x00' * components + \
+        '\xff\xda' + struct.pack('>H', 2)
+
+
+def jp2_box(box_type, content):
+    return struct.pack('>I4s', 8 + len(content), box_type) + content
+
+
+def jp2_header(width=1200, height=1800, components=1, bpc=8, colourspace=17):
+    ihdr = jp2_box('ihdr', struct.pack('>IIHBBBB', height, width,
+                                       components, bpc - 1, 7, 0, 0))
+    colr = jp2_box('colr', struct.pack('>BBBI', 1, 0, 0, colourspace))
+    return '\x00\x00\x00\x0cjP  \r\n\x87\n' + \
+        jp2_box('ftyp', 'jp2 \x00\x00\x00\x00jp2 ') + \
+        jp2_box('jp2h', ihdr + colr)
+
+
+class CountingFile(BytesIO):
+    # file-like object that keeps track of how much is read
+
+    def __init__(self, data):
+        BytesIO.__init__(self, data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = BytesIO.read(self, size)
+        self.bytes_read += len(data)
+        return data
+
+
+class TestCharacterize:
+
+    @pytest.mark.parametrize('byte_order', ['<', '>'])
+    def test_tiff(self, byte_order):
+        info = characterize.characterize_tiff(
+            BytesIO(tiff_header(byte_order)))
+        assert info['mimetype'] == 'image/tiff'
+        assert info['width'] == 2000
+        assert info['height'] == 3000
+        assert info['bits_per_sample'] == [8, 8, 8]
+        assert info['samples_per_pixel'] == 3
+        assert info['compression'] == 'LZW'
+        assert info['color_space'] == 'RGB'
+        assert info['byte_order'] == ('little endian' if byte_order == '<'
+                                      else 'big endian')
+
+        # bilevel, with bits per sample stored in the entry
+        info = characterize.characterize_tiff(BytesIO(tiff_header(
+            byte_order, bits=(1, ), compression=4, photometric=0)))
+        assert info['bits_per_sample'] == [1]
+        assert info['compression'] == 'CCITT Group 4'
+        assert info['color_space'] == 'WhiteIsZero'
+
+        with pytest.raises(characterize.CharacterizationError):
+            characterize.characterize_tiff(BytesIO('II+\x00' + '\x00' * 12))
+
+    def test_jpeg(self):
+        img = CountingFile(jpeg_header() + '\x00' * 4096)
+        info = characterize.characterize_jpeg(img)
+        assert info['mimetype'] == 'image/jpeg'
+        assert (info['width'], info['height']) == (640, 480)
+        assert info['bits_per_sample'] == [8, 8, 8]
+        assert info['color_space'] == 'YCbCr'
+        # marker payloads are skipped, not read
+        assert img.bytes_read < 20
+
+        info = characterize.characterize_jpeg(
+            BytesIO(jpeg_header(components=1)))
+        assert info['color_space'] == 'BlackIsZero'
+
+        # start of scan before the frame header
+        with pytest.raises(characterize.CharacterizationError):
+            characterize.characterize_jpeg(BytesIO('\xff\xd8\xff\xda'))
+
+    def test_jp2(self):
+        img = CountingFile(jp2_header() + jp2_box('jp2c', '\x00' * 4096))
+        info = characterize.characterize_jp2(img)
+        assert info['mimetype'] == 'image/jp2'
+        assert (info['width'], info['height']) == (1200, 1800)
+        assert info['bits_per_sample'] == [8]
+        assert info['samples_per_pixel'] == 1
+        assert info['compression'] == 'JPEG 2000'
+        assert info['color_space'] == 'greyscale'
+        # codestream is not read
+        assert img.bytes_read < 100
+
+        with pytest.raises(characterize.CharacterizationError):
+            characterize.characterize_jp2(BytesIO(
+                '\x00\x00\x00\x0cjP  \r\n\x87\n' + jp2_box('jp2c', '')))
+
+    def test_characterize(self, tmpdir):
+        tiff = tmpdir.join('page.jpg')
+        tiff.write(tiff_header() + '\x00' * 1024, 'wb')
+        info = characterize.characterize(str(tiff))
+        # format is based on signature, not file name
+        assert info['mimetype'] == 'image/tiff'
+        assert info['size'] == tiff.size()
+
+        jp2 = tmpdir.join('page.jp2')
+        jp2.write(jp2_header(), 'wb')
+        assert characterize.characterize(str(jp2))['mimetype'] == 'image/jp2'
+
+        text = tmpdir.join('page.txt')
+        text.write('not an image', 'wb')
+        with pytest.raises(characterize.CharacterizationError):
+            characterize.characterize(str(text))
+
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_characterize_files(self, tmpdir, workers):
+        paths = []
+        for i in range(4):
+            img = tmpdir.join('%04d.tif' % i)
+            img.write(tiff_header(width=100 + i), 'wb')
+            paths.append(str(img))
+        bad = tmpdir.join('0005.tif')
+        bad.write('II*\x00', 'wb')
+        paths.append(str(bad))
+
+        results = characterize.characterize_files(paths, workers)
+        # results are in the requested order
+        assert [path for path, info in results] == paths
+        assert [info['width'] for path, info in results[:4]] == \
+            [100, 101, 102, 103]
+        assert results[4][1] is None
+
+    def test_mix_record(self, tmpdir):
+        info = characterize.characterize_tiff(BytesIO(tiff_header()))
+        info['size'] = 2048
+        mix = characterize.mix_record(info, '00000001.tif')
+        ns = {'mix': characterize.MIX_NS}
+        assert mix.xpath('string(.//mix:objectIdentifierValue)',
+                         namespaces=ns) == '00000001.tif'
+        assert mix.xpath('string(.//mix:fileSize)', namespaces=ns) == '2048'
+        assert mix.xpath('string(.//mix:compressionScheme)',
+                         namespaces=ns) == 'LZW'
+        assert mix.xpath('string(.//mix:imageWidth)', namespaces=ns) == '2000'
+        assert mix.xpath('string(.//mix:colorSpace)', namespaces=ns) == 'RGB'
+        assert mix.xpath('string(.//mix:bitsPerSampleValue)',
+                         namespaces=ns) == '8,8,8'
+        assert mix.xpath('string(.//mix:samplesPerPixel)',
+                         namespaces=ns) == '3'
+
+        path = str(tmpdir.join('00000001.tif.mix.xml'))
+        characterize.write_mix(path, info, '00000001.tif')
+        assert etree.parse(path).getroot().tag == \
+            '{%s}mix' % characterize.MIX_NS
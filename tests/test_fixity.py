@@ -0,0 +1,82 @@
+import hashlib
+import os
+import tempfile
+
+from baggins import fixity
+
+
+class TestFixity:
+
+    content = 'some file content to checksum' * 1000
+
+    def test_hash_file(self, tmpdir):
+        testfile = tempfile.NamedTemporaryFile(dir=unicode(tmpdir))
+        testfile.write(self.content)
+        testfile.flush()
+
+        size, checksums = fixity.hash_file(testfile.name, ['md5', 'sha256'])
+        assert size == len(self.content)
+        assert checksums == {
+            'md5': hashlib.md5(self.content).hexdigest(),
+            'sha256': hashlib.sha256(self.content).hexdigest()
+        }
+
+    def test_hash_file_threaded(self, tmpdir):
+        testfile = tempfile.NamedTemporaryFile(dir=unicode(tmpdir))
+        testfile.write(self.content)
+        testfile.flush()
+
+        # use a small block size to check multiple queued blocks
+        fixity.BLOCK_SIZE, block_size = 1024, fixity.BLOCK_SIZE
+        try:
+            size, checksums = fixity.hash_file(
+                testfile.name, ['md5', 'sha1', 'sha256'], threaded=True)
+        finally:
+            fixity.BLOCK_SIZE = block_size
+        assert size == len(self.content)
+        assert checksums == {
+            'md5': hashlib.md5(self.content).hexdigest(),
+            'sha1': hashlib.sha1(self.content).hexdigest(),
+            'sha256': hashlib.sha256(self.content).hexdigest()
+        }
+
+    def test_multihasher(self):
+        hasher = fixity.MultiHasher(['md5', 'sha256'], threaded=True)
+        assert len(hasher.threads) == 2
+        hasher.update('abc')
+        hasher.update('def')
+        assert hasher.hexdigests() == {
+            'md5': hashlib.md5('abcdef').hexdigest(),
+            'sha256': hashlib.sha256('abcdef').hexdigest()
+        }
+        # threads should be finished once digests are returned
+        assert not hasher.threads
+
+        # no threads needed for a single algorithm
+        hasher = fixity.MultiHasher(['md5'], threaded=True)
+        assert not hasher.threads
+
+    def test_copy_and_hash(self, tmpdir):
+        testfile = tempfile.NamedTemporaryFile(dir=unicode(tmpdir))
+        testfile.write(self.content)
+        testfile.flush()
+        os.utime(testfile.name, (1000000000, 1000000000))
+        copy = os.path.join(unicode(tmpdir), 'copy.txt')
+
+        # use a small block size to check multiple reads
+        fixity.BLOCK_SIZE, block_size = 1024, fixity.BLOCK_SIZE
+        try:
+            size, checksums = fixity.copy_and_hash(testfile.name, copy,
+                                                   ['md5', 'sha1'])
+        finally:
+            fixity.BLOCK_SIZE = block_size
+
+        with open(copy, 'rb') as copied:
+            assert copied.read() == self.content
+        # file stats should be preserved
+        assert os.stat(copy).st_mtime == 1000000000
+        assert size == len(self.content)
+        assert checksums == {
+            'md5': hashlib.md5(self.content).hexdigest(),
+            'sha1': hashlib.sha1(self.content).hexdigest()
+        }
@@ -0,0 +1,69 @@
+import os
+import time
+
+from baggins.fixity_index import FixityIndex
+
+
+class TestFixityIndex:
+
+    def test_update_get(self, tmpdir):
+        index = FixityIndex(str(tmpdir.join('index.db')))
+        datafile = tmpdir.join('file.txt')
+        datafile.write('content')
+        assert index.get(str(datafile)) is None
+
+        signature = FixityIndex.signature(str(datafile))
+        assert signature[0] == len('content')
+        index.update([(str(datafile), signature, {'md5': 'abc'})])
+        info = index.get(str(datafile))
+        assert (info['size'], info['mtime'], info['inode']) == signature
+        assert info['checksums'] == {'md5': 'abc'}
+        assert info['verified'] <= time.time()
+
+    def test_stale(self, tmpdir):
+        index = FixityIndex(str(tmpdir.join('index.db')), sample_rate=0)
+        files = {}
+        for i in range(4):
+            datafile = tmpdir.join('file%d.txt' % i)
+            datafile.write('content %d' % i)
+            files[str(datafile)] = {'md5': 'sum%d' % i}
+
+        # nothing indexed yet: everything is stale
+        stale = index.stale(files)
+        assert sorted(stale.keys()) == sorted(files.keys())
+        index.update([(path, stale[path], files[path]) for path in files])
+        assert index.stale(files) == {}
+
+        # changed content, changed manifest, missing file
+        file0, file1, file2, file3 = sorted(files.keys())
+        with open(file0, 'a') as datafile:
+            datafile.write('more')
+        files[file1] = {'md5': 'newsum'}
+        os.remove(file2)
+        stale = index.stale(files)
+        assert sorted(stale.keys()) == [file0, file1, file2]
+        assert stale[file0] == FixityIndex.signature(file0)
+        assert stale[file2] is None
+
+        # maximum age since last verification
+        index.max_age = 0
+        assert file3 in index.stale(files)
+
+    def test_stale_sample(self, tmpdir):
+        index = FixityIndex(str(tmpdir.join('index.db')), sample_rate=0.5)
+        files = {}
+        for i in range(4):
+            datafile = tmpdir.join('file%d.txt' % i)
+            datafile.write('content %d' % i)
+            files[str(datafile)] = {'md5': 'sum%d' % i}
+            # index files one at a time, so verification times differ
+            index.update([(str(datafile), FixityIndex.signature(str(datafile)),
+                           files[str(datafile)])])
+            time.sleep(0.01)
+
+        # least recently verified files are sampled first
+        paths = sorted(files.keys())
+        stale = index.stale(files)
+        assert sorted(stale.keys()) == paths[:2]
+        index.update([(path, stale[path], files[path]) for path in stale])
+        assert sorted(index.stale(files).keys()) == paths[2:]
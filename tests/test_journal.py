@@ -0,0 +1,71 @@
+import os
+import threading
+
+import pytest
+
+from baggins import journal
+
+
+class TestJournal:
+
+    def test_update(self, tmpdir):
+        path = os.path.join(str(tmpdir), 'journal.db')
+        jobs = journal.Journal(path)
+        assert jobs.get('1234') is None
+
+        jobs.update('1234', journal.FETCHING)
+        job = jobs.get('1234')
+        assert job['item_id'] == '1234'
+        assert job['state'] == journal.FETCHING
+        assert job['bag'] is None
+        assert job['updated']
+
+        # bag path is kept when not specified
+        jobs.update(1234, journal.STAGING, bag='/tmp/bags/1234')
+        jobs.update(1234, journal.FAILED, error='failed to copy')
+        job = jobs.get(1234)
+        assert job['state'] == journal.FAILED
+        assert job['bag'] == '/tmp/bags/1234'
+        assert job['error'] == 'failed to copy'
+
+        # error is cleared by later updates
+        jobs.update(1234, journal.DONE)
+        assert jobs.get(1234)['error'] is None
+
+        # state is available to a new journal using the same file
+        assert journal.Journal(path).get('1234')['state'] == journal.DONE
+
+        with pytest.raises(ValueError):
+            jobs.update(1234, 'bogus')
+
+    def test_update_all(self, tmpdir):
+        jobs = journal.Journal(os.path.join(str(tmpdir), 'journal.db'))
+        jobs.update('1', journal.FAILED, bag='/tmp/bags/1', error='oops')
+        jobs.update_all(['1', '2', '3'], journal.PENDING)
+        items = jobs.items()
+        assert [job['item_id'] for job in items] == ['1', '2', '3']
+        assert all(job['state'] == journal.PENDING for job in items)
+        assert items[0]['bag'] == '/tmp/bags/1'
+        assert items[0]['error'] is None
+
+        jobs.update('2', journal.DONE)
+        assert [job['item_id'] for job in jobs.items(journal.PENDING)] == \
+            ['1', '3']
+        assert [job['item_id'] for job in jobs.items(journal.DONE)] == ['2']
+
+    def test_threads(self, tmpdir):
+        jobs = journal.Journal(os.path.join(str(tmpdir), 'journal.db'))
+        jobs.update('1', journal.PENDING)
+        errors = []
+
+        def update():
+            # each thread uses its own database connection
+            try:
+                jobs.update('1', journal.DONE)
+            except Exception as err:
+                errors.append(err)
+        thread = threading.Thread(target=update)
+        thread.start()
+        thread.join()
+        assert errors == []
+        assert jobs.get('1')['state'] == journal.DONE
@@ -0,0 +1,73 @@
+import json
+import logging
+import pytest
+
+from baggins import metrics
+
+
+class TestMetrics:
+
+    def test_stage(self, caplog):
+        bag_metrics = metrics.BagMetrics('test-bag')
+        with caplog.at_level(logging.INFO, logger='baggins.metrics'):
+            with bag_metrics.stage('copy') as stage:
+                stage.files = 2
+                stage.bytes_read = stage.bytes_written = 2 * 1024 * 1024
+        assert len(bag_metrics.stages) == 1
+        assert stage.seconds > 0
+        assert stage.mb_per_sec == pytest.approx(2 / stage.seconds)
+        assert 'bag=test-bag stage=copy seconds=' in caplog.text
+        assert 'files=2 bytes_read=2097152 bytes_written=2097152' in caplog.text
+
+        # stage is recorded even if there is an error
+        with pytest.raises(ValueError):
+            with bag_metrics.stage('fail'):
+                raise ValueError
+        assert [s.name for s in bag_metrics.stages] == ['copy', 'fail']
+        assert bag_metrics.total('files') == 2
+
+        bag_metrics.finish()
+        info = bag_metrics.as_dict()
+        assert info['bag'] == 'test-bag'
+        assert info['seconds'] >= stage.seconds
+        assert info['stages'][0]['stage'] == 'copy'
+        assert info['stages'][0]['bytes_read'] == 2097152
+
+    def test_directory_totals(self, tmpdir):
+        assert metrics.directory_totals(str(tmpdir.join('missing'))) == (0, 0)
+        tmpdir.join('one.txt').write('abc')
+        tmpdir.mkdir('sub').join('two.txt').write('defg')
+        assert metrics.directory_totals(str(tmpdir)) == (2, 7)
+
+    def sample_metrics(self):
+        return [{'bag': 'bag1', 'seconds': 3, 'stages': [
+                    {'stage': 'stage_payload', 'seconds': 2, 'files': 4,
+                     'bytes_read': 100, 'bytes_written': 100,
+                     'mb_per_sec': 0},
+                    {'stage': 'save', 'seconds': 1, 'files': 3,
+                     'bytes_read': 10, 'bytes_written': 5, 'mb_per_sec': 0}]},
+                {'bag': 'bag2', 'seconds': 2, 'stages': [
+                    {'stage': 'stage_payload', 'seconds': 1.5, 'files': 1,
+                     'bytes_read': 50, 'bytes_written': 50,
+                     'mb_per_sec': 0}]}]
+
+    def test_write_json(self, tmpdir):
+        path = str(tmpdir.join('metrics.json'))
+        metrics.write_metrics(path, self.sample_metrics())
+        with open(path) as metricsfile:
+            data = json.load(metricsfile)
+        assert data['bags'] == self.sample_metrics()
+        assert 'created' in data
+        assert tmpdir.listdir() == [tmpdir.join('metrics.json')]
+
+    def test_write_prometheus(self, tmpdir):
+        path = str(tmpdir.join('metrics.prom'))
+        metrics.write_metrics(path, self.sample_metrics())
+        content = tmpdir.join('metrics.prom').read()
+        assert '# TYPE baggins_stage_seconds gauge' in content
+        # stages are totalled across bags
+        assert 'baggins_stage_seconds{stage="stage_payload"} 3.5\n' in content
+        assert 'baggins_stage_read_bytes{stage="stage_payload"} 150\n' in content
+        assert 'baggins_stage_written_bytes{stage="save"} 5\n' in content
+        assert 'baggins_bags 2\n' in content
+        assert 'baggins_bag_seconds 5\n' in content
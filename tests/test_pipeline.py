@@ -0,0 +1,69 @@
+import threading
+
+from baggins import pipeline
+
+
+class TestPipeline:
+
+    def test_run(self):
+        def double(job):
+            job.value = job.item * 2
+
+        def increment(job):
+            job.value += 1
+
+        jobs = pipeline.Pipeline([
+            pipeline.Stage('double', double, workers=2),
+            pipeline.Stage('increment', increment, workers=3)
+        ], queue_size=1)
+        results = dict((job.item, job.value) for job in jobs.run(range(10)))
+        assert results == dict((i, i * 2 + 1) for i in range(10))
+
+    def test_errors(self):
+        processed = []
+
+        def check(job):
+            if job.item == 2:
+                raise ValueError('bad item')
+
+        def finish(job):
+            processed.append(job.item)
+
+        jobs = list(pipeline.Pipeline([
+            pipeline.Stage('check', check),
+            pipeline.Stage('finish', finish)
+        ]).run([1, 2, 3]))
+        assert len(jobs) == 3
+        failed = [job for job in jobs if job.failed]
+        assert len(failed) == 1
+        assert failed[0].item == 2
+        assert failed[0].failed_stage == 'check'
+        assert str(failed[0].error) == 'bad item'
+        assert 'ValueError' in failed[0].traceback
+        # later stages are skipped for the failed item
+        assert sorted(processed) == [1, 3]
+
+    def test_stages_overlap(self):
+        second_fetched = threading.Event()
+        overlapped = []
+
+        def fetch(job):
+            if job.item == 2:
+                second_fetched.set()
+
+        def checksum(job):
+            if job.item == 1:
+                # the next item is fetched while this one is in a
+                # later stage
+                overlapped.append(second_fetched.wait(5))
+
+        list(pipeline.Pipeline([
+            pipeline.Stage('fetch', fetch),
+            pipeline.Stage('checksum', checksum)
+        ]).run([1, 2]))
+        assert overlapped == [True]
+
+    def test_empty(self):
+        jobs = pipeline.Pipeline([pipeline.Stage('noop', lambda job: None,
+                                                 workers=4)])
+        assert list(jobs.run([])) == []
@@ -0,0 +1,88 @@
+import errno
+import hashlib
+import os
+import tempfile
+from mock import patch, Mock
+import pytest
+
+from baggins import staging
+
+
+class TestStaging:
+
+    content = 'some payload content' * 1000
+
+    def sourcefile(self, tmpdir):
+        srcfile = tempfile.NamedTemporaryFile(dir=unicode(tmpdir))
+        srcfile.write(self.content)
+        srcfile.flush()
+        os.utime(srcfile.name, (1000000000, 1000000000))
+        return srcfile
+
+    def test_hardlink(self, tmpdir):
+        srcfile = self.sourcefile(tmpdir)
+        dest = os.path.join(unicode(tmpdir), 'staged')
+        strategy, size, checksums = staging.stage_file(
+            srcfile.name, dest, staging.HARDLINK, ['md5'])
+        assert strategy == staging.HARDLINK
+        assert size == len(self.content)
+        # not copied, so no checksums calculated
+        assert checksums is None
+        assert os.stat(dest).st_ino == os.stat(srcfile.name).st_ino
+
+    def test_hardlink_fallback(self, tmpdir):
+        srcfile = self.sourcefile(tmpdir)
+        dest = os.path.join(unicode(tmpdir), 'staged')
+        # simulate cross-device link and no support for clone or kernel copy
+        with patch('baggins.staging.os.link') as mocklink:
+            mocklink.side_effect = OSError(errno.EXDEV, 'Invalid cross-device link')
+            with patch.dict(staging._staging_methods, {
+                    staging.REFLINK: Mock(side_effect=IOError(errno.EOPNOTSUPP, 'nope')),
+                    staging.KERNEL: Mock(side_effect=OSError(errno.ENOSYS, 'nope'))}):
+                strategy, size, checksums = staging.stage_file(
+                    srcfile.name, dest, staging.HARDLINK, ['md5'])
+
+        assert strategy == staging.COPY
+        assert size == len(self.content)
+        # checksums calculated while copying
+        assert checksums == {'md5': hashlib.md5(self.content).hexdigest()}
+        assert os.stat(dest).st_ino != os.stat(srcfile.name).st_ino
+        with open(dest) as staged:
+            assert staged.read() == self.content
+
+    def test_kernel_copy(self, tmpdir):
+        srcfile = self.sourcefile(tmpdir)
+        dest = os.path.join(unicode(tmpdir), 'staged')
+        strategy, size, checksums = staging.stage_file(
+            srcfile.name, dest, staging.KERNEL)
+        # kernel copy should be available on linux
+        assert strategy == staging.KERNEL
+        assert checksums is None
+        with open(dest) as staged:
+            assert staged.read() == self.content
+        assert os.stat(dest).st_mtime == 1000000000
+
+    def test_reflink(self, tmpdir):
+        srcfile = self.sourcefile(tmpdir)
+        dest = os.path.join(unicode(tmpdir), 'staged')
+        # reflink may not be supported by the test filesystem, but
+        # should always result in a copy of the content
+        strategy, size, checksums = staging.stage_file(
+            srcfile.name, dest, staging.REFLINK)
+        assert strategy in [staging.REFLINK, staging.KERNEL, staging.COPY]
+        with open(dest) as staged:
+            assert staged.read() == self.content
+
+    def test_copy(self, tmpdir):
+        srcfile = self.sourcefile(tmpdir)
+        dest = os.path.join(unicode(tmpdir), 'staged')
+        strategy, size, checksums = staging.stage_file(srcfile.name, dest)
+        assert strategy == staging.COPY
+        assert checksums is None
+        with open(dest) as staged:
+            assert staged.read() == self.content
+        assert os.stat(dest).st_mtime == 1000000000
+
+    def test_unknown_strategy(self, tmpdir):
+        with pytest.raises(ValueError):
+            staging.stage_file('foo', 'bar', 'teleport')
@@ -0,0 +1,173 @@
+import json
+import os
+import pytest
+
+from baggins import archive, verify
+from baggins.fixity_index import FixityIndex
+from conftest import SampleBaggee
+
+
+@pytest.fixture
+def payload(tmpdir):
+    content = tmpdir.mkdir('content')
+    files = []
+    for i in range(3):
+        page = content.join('%04d.txt' % i)
+        page.write('page %d content\n' % i * 100)
+        files.append(str(page))
+    return files
+
+
+def make_bag(tmpdir, payload, serialization=None):
+    baggee = SampleBaggee()
+    baggee.files = payload
+    baggee.serialization = serialization
+    output = str(tmpdir.mkdir('bags-%s' % serialization))
+    baggee.create_bag(output)
+    return baggee.bag_path(output)
+
+
+class TestVerify:
+
+    def test_parse_manifest(self):
+        manifest = verify.parse_manifest(
+            'ABC123  data/file one.txt\n\n'
+            'def456 *data/line%0Abreak.txt\n')
+        assert manifest == {'data/file one.txt': 'abc123',
+                            'data/line\nbreak.txt': 'def456'}
+        with pytest.raises(verify.VerificationError):
+            verify.parse_manifest('abc123\n')
+
+    def test_parse_tags(self):
+        tags = verify.parse_tags('Payload-Oxum: 10.2\n'
+                                 'Title: a long\n  title\n'
+                                 'Note: one\nNote: two\n')
+        assert tags == {'Payload-Oxum': ['10.2'], 'Title': ['a long title'],
+                        'Note': ['one', 'two']}
+
+    @pytest.mark.parametrize('serialization', [None] + archive.FORMATS)
+    def test_verify_valid(self, tmpdir, payload, serialization):
+        bagpath = make_bag(tmpdir, payload, serialization)
+        result = verify.verify_bag(bagpath, threads=2)
+        assert result['valid']
+        assert result['fixity']
+        assert result['errors'] == []
+        assert result['files'] == 3
+        assert result['oxum'] == '%d.3' % result['bytes']
+
+        result = verify.verify_bag(bagpath, fast=True)
+        assert result['valid']
+        assert not result['fixity']
+
+    def test_verify_checksum(self, tmpdir, payload):
+        bagpath = make_bag(tmpdir, payload)
+        # same size, different content: passes oxum, fails fixity
+        datafile = os.path.join(bagpath, 'data', '0001.txt')
+        with open(datafile, 'r+b') as data:
+            data.write('X')
+        result = verify.verify_bag(bagpath)
+        assert not result['valid']
+        assert [(err['error'], err['path']) for err in result['errors']] == \
+            [(verify.CHECKSUM, 'data/0001.txt'),
+             (verify.CHECKSUM, 'data/0001.txt')]
+        # fast verification only checks sizes
+        assert verify.verify_bag(bagpath, fast=True)['valid']
+
+    def test_verify_oxum(self, tmpdir, payload):
+        bagpath = make_bag(tmpdir, payload)
+        os.remove(os.path.join(bagpath, 'data', '0001.txt'))
+        extra = os.path.join(bagpath, 'data', 'extra.txt')
+        with open(extra, 'w') as data:
+            data.write('unexpected')
+        result = verify.verify_bag(bagpath)
+        assert not result['valid']
+        # fixity is not checked when the cheap pass fails
+        assert not result['fixity']
+        errors = dict((err['error'], err) for err in result['errors'])
+        assert errors[verify.OXUM]['expected'] == result['oxum']
+        assert errors[verify.MISSING]['path'] == 'data/0001.txt'
+        assert errors[verify.UNLISTED]['path'] == 'data/extra.txt'
+
+    def test_verify_invalid(self, tmpdir):
+        result = verify.verify_bag(str(tmpdir.join('nonexistent')))
+        assert not result['valid']
+        assert result['errors'][0]['error'] == verify.INVALID
+
+        notabag = tmpdir.join('notabag.txt')
+        notabag.write('not a bag')
+        result = verify.verify_bag(str(notabag))
+        assert result['errors'][0]['error'] == verify.INVALID
+
+        result = verify.verify_bag(str(tmpdir.mkdir('emptydir')))
+        assert result['errors'] == [{'error': verify.INVALID,
+                                     'message': 'bagit.txt not found'}]
+
+    def test_verify_bags(self, tmpdir, payload):
+        bags = [make_bag(tmpdir, payload),
+                make_bag(tmpdir, payload, archive.ZIP),
+                str(tmpdir.join('nonexistent'))]
+        results = list(verify.verify_bags(bags, jobs=2))
+        # results are reported in the requested order
+        assert [result['bag'] for result in results] == bags
+        assert [result['valid'] for result in results] == \
+            [True, True, False]
+
+        # stopping early shuts down the worker processes cleanly
+        results = verify.verify_bags(bags, jobs=2)
+        assert next(results)['bag'] == bags[0]
+        results.close()
+
+
+class TestBagVerifier:
+
+    def test_run(self, tmpdir, payload):
+        bagpath = make_bag(tmpdir, payload)
+        baglist = tmpdir.join('bags.txt')
+        baglist.write('%s\n\n' % str(tmpdir.join('nonexistent')))
+        report = str(tmpdir.join('report.json'))
+
+        verifier = verify.BagVerifier()
+        with pytest.raises(SystemExit) as exit:
+            verifier.run([bagpath, '-f', str(baglist), '-o', report])
+        # exit status indicates some bags are invalid
+        assert exit.value.code == 1
+        assert verifier.options.bags == \
+            [bagpath, str(tmpdir.join('nonexistent'))]
+
+        with open(report) as reportfile:
+            data = json.load(reportfile)
+        assert data['summary']['bags'] == 2
+        assert data['summary']['valid'] == 1
+        assert data['summary']['invalid'] == 1
+        assert data['summary']['files'] == 3
+        assert data['bags'][0]['bag'] == bagpath
+
+    def test_verify_incremental(self, tmpdir, payload):
+        bagpath = make_bag(tmpdir, payload)
+        index = FixityIndex(str(tmpdir.join('index.db')), sample_rate=0)
+        result = verify.verify_bag(bagpath, index=index)
+        assert result['valid']
+        # first run checksums everything: payload, plus tag files
+        # listed in tag manifests
+        assert result['checked'] > 3
+        assert result['skipped'] == 0
+
+        # second run skips unchanged files
+        result = verify.verify_bag(bagpath, index=index, threads=2)
+        assert result['valid']
+        assert result['checked'] == 0
+        assert result['fixity']
+
+        # changed file is checksummed again and reported
+        datafile = os.path.join(bagpath, 'data', '0001.txt')
+        with open(datafile, 'r+b') as data:
+            data.write('X')
+        result = verify.verify_bag(bagpath, index=index)
+        assert not result['valid']
+        assert result['checked'] == 1
+        assert set(err['path'] for err in result['errors']) == \
+            set(['data/0001.txt'])
+        # ... including on later runs
+        result = verify.verify_bag(bagpath, index=index)
+        assert not result['valid']
+        assert result['checked'] == 1